@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""Cost of the fleet reports over a large history.
+
+Fills a monit.db with `rows` system samples (hosts reporting once a
+minute, cpu_user and memory_percent) and times the daily p95 and the
+trend of cpu_user three ways:
+
+  numpy   analytics with NumPy, bulk load from system_service_data
+  python  analytics without NumPy (the fallback)
+  view    a DictCursor over the system_service view, grouping per row
+
+A database at `path` is kept and reused by later runs with the same
+number of rows, without `path` it is filled in a temporary directory
+and removed afterwards. The python and view modes hold every sample as Python
+objects, at tens of millions of rows they need several GB of memory.
+
+Usage: python benchmarks/bench_analytics.py [rows] [path|-] [modes]
+"""
+
+import logging, os, random, shutil, sys, tempfile, time
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(root, 'monitoring'))
+
+import analytics, db
+
+START = 1230000000 # 2008-12-23
+
+def fill(path, rows, hosts=200):
+    conn = db.connect(path)
+    db.init_schema(conn, logging.getLogger('bench'))
+    cur = conn.cursor()
+    for h in range(hosts):
+        cur.execute("INSERT INTO monit (id, localhostname, monitid) "
+                    "VALUES (?,?,?)", (h + 1, 'host%03d' % h, '%032x' % h))
+        cur.execute("INSERT INTO strings (id, value) VALUES (?,?)",
+                    (h + 1, 'host%03d' % h))
+    rnd = random.Random(42)
+    def samples():
+        for i in xrange(rows):
+            h = i % hosts
+            t = START + (i // hosts) * 60
+            yield (h + 1, 0, 0, 1, t, h + 1, 5, rnd.gammavariate(2, 5),
+                   30 + (t - START) / 86400.0 + rnd.random() * 5)
+    cur.executemany("INSERT INTO system_service_data (monit_id, status, "
+                    "monitormode, monitor, collected_sec, name_id, type, "
+                    "cpu_user, memory_percent) VALUES (?,?,?,?,?,?,?,?,?)",
+                    samples())
+    cur.execute("CREATE TABLE bench (rows INTEGER)")
+    cur.execute("INSERT INTO bench VALUES (?)", (rows,))
+    conn.commit()
+    conn.close()
+
+def filled(path, rows):
+    if not os.path.exists(path):
+        return False
+    conn = db.connect(path)
+    try:
+        cur = conn.cursor()
+        try:
+            cur.execute("SELECT rows FROM bench")
+        except db.sqlite.OperationalError:
+            return False
+        return cur.fetchone()['rows'] == rows
+    finally:
+        conn.close()
+
+def by_view(conn):
+    """daily p95 and mean of cpu_user the row by row way"""
+    cur = conn.cursor()
+    cur.execute("SELECT monit.localhostname AS host, s.name AS name, "
+                "s.collected_sec AS sec, s.cpu_user AS value FROM "
+                "system_service s JOIN monit ON monit.id = s.monit_id "
+                "WHERE s.cpu_user IS NOT NULL")
+    groups = {}
+    for row in cur:
+        key = (row['host'], row['name'], row['sec'] // 86400)
+        groups.setdefault(key, []).append(row['value'])
+    result = []
+    for key in sorted(groups):
+        values = sorted(groups[key])
+        result.append((key, sum(values) / len(values),
+                       values[int(0.95 * (len(values) - 1))]))
+    return result
+
+def run(conn, mode):
+    analytics.have_numpy = mode == 'numpy'
+    t0 = time.time()
+    samples = analytics.load(conn, 'system_service', 'cpu_user')
+    t1 = time.time()
+    groups = analytics.daily(samples, (0.95,))
+    t2 = time.time()
+    analytics.trend(samples, 100.0)
+    t3 = time.time()
+    return len(groups), t1 - t0, t2 - t1, t3 - t2
+
+def main(args):
+    rows = len(args) > 1 and int(args[1]) or 20000000
+    path = len(args) > 2 and args[2] != '-' and args[2] or None
+    modes = len(args) > 3 and args[3].split(',') or ['numpy', 'python', 'view']
+    tmp = None
+    if path is None:
+        tmp = tempfile.mkdtemp()
+        path = os.path.join(tmp, 'monit.db')
+    try:
+        report(path, rows, modes)
+    finally:
+        if tmp:
+            shutil.rmtree(tmp)
+
+def report(path, rows, modes):
+    if not filled(path, rows):
+        if os.path.exists(path):
+            os.remove(path)
+        t = time.time()
+        fill(path, rows)
+        print "filled %s with %d rows in %.1fs" % (path, rows, time.time() - t)
+    if 'numpy' in modes and not analytics.have_numpy:
+        print "numpy is not installed"
+        modes.remove('numpy')
+    conn = db.connect(path)
+    print "%d rows" % rows
+    print "%-8s %8s %8s %8s %8s %8s" % ('mode', 'groups', 'load s',
+                                        'daily s', 'trend s', 'total s')
+    for mode in modes:
+        if mode == 'view':
+            t = time.time()
+            groups = len(by_view(conn))
+            print "%-8s %8d %8s %8s %8s %8.1f" % (mode, groups, '', '', '',
+                                                  time.time() - t)
+        else:
+            groups, load, daily, trend = run(conn, mode)
+            print "%-8s %8d %8.1f %8.1f %8.1f %8.1f" % (mode, groups, load,
+                  daily, trend, load + daily + trend)
+    conn.close()
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+"""Overhead the monitoring plugin adds to a request for an unrelated page.
+
+Trac asks every IRequestHandler whether it matches and every
+INavigationContributor for its items, this times those calls for all
+monitoring components against `/wiki/WikiStart`.
+
+Usage: python benchmarks/bench_routing.py [iterations]
+"""
+
+import os, re, shutil, sys, tempfile, timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from trac.test import EnvironmentStub, Mock, MockPerm
+from trac.web.href import Href
+
+from monitoring.api import MonitoringAdminModule
+from monitoring.monit import MonitCollector, MonitViewer
+from monitoring.munin import MuninStatsViewer
+
+
+def make_env():
+    env = EnvironmentStub(enable=['trac.*', 'monitoring.*'])
+    env.path = tempfile.mkdtemp()
+    os.mkdir(os.path.join(env.path, 'db'))
+    rrd_path = os.path.join(env.path, 'munin')
+    os.mkdir(rrd_path)
+    fp = open(os.path.join(rrd_path, 'datafile'), 'w')
+    fp.write('version 1.4.5\n')
+    fp.write('example.com;node1.example.com:cpu.graph_title CPU usage\n')
+    fp.close()
+    env.config.set('munin', 'rrd_path', rrd_path)
+    return env
+
+def make_req(path_info):
+    return Mock(path_info=path_info, args={}, perm=MockPerm(),
+                href=Href('/trac'), authname='anonymous')
+
+def old_match(log, path_info):
+    """what every handler did before the routing table"""
+    for name, pattern in [('collector', '/collector(.*)'),
+                          ('monit', '/monit(.*)'), ('munin', '/munin(.*)'),
+                          ('monitoring', '/monitoring(?:/([^/]+))?(?:/([^/]+))?(?:/(.*)$)?')]:
+        log.debug("%s: match_request() called" % name)
+        re.match(pattern, path_info)
+
+def main(args):
+    number = len(args) > 1 and int(args[1]) or 100000
+    env = make_env()
+    try:
+        handlers = [MonitCollector(env), MonitViewer(env), MuninStatsViewer(env),
+                    MonitoringAdminModule(env)]
+        navs = [MonitViewer(env), MuninStatsViewer(env),
+                MonitoringAdminModule(env)]
+        req = make_req('/wiki/WikiStart')
+
+        def match():
+            for h in handlers:
+                h.match_request(req)
+
+        def navigation():
+            for n in navs:
+                list(n.get_navigation_items(req))
+
+        def old():
+            old_match(env.log, req.path_info)
+
+        for label, func in [('match_request, previous code', old),
+                            ('match_request, all handlers', match),
+                            ('get_navigation_items, all', navigation)]:
+            t = min(timeit.repeat(func, number=number, repeat=3))
+            print "%-32s %8.3f us/request" % (label, t / number * 1e6)
+    finally:
+        shutil.rmtree(env.path)
+
+if __name__ == '__main__':
+    main(sys.argv)
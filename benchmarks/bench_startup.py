@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Startup cost of a Trac environment with the monitoring plugin enabled.
+
+Every run is a fresh interpreter (a new Trac worker): it imports the
+plugin, opens the environment and dispatches two requests to /monit
+through Trac's WSGI entry point. The medians are printed in ms.
+
+Usage: python benchmarks/bench_startup.py [runs]
+"""
+
+import os, shutil, subprocess, sys, tempfile
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, root)
+
+child = r'''
+import sys, time
+sys.path.insert(0, %(root)r)
+t0 = time.time()
+import trac.env, trac.web.main
+t1 = time.time()
+import monitoring.api, monitoring.monit, monitoring.munin
+t2 = time.time()
+env = trac.env.open_environment(%(path)r, use_cache=True)
+t3 = time.time()
+
+def request(path_info):
+    from StringIO import StringIO
+    environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': path_info,
+               'SCRIPT_NAME': '/trac', 'SERVER_NAME': 'localhost',
+               'SERVER_PORT': '80', 'wsgi.url_scheme': 'http',
+               'wsgi.input': StringIO(), 'wsgi.errors': sys.stderr,
+               'wsgi.run_once': False, 'wsgi.multithread': False,
+               'wsgi.multiprocess': True,
+               'trac.env_path': %(path)r}
+    status = []
+    body = trac.web.main.dispatch_request(environ,
+                lambda s, h, exc_info=None: status.append(s) or (lambda d: None))
+    ''.join(body)
+    assert status[0].startswith('200'), status
+
+request('/monit')
+t4 = time.time()
+request('/monit')
+t5 = time.time()
+print ' '.join(['%%f' %% ((b - a) * 1000) for a, b in
+                [(t0, t1), (t1, t2), (t2, t3), (t3, t4), (t4, t5)]])
+'''
+
+labels = ['import trac', 'import plugin', 'open environment',
+          'first request /monit', 'second request /monit']
+
+def make_env():
+    from trac.env import Environment
+    from trac.perm import PermissionSystem
+    path = tempfile.mkdtemp()
+    rrd_path = os.path.join(path, 'munin')
+    env = Environment(path, create=True, options=[
+        ('components', 'monitoring.*', 'enabled'),
+        ('munin', 'rrd_path', rrd_path),
+        ('logging', 'log_type', 'none')])
+    os.mkdir(rrd_path)
+    fp = open(os.path.join(rrd_path, 'datafile'), 'w')
+    fp.write('version 1.4.5\n')
+    fp.close()
+    import monitoring.api, monitoring.monit, monitoring.munin
+    PermissionSystem(env).grant_permission('anonymous', 'MONIT_VIEW')
+    return path
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main(args):
+    runs = len(args) > 1 and int(args[1]) or 10
+    path = make_env()
+    try:
+        script = child % {'root': root, 'path': path}
+        results = []
+        for i in range(runs):
+            out = subprocess.Popen([sys.executable, '-c', script],
+                                   stdout=subprocess.PIPE).communicate()[0]
+            results.append([float(v) for v in out.split()])
+        for i, label in enumerate(labels):
+            print "%-24s %8.1f ms" % (label, median([r[i] for r in results]))
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+"""Cost of repeated timeline views with many monit events.
+
+Fills monit.db with `events` events over the last 30 days and times
+MonitViewer.get_timeline_events for the default 30 day window: the
+first view (an empty cache), a view after `new` events were added and
+a view without the cache (timeline_cache_size = 0). Medians in ms.
+The cache is made large enough to hold all events.
+
+Usage: python benchmarks/bench_timeline.py [events] [new] [runs]
+"""
+
+import os, shutil, sys, tempfile, time
+from datetime import datetime
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, root)
+
+from trac.test import EnvironmentStub
+from trac.util.datefmt import utc
+
+from monitoring import db
+from monitoring.monit import MonitViewer
+
+SERVICES = 200
+
+def make_env():
+    env = EnvironmentStub(enable=['trac.*', 'monitoring.*'])
+    env.path = tempfile.mkdtemp()
+    os.mkdir(os.path.join(env.path, 'db'))
+    return env
+
+def fill(path, events, now, first_id=1):
+    conn = db.connect(path)
+    cur = conn.cursor()
+    if first_id == 1:
+        cur.execute("INSERT INTO monit (id, localhostname, monitid) "
+                    "VALUES (1, 'bench', 'f')")
+        for i in range(SERVICES):
+            cur.execute("INSERT INTO strings (id, value) VALUES (?,?)",
+                        (i + 1, 'process-%d' % i))
+            cur.execute("INSERT INTO process_service_data (id, monit_id, "
+                        "status, monitormode, monitor, collected_sec, "
+                        "name_id, pid) VALUES (?,1,0,0,1,?,?,?)",
+                        (i + 1, now - 30 * 86400, i + 1, 1000 + i))
+        cur.execute("INSERT INTO strings (id, value) VALUES (?,?)",
+                    (SERVICES + 1, 'process is not running'))
+    step = 30 * 86400 / max(events, 1)
+    cur.executemany("INSERT INTO event_data (id, service_id, type, "
+                    "collected_sec, state, message_id, last_sec, count) "
+                    "VALUES (?,?,3,?,1,?,?,1)",
+                    [(first_id + i, i % SERVICES + 1,
+                      now - 30 * 86400 + (first_id + i) * step % (30 * 86400),
+                      SERVICES + 1, now) for i in range(events)])
+    # the last event of every service may still be counted
+    cur.execute("INSERT OR REPLACE INTO event_latest (monit_id, type, name_id, "
+                "event_id) SELECT 1, type, service_id, MAX(id) FROM event_data "
+                "GROUP BY type, service_id")
+    conn.commit()
+    conn.close()
+
+def view(viewer, start, stop):
+    t = time.time()
+    n = len(list(viewer.get_timeline_events(None, start, stop,
+                                            ['monit_process'])))
+    return n, time.time() - t
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main(args):
+    events = len(args) > 1 and int(args[1]) or 20000
+    new = len(args) > 2 and int(args[2]) or 10
+    runs = len(args) > 3 and int(args[3]) or 5
+    env = make_env()
+    try:
+        path = os.path.join(env.path, 'db', 'monit.db')
+        db.ensure_schema(path, env.log)
+        now = int(time.time())
+        fill(path, events, now)
+        env.config.set('monit', 'timeline_cache_size',
+                       str(max(20000, events + (runs + 1) * new)))
+        viewer = MonitViewer(env)
+        stop = datetime.fromtimestamp(now + 3600, utc)
+        start = datetime.fromtimestamp(now - 30 * 86400, utc)
+        n, first = view(viewer, start, stop)
+        warm = []
+        next_id = events + 1
+        for i in range(runs):
+            fill(path, new, now, next_id)
+            next_id += new
+            n, t = view(viewer, start, stop)
+            warm.append(t)
+        viewer._timeline.max_events = 0
+        cold = [view(viewer, start, stop)[1] for i in range(runs)]
+        print "%d events in the window" % n
+        print "%-24s %10.1f" % ('first view ms', first * 1000)
+        print "%-24s %10.1f" % ('view, %d new ms' % new, median(warm) * 1000)
+        print "%-24s %10.1f" % ('without cache ms', median(cold) * 1000)
+    finally:
+        shutil.rmtree(env.path)
+
+if __name__ == '__main__':
+    main(sys.argv)
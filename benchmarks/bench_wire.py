@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+"""Size and decoding cost of the /collector wire formats.
+
+Builds one monit document with many process services and compares the
+bytes sent per format with the time the collector spends inflating and
+parsing it (wire.read_body + wire.parse), the median of the runs in ms.
+
+Usage: python benchmarks/bench_wire.py [processes] [runs]
+"""
+
+import gzip, os, sys, time, zlib
+from StringIO import StringIO
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(root, 'monitoring'))
+
+import wire
+
+def make_document(processes):
+    services = [{'type': 5, 'name': 'localhost', 'status': 0, 'monitor': 1,
+                 'monitormode': 0, 'pendingaction': 0, 'collected_sec': 1230000000,
+                 'collected_usec': 0,
+                 'system': {'load': {'avg01': 0.12, 'avg05': 0.2, 'avg15': 0.3},
+                            'cpu': {'user': 1.5, 'system': 0.7, 'wait': 0.1},
+                            'memory': {'percent': 41.2, 'kilobyte': 843212},
+                            'swap': {'percent': 0.0, 'kilobyte': 0}}}]
+    for i in range(processes):
+        services.append({'type': 3, 'name': 'process-%d' % i, 'status': 0,
+                         'monitor': 1, 'monitormode': 0, 'pendingaction': 0,
+                         'collected_sec': 1230000000, 'collected_usec': 0,
+                         'pid': 1000 + i, 'ppid': 1, 'uptime': 86400 + i,
+                         'children': i % 4,
+                         'memory': {'percent': 0.4, 'percenttotal': 0.9,
+                                    'kilobyte': 8124 + i, 'kilobytetotal': 16248},
+                         'cpu': {'percent': 0.1, 'percenttotal': 0.3}})
+    return {'monit': {'server': {'id': 'f' * 32, 'incarnation': 1230000000,
+                                 'version': '5.0', 'uptime': 86400, 'poll': 60,
+                                 'startdelay': 0, 'localhostname': 'bench',
+                                 'controlfile': '/etc/monitrc',
+                                 'platform': {'name': 'Linux', 'release': '2.6.26',
+                                              'version': '#1', 'machine': 'x86_64',
+                                              'cpu': 4, 'memory': 2055120,
+                                              'swap': 2097144}}},
+            'servicelist': services}
+
+def gzipped(data):
+    buf = StringIO()
+    fp = gzip.GzipFile(fileobj=buf, mode='wb')
+    fp.write(data)
+    fp.close()
+    return buf.getvalue()
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+def main(args):
+    processes = len(args) > 1 and int(args[1]) or 2000
+    runs = len(args) > 2 and int(args[2]) or 20
+    doc = make_document(processes)
+    formats = []
+    if wire.have_json:
+        import simplejson
+        text = simplejson.dumps(doc)
+        formats += [('json', 'application/json', None, text),
+                    ('json+gzip', 'application/json', 'gzip', gzipped(text)),
+                    ('json+deflate', 'application/json', 'deflate',
+                     zlib.compress(text))]
+    if wire.have_msgpack:
+        import msgpack
+        packed = msgpack.packb(doc, use_bin_type=True)
+        formats += [('msgpack', 'application/x-msgpack', None, packed),
+                    ('msgpack+gzip', 'application/x-msgpack', 'gzip',
+                     gzipped(packed))]
+    print "%d process services" % processes
+    print "%-14s %10s %10s" % ('format', 'bytes', 'ms')
+    for label, ct, encoding, body in formats:
+        times = []
+        for i in range(runs):
+            t = time.time()
+            raw = wire.read_body(StringIO(body).read, len(body), encoding)
+            wire.parse(raw, ct)
+            times.append(time.time() - t)
+        print "%-14s %10d %10.2f" % (label, len(body), median(times) * 1000)
+
+if __name__ == '__main__':
+    main(sys.argv)
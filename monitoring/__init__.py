@@ -0,0 +1,9 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
+"""Monit and munin monitoring for Trac.
+
+Only the components in api.py, monit.py and munin.py import Trac. The
+other modules are shared with the standalone tools (monit-collectord,
+monit-spool, monit-backfill, monit-export, monit-report and
+munin-prerender) and must not depend on Trac.
+"""
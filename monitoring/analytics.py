@@ -0,0 +1,442 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
+"""Fleet reports over monit history.
+
+A report reads one numeric column of a `*_service` table for a time
+range in bulk: `(monit_id, name_id, collected_sec, value)` straight from
+`<table>_data` with a plain cursor, without the string joins of the
+views and without a dict per row. With NumPy installed the samples are
+kept in arrays and aggregated per group in a few vectorised passes,
+otherwise the same results are computed with lists.
+
+Reports:
+
+  daily   count, mean, min, max and percentiles per host, service and
+          UTC day, e.g. the daily p95 of `system_service.cpu_user`
+  trend   a least squares line per host and service, its slope per day
+          and when it reaches `limit`, e.g. the fill time projection of
+          `filesystem_service.block_percent` with limit 100
+
+Percentiles interpolate linearly between the closest ranks.
+
+Usage: monit-report [options] /path/to/tracenv daily|trend table column
+"""
+
+import csv, logging, os, sys, time
+from itertools import chain, izip
+from optparse import OptionParser
+
+import db, partition
+from db import sqlite
+from export import parse_time
+from ingest import srv_types
+
+try:
+    import numpy
+    have_numpy = True
+except ImportError:
+    have_numpy = False
+
+joinpath = os.path.join
+
+DAY = 86400
+
+tables = ['%s_service' % v for v in srv_types.values()]
+
+reports = ['daily', 'trend']
+
+
+class Samples(object):
+    """The values of one column. `keys` are the (host, name) of each
+    series sorted by host and name, `series`, `sec` and `value` hold the
+    series index, time and value of every sample (arrays with NumPy,
+    lists otherwise). Clients sharing a localhostname (a host whose
+    monit id was generated again) are one series."""
+
+    def __init__(self, keys, series, sec, value):
+        self.keys = keys
+        self.series = series
+        self.sec = sec
+        self.value = value
+
+    def __len__(self):
+        return len(self.value)
+
+
+def columns(conn, table):
+    """the numeric columns of `table` a report can use"""
+    if table not in tables:
+        raise ValueError("Unknown table '%s'" % table)
+    cur = conn.cursor()
+    cur.execute("PRAGMA table_info(%s)" % table)
+    return [r['name'] for r in cur.fetchall() if r['name'] not in
+            ('id', 'monit_id', 'collected_sec') and
+            r['name'] not in db.interned[table] and
+            ('INT' in r['type'].upper() or 'REAL' in r['type'].upper())]
+
+def load(conn, table, column, start=None, stop=None, host=None, service=None,
+         partitions=None, chunk=100000):
+    """Read `column` of `table` for [start, stop], optionally for one
+    monit host (localhostname) and service name. Returns `Samples`."""
+    if column not in columns(conn, table):
+        raise ValueError("No numeric column '%s' in %s" % (column, table))
+    cur = conn.cursor()
+    cur.execute("SELECT id, localhostname FROM monit")
+    hosts = dict([(r['id'], r['localhostname']) for r in cur.fetchall()])
+    monit_ids = None
+    if host:
+        monit_ids = [i for i, h in hosts.items() if h == host]
+        if not monit_ids:
+            return _samples([], [], [], [])
+    if partitions:
+        prefixes = partitions.iter_range(conn, start or 0, stop or sys.maxint)
+    else:
+        prefixes = ['']
+    keys = {} # (monit_id, name) -> series index, in order of appearance
+    parts = []
+    for prefix in prefixes:
+        part = _load(conn, prefix, table, column, start, stop, monit_ids,
+                     service, chunk, keys)
+        if part:
+            parts.append(part)
+    keys = [((hosts.get(m, str(m)), name), i) for (m, name), i in keys.items()]
+    if have_numpy:
+        if not parts:
+            return _samples(keys, numpy.zeros(0, numpy.int32),
+                            numpy.zeros(0), numpy.zeros(0))
+        return _samples(keys, numpy.concatenate([p[0] for p in parts]),
+                        numpy.concatenate([p[1] for p in parts]),
+                        numpy.concatenate([p[2] for p in parts]))
+    series, sec, value = [], [], []
+    for p in parts:
+        series += p[0]
+        sec += p[1]
+        value += p[2]
+    return _samples(keys, series, sec, value)
+
+def daily(samples, quantiles=(0.5, 0.95), span=DAY):
+    """count, mean, min, max and `quantiles` per series and day, a list
+    of dicts sorted by host, name and day. The percentiles are keys like
+    `p95`."""
+    if not len(samples):
+        return []
+    labels = [label(q) for q in quantiles]
+    if have_numpy:
+        day = (samples.sec // span).astype(numpy.int64)
+        first = day.min()
+        days = day.max() - first + 1
+        group, value, starts, ends = _sort_groups(
+            samples.series.astype(numpy.int64) * days + (day - first),
+            samples.value)
+        series, day = group // days, group % days + first
+        counts = ends - starts
+        sums = numpy.add.reduceat(value, starts)
+        results = [_ranked(value, starts, counts, q) for q in quantiles]
+        groups = izip(series[starts].tolist(), day[starts].tolist(),
+                      counts.tolist(), (sums / counts).tolist(),
+                      value[starts].tolist(), value[ends - 1].tolist(),
+                      izip(*[r.tolist() for r in results]))
+    else:
+        by_group = {}
+        for s, t, v in izip(samples.series, samples.sec, samples.value):
+            by_group.setdefault((s, int(t // span)), []).append(v)
+        groups = []
+        for (s, d), values in sorted(by_group.items()):
+            values.sort()
+            n = len(values)
+            groups.append((s, d, n, float(sum(values)) / n, values[0],
+                           values[-1], [_rank(values, 0, n, q)
+                                        for q in quantiles]))
+    keys = samples.keys
+    rows = []
+    for s, d, count, mean, lowest, highest, ranked in groups:
+        row = {'host': keys[s][0], 'name': keys[s][1],
+               'day': time.strftime('%Y-%m-%d', time.gmtime(d * span)),
+               'count': count, 'mean': mean, 'min': lowest, 'max': highest}
+        row.update(zip(labels, ranked))
+        rows.append(row)
+    return rows
+
+def trend(samples, limit=None):
+    """A least squares line through each series: a list of dicts with
+    count, first_sec, last_sec, last (the last value), slope (per day)
+    and, with `limit`, reaches (the time the line crosses `limit`, None
+    if it does not rise) and days_left from the last sample."""
+    if not len(samples):
+        return []
+    keys = samples.keys
+    if have_numpy:
+        t0 = samples.sec.min()
+        x = (samples.sec - t0) / DAY
+        y = samples.value
+        s = samples.series
+        size = len(keys)
+        n = numpy.bincount(s, minlength=size).astype(numpy.float64)
+        sx = numpy.bincount(s, x, size)
+        sy = numpy.bincount(s, y, size)
+        sxy = numpy.bincount(s, x * y, size)
+        sxx = numpy.bincount(s, x * x, size)
+        group, sec, starts, ends = _sort_groups(s, samples.sec)
+        present = group[starts]
+        last = numpy.zeros(size)
+        last[present] = sec[ends - 1]
+        at_last = numpy.flatnonzero(samples.sec == last[s])
+        last_value = numpy.zeros(size)
+        last_value[s[at_last]] = y[at_last]
+        sums = izip(present.tolist(), n[present].tolist(), sx[present].tolist(),
+                    sy[present].tolist(), sxy[present].tolist(),
+                    sxx[present].tolist(), sec[starts].tolist(),
+                    sec[ends - 1].tolist(), last_value[present].tolist())
+    else:
+        t0 = min(samples.sec)
+        acc = {} # series -> [n, sx, sy, sxy, sxx, first, last, last value]
+        for s, t, v in izip(samples.series, samples.sec, samples.value):
+            x = float(t - t0) / DAY
+            a = acc.get(s)
+            if a is None:
+                a = acc[s] = [0, 0.0, 0.0, 0.0, 0.0, t, t, v]
+            a[0] += 1
+            a[1] += x
+            a[2] += v
+            a[3] += x * v
+            a[4] += x * x
+            if t < a[5]:
+                a[5] = t
+            if t >= a[6]:
+                a[6], a[7] = t, v
+        sums = [tuple([s] + a) for s, a in sorted(acc.items())]
+    rows = []
+    for s, n, sx, sy, sxy, sxx, first, last, last_value in sums:
+        row = {'host': keys[s][0], 'name': keys[s][1], 'count': int(n),
+               'first_sec': int(first), 'last_sec': int(last),
+               'last': last_value, 'slope': None}
+        denominator = n * sxx - sx * sx
+        if n > 1 and denominator > 1e-12 * n * n:
+            slope = (n * sxy - sx * sy) / denominator
+            intercept = (sy - slope * sx) / n
+            row['slope'] = slope
+            if limit is not None:
+                row['reaches'] = row['days_left'] = None
+                if slope > 0:
+                    reaches = t0 + (limit - intercept) / slope * DAY
+                    row['reaches'] = int(reaches)
+                    row['days_left'] = (reaches - last) / DAY
+        elif limit is not None:
+            row['reaches'] = row['days_left'] = None
+        rows.append(row)
+    return rows
+
+def label(q):
+    """the key of quantile `q` in the `daily` rows, e.g. p95"""
+    return 'p%g' % (q * 100)
+
+
+# Internal functions
+
+def _load(conn, prefix, table, column, start, stop, monit_ids, service,
+          chunk, keys):
+    """(series, sec, value) of one schema, `keys` collects the series"""
+    cur = conn.cursor()
+    cur.execute("PRAGMA %stable_info(%s_data)" % (prefix, table))
+    present = set([r['name'] for r in cur.fetchall()])
+    if present:
+        name = 'name_id'
+        source = '%s%s_data' % (prefix, table)
+    else: # a partition not written to since the strings were interned
+        cur.execute("PRAGMA %stable_info(%s)" % (prefix, table))
+        present = set([r['name'] for r in cur.fetchall()])
+        name = 'name'
+        source = prefix + table
+    if column not in present:
+        return None
+    sql = "SELECT monit_id, %s, collected_sec, %s FROM %s WHERE %s IS NOT NULL" % (
+          name, column, source, column)
+    args = ()
+    if start is not None:
+        sql += " AND collected_sec >= ?"
+        args += (start,)
+    if stop is not None:
+        sql += " AND collected_sec <= ?"
+        args += (stop,)
+    if monit_ids:
+        sql += " AND monit_id IN (%s)" % ','.join(['?'] * len(monit_ids))
+        args += tuple(monit_ids)
+    if service and name == 'name_id':
+        sql += " AND name_id = (SELECT id FROM %sstrings WHERE value=?)" % prefix
+        args += (service,)
+    elif service:
+        sql += " AND name = ?"
+        args += (service,)
+    # a plain cursor, tuples are all we need
+    cur = sqlite.Cursor(conn)
+    cur.execute(sql, args)
+    codes = None
+    if name == 'name':
+        codes = {} # text name -> key
+    if have_numpy:
+        pair, sec, value = [], [], []
+        while True:
+            rows = cur.fetchmany(chunk)
+            if not rows:
+                break
+            if codes is not None:
+                rows = [(r[0], codes.setdefault(r[1], len(codes)), r[2], r[3])
+                        for r in rows]
+            a = numpy.fromiter(chain.from_iterable(rows), numpy.float64,
+                               4 * len(rows)).reshape(-1, 4)
+            # monit_id and name key in one integer
+            pair.append(a[:, 0].astype(numpy.int64) << 32 |
+                        a[:, 1].astype(numpy.int64))
+            sec.append(a[:, 2].copy())
+            value.append(a[:, 3].copy())
+        cur.close()
+        if not value:
+            return None
+        pairs, inverse = numpy.unique(numpy.concatenate(pair),
+                                      return_inverse=True)
+        del pair
+        pairs = [(int(p >> 32), int(p & 0xffffffff)) for p in pairs]
+        mapping = numpy.array(_series(conn, prefix, pairs, keys, codes),
+                              dtype=numpy.int32)
+        return (mapping[inverse], numpy.concatenate(sec),
+                numpy.concatenate(value))
+    rows = cur.fetchall()
+    cur.close()
+    if not rows:
+        return None
+    if codes is not None:
+        rows = [(r[0], codes.setdefault(r[1], len(codes)), r[2], r[3])
+                for r in rows]
+    pairs = sorted(set([(r[0], r[1]) for r in rows]))
+    mapping = dict(zip(pairs, _series(conn, prefix, pairs, keys, codes)))
+    return ([mapping[(r[0], r[1])] for r in rows], [r[2] for r in rows],
+            [r[3] for r in rows])
+
+def _series(conn, prefix, pairs, keys, codes):
+    """the series index of each (monit_id, name key) in `pairs`, the
+    keys are ids of the strings table or, without one, from `codes`"""
+    if codes is not None:
+        names = dict([(c, n) for n, c in codes.items()])
+    else:
+        ids = sorted(set([p[1] for p in pairs]))
+        names = {}
+        cur = conn.cursor()
+        for i in range(0, len(ids), 500):
+            part = ids[i:i+500]
+            cur.execute("SELECT id, value FROM %sstrings WHERE id IN (%s)" % (
+                        prefix, ','.join(['?'] * len(part))), part)
+            names.update([(r['id'], r['value']) for r in cur.fetchall()])
+    result = []
+    for monit_id, key in pairs:
+        k = (monit_id, names.get(key))
+        if k not in keys:
+            keys[k] = len(keys)
+        result.append(keys[k])
+    return result
+
+def _samples(keys, series, sec, value):
+    """Samples with the series renumbered in the order of their keys,
+    `keys` are ((host, name), series) pairs. Series with the same key
+    are merged."""
+    ordered = sorted(set([key for key, old in keys]))
+    index = dict([(key, i) for i, key in enumerate(ordered)])
+    renumber = [0] * len(keys)
+    for key, old in keys:
+        renumber[old] = index[key]
+    if have_numpy:
+        series = numpy.array(renumber, dtype=numpy.int32)[series] \
+                 if len(series) else series
+    else:
+        series = [renumber[s] for s in series]
+    return Samples(ordered, series, sec, value)
+
+def _sort_groups(group, value):
+    """Sort by `group`, then by `value` and return the sorted groups and
+    values with the start and end index of each group. Complex numbers
+    sort by their real part first, one sort does both keys."""
+    c = numpy.empty(len(group), numpy.complex128)
+    c.real = group
+    c.imag = value
+    c.sort()
+    group = c.real.astype(numpy.int64)
+    starts = numpy.concatenate(([0], numpy.flatnonzero(group[1:] !=
+                                                      group[:-1]) + 1))
+    ends = numpy.concatenate((starts[1:], [len(group)]))
+    return group, c.imag, starts, ends
+
+def _ranked(value, starts, counts, q):
+    """the `q` quantile of each sorted group (vectorised `_rank`)"""
+    pos = starts + q * (counts - 1)
+    lo = numpy.floor(pos).astype(numpy.int64)
+    hi = numpy.minimum(lo + 1, starts + counts - 1)
+    return value[lo] + (value[hi] - value[lo]) * (pos - lo)
+
+def _rank(values, start, count, q):
+    pos = start + q * (count - 1)
+    lo = int(pos)
+    hi = min(lo + 1, start + count - 1)
+    return values[lo] + (values[hi] - values[lo]) * (pos - lo)
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options] /path/to/tracenv '
+                          'daily|trend table column\n\ntables: ' +
+                          ', '.join(tables))
+    parser.add_option('-o', '--output', default='-',
+                      help='output file [stdout]')
+    parser.add_option('--host', default=None, help='monit localhostname')
+    parser.add_option('--service', default=None, help='service name')
+    parser.add_option('--from', dest='start', default=None,
+                      help='YYYY-MM-DD or seconds since the epoch')
+    parser.add_option('--to', dest='stop', default=None,
+                      help='YYYY-MM-DD or seconds since the epoch')
+    parser.add_option('-q', '--quantiles', default='0.5,0.95',
+                      help='percentiles of the daily report [%default]')
+    parser.add_option('--limit', type='float', default=None,
+                      help='project when the trend reaches this value')
+    options, args = parser.parse_args(args)
+    if len(args) != 4 or args[1] not in reports:
+        parser.error('the Trac environment, a report, a table and a column '
+                     'are required')
+    env_path, report, table, column = args
+
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+    log = logging.getLogger('monit-report')
+
+    db_path = joinpath(env_path, 'db', 'monit.db')
+    partitions = partition.from_env(env_path, log)
+
+    conn = db.connect(db_path)
+    try:
+        try:
+            quantiles = [float(q) for q in options.quantiles.split(',')]
+            samples = load(conn, table, column, parse_time(options.start),
+                           parse_time(options.stop), options.host,
+                           options.service, partitions)
+        except ValueError, e:
+            parser.error(str(e))
+    finally:
+        conn.close()
+    if report == 'daily':
+        rows = daily(samples, quantiles)
+        fields = ['host', 'name', 'day', 'count', 'mean', 'min', 'max'] + \
+                 [label(q) for q in quantiles]
+    else:
+        rows = trend(samples, options.limit)
+        fields = ['host', 'name', 'count', 'first_sec', 'last_sec', 'last',
+                  'slope']
+        if options.limit is not None:
+            fields += ['reaches', 'days_left']
+    out = options.output == '-' and sys.stdout or open(options.output, 'wb')
+    try:
+        writer = csv.writer(out)
+        writer.writerow(fields)
+        for row in rows:
+            writer.writerow([isinstance(row[f], unicode) and
+                             row[f].encode('utf-8') or row[f] for f in fields])
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -11,21 +11,24 @@
 # individuals. For the exact contribution history, see the revision
 # history and logs, available at http://trac.edgewall.org/log/.
 import pkg_resources
-import re
+import threading, time
 
 from genshi import HTML
 from genshi.builder import tag
 
 from trac import __version__ as TRAC_VERSION
 from trac.core import *
+from trac.config import IntOption
 from trac.perm import PermissionSystem, IPermissionRequestor
 from trac.util import get_pkginfo, get_module_path
 from trac.util.compat import partial
 from trac.util.translation import _
-from trac.web import HTTPNotFound, IRequestHandler
+from trac.web import HTTPNotFound, IRequestFilter, IRequestHandler
 from trac.web.chrome import add_script, add_stylesheet, Chrome, \
                             INavigationContributor, ITemplateProvider
 
+import routes
+
 
 class IMonitoringPanelProvider(Interface):
     """Extension point interface for adding panels to the web-based
@@ -50,14 +53,85 @@ class IMonitoringPanelProvider(Interface):
         data to be passed to the template.
         """
         
+class PanelRegistry(object):
+    """Panels of all `IMonitoringPanelProvider`s, cached per permission set.
+
+    Users with the same permissions share one entry. The permissions of a
+    user are looked up again after `ttl` seconds or after `invalidate()`.
+    Trac 0.11 doesn't announce permission changes, `MonitoringAdminModule`
+    invalidates when the permission admin panel is posted, changes made
+    with trac-admin wait for the ttl. The providers only change with the
+    component, which a reloaded environment creates again.
+    """
+
+    def __init__(self, env, providers, ttl):
+        self.env = env
+        self.providers = providers
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self.invalidate()
+
+    def invalidate(self):
+        """Forget all cached permissions and panels"""
+        self._lock.acquire()
+        try:
+            self._users = {} # authname -> (time, permission set)
+            self._entries = {} # permission set -> PanelEntry
+        finally:
+            self._lock.release()
+
+    def get(self, req):
+        """Return the `PanelEntry` for the user of `req`"""
+        now = time.time()
+        user = self._users.get(req.authname)
+        if user is None or now - user[0] > self.ttl:
+            perms = PermissionSystem(self.env).get_user_permissions(req.authname)
+            user = (now, frozenset([k for k, v in perms.items() if v]))
+            self._users[req.authname] = user
+        entry = self._entries.get(user[1])
+        if entry is None:
+            entry = PanelEntry(self.providers, req)
+            self._lock.acquire()
+            try:
+                self._entries[user[1]] = entry
+            finally:
+                self._lock.release()
+        return entry
+
+
+class PanelEntry(object):
+    """Sorted panels with the provider of each panel and the default
+    panel of each category."""
+
+    def __init__(self, providers, req):
+        panels = []
+        self.providers = {}
+        for provider in providers:
+            p = list(provider.get_panels(req))
+            for panel in p:
+                self.providers[(panel[0], panel[2])] = provider
+            panels += p
+        panels.sort()
+        self.panels = panels
+        self.defaults = {}
+        for panel in panels:
+            self.defaults.setdefault(panel[0], panel[2])
+
+
 class MonitoringAdminModule(Component):
     """Web administration interface for monitoring"""
-    implements(INavigationContributor, IRequestHandler, ITemplateProvider)
+    implements(INavigationContributor, IRequestFilter, IRequestHandler,
+               ITemplateProvider)
     panel_providers = ExtensionPoint(IMonitoringPanelProvider)
 
+    panel_cache_ttl = IntOption('monitoring', 'panel_cache_ttl', 60,
+        """Seconds until the permissions of a user are checked again to
+        find the monitoring panels available to them.""")
+
     def __init__(self, *args, **kwargs):
         Component.__init__(self, *args, **kwargs)
-        self.env.log.debug("MonitoringAdminModule: __init__() called")
+        self.panel_registry = PanelRegistry(self.env, self.panel_providers,
+                                            self.panel_cache_ttl)
         
     # INavigationContributor methods
 
@@ -67,17 +141,25 @@ class MonitoringAdminModule(Component):
     def get_navigation_items(self, req):
         # The 'Admin' navigation item is only visible if at least one
         # admin panel is available
-        panels, providers = self._get_panels(req)
-        if panels:
+        if self.panel_registry.get(req).panels:
             yield ('mainnav', 'monitoring', tag.a(_('Monitoring'), 
                    href=req.href.monitoring(), title=_('Monitoring')))
 
+    # IRequestFilter methods
+
+    def pre_process_request(self, req, handler):
+        if req.method == 'POST' and \
+                req.path_info.startswith('/admin/general/perm'):
+            self.panel_registry.invalidate()
+        return handler
+
+    def post_process_request(self, req, template, data, content_type):
+        return template, data, content_type
+
     # IRequestHandler methods
 
     def match_request(self, req):
-        self.env.log.debug("MonitoringAdminModule: match_request() called")
-        match = re.match('/monitoring(?:/([^/]+))?(?:/([^/]+))?(?:/(.*)$)?',
-                         req.path_info)
+        match = routes.match('monitoring', req.path_info)
         if match:
             req.args['cat_id'] = match.group(1)
             req.args['panel_id'] = match.group(2)
@@ -85,18 +167,18 @@ class MonitoringAdminModule(Component):
             return True
 
     def process_request(self, req):
-        panels, providers = self._get_panels(req)
+        entry = self.panel_registry.get(req)
+        panels = entry.panels
         if not panels:
             raise HTTPNotFound(_('No monitoring panels available'))
 
-        panels.sort()
         cat_id = req.args.get('cat_id') or panels[0][0]
         panel_id = req.args.get('panel_id')
         path_info = req.args.get('path_info')
         if not panel_id:
-            panel_id = filter(lambda panel: panel[0] == cat_id, panels)[0][2]
+            panel_id = entry.defaults.get(cat_id)
 
-        provider = providers.get((cat_id, panel_id), None)
+        provider = entry.providers.get((cat_id, panel_id), None)
         if not provider:
             raise HTTPNotFound(_('Unknown monitoring panel'))
 
@@ -129,23 +211,3 @@ class MonitoringAdminModule(Component):
     def get_templates_dirs(self):
         #FIXME: what's the first value?
         return [pkg_resources.resource_filename(__name__, 'templates')]
-
-    # Internal methods
-
-    def _get_panels(self, req):
-        """Return a list of available admin panels."""
-        panels = []
-        providers = {}
-
-        for provider in self.panel_providers:
-            p = list(provider.get_panels(req))
-            for panel in p:
-                providers[(panel[0], panel[2])] = provider
-            panels += p
-
-        return panels, providers
-
-
-        
-
-        
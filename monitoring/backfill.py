@@ -0,0 +1,176 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
+"""Load archived monit documents into monit.db.
+
+The collector keeps XML documents in `log_dir/<monit id>/` and documents
+it could not parse in `log_dir/invalid/`. This tool parses them on a
+process pool, maps them through `MonitIngest` like the live collector
+and stores them in large transactions in order of collection time.
+Loaded files are recorded in `backfill_file` in the same transaction,
+an interrupted run continues where it stopped.
+
+Usage: monit-backfill [options] /path/to/tracenv
+"""
+
+import logging, os, sys, time
+from ConfigParser import ConfigParser
+from multiprocessing import Pool
+from optparse import OptionParser
+
+import db, partition
+from ingest import MonitIngest, parse_xml
+
+try:
+    import simplejson
+    have_json = True
+except ImportError:
+    have_json = False
+
+joinpath = os.path.join
+
+def find_files(log_dir):
+    """all archived documents below log_dir, as (timestamp, path)"""
+    found = []
+    for dirpath, dirnames, filenames in os.walk(log_dir):
+        for name in filenames:
+            stem, ext = os.path.splitext(name)
+            if ext not in ('.xml', '.json'):
+                continue
+            path = joinpath(dirpath, name)
+            try:
+                ts = int(stem) # the collector names files after time()
+            except ValueError:
+                ts = int(os.path.getmtime(path))
+            found.append((ts, path))
+    return found
+
+def parse_file(item):
+    """Parse one archived document, runs in the worker processes.
+    Returns (timestamp, path, document or None, error or None)."""
+    ts, path = item
+    try:
+        fp = open(path)
+        try:
+            raw = fp.read()
+        finally:
+            fp.close()
+        if path.endswith('.json'):
+            data = simplejson.loads(raw.replace('\n', ''))
+        else:
+            data = parse_xml(raw)
+        data['monit']['server']['id'] # every document names its monit
+        return ts, path, data, None
+    except Exception, e:
+        return ts, path, None, '%s: %s' % (e.__class__.__name__, e)
+
+
+class Backfill(object):
+
+    def __init__(self, db_path, log, partitions=None, batch_size=1000,
+                 processes=None):
+        self.db_path = db_path
+        self.log = log
+        self.partitions = partitions
+        self.batch_size = batch_size
+        self.processes = processes
+        self.ingest = MonitIngest(log, partitions)
+        self.files = self.documents = self.failed = self.skipped = 0
+
+    def run(self, log_dir):
+        db.ensure_schema(self.db_path, self.log)
+        conn = db.connect(self.db_path, isolation_level=None)
+        cur = conn.cursor()
+        cur.execute("SELECT path FROM backfill_file")
+        done = set([r['path'] for r in cur.fetchall()])
+        todo = [f for f in find_files(log_dir) if f[1] not in done]
+        self.skipped = len(done)
+        todo.sort()
+        self.log.info("%d files to load, %d loaded before" % (len(todo), len(done)))
+
+        started = time.time()
+        pool = Pool(self.processes)
+        try:
+            # imap keeps the order, so batches stay sorted by time
+            batch = []
+            for result in pool.imap(parse_file, todo, chunksize=64):
+                batch.append(result)
+                if len(batch) >= self.batch_size:
+                    self._load(conn, batch)
+                    self._report(started)
+                    batch = []
+            if batch:
+                self._load(conn, batch)
+        finally:
+            pool.close()
+            pool.join()
+            conn.close()
+        self._report(started)
+
+    def _load(self, conn, batch):
+        now = int(time.time())
+        cur = conn.cursor()
+        self.ingest.begin(conn)
+        for ts, path, data, error in batch:
+            status = 'ok'
+            if data is None:
+                self.log.warning("Failed to parse %s (%s)" % (path, error))
+                status = 'failed'
+                self.failed += 1
+            else:
+                try:
+                    self.ingest.store(conn, data, path)
+                    self.documents += 1
+                except Exception, e:
+                    self.log.warning("Failed to load %s (%s)" % (path, e))
+                    status = 'failed'
+                    self.failed += 1
+            cur.execute("INSERT OR REPLACE INTO backfill_file (path, "
+                        "loaded_sec, status) VALUES (?,?,?)", (path, now, status))
+            self.files += 1
+        self.ingest.commit(conn)
+
+    def _report(self, started):
+        elapsed = max(time.time() - started, 0.001)
+        self.log.info("%d files (%d documents, %d failed) in %.1fs, "
+                      "%.1f files/s" % (self.files, self.documents, self.failed,
+                      elapsed, self.files / elapsed))
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options] /path/to/tracenv')
+    parser.add_option('-l', '--log-dir', default=None,
+                      help='directory with the archived documents '
+                           '[[monit] log_dir from trac.ini]')
+    parser.add_option('-j', '--processes', type='int', default=None,
+                      help='parser processes [number of CPUs]')
+    parser.add_option('-b', '--batch-size', type='int', default=1000,
+                      help='files per transaction [%default]')
+    parser.add_option('--partition', default=None,
+                      choices=['none'] + partition.schemes.keys(),
+                      help='partition scheme [[monit] partition from trac.ini]')
+    parser.add_option('-v', '--verbose', action='store_true', default=False)
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('the path of the Trac environment is required')
+    env_path = args[0]
+
+    logging.basicConfig(level=options.verbose and logging.DEBUG or logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+    log = logging.getLogger('monit-backfill')
+
+    config = ConfigParser()
+    config.read(joinpath(env_path, 'conf', 'trac.ini'))
+    def setting(name, default):
+        if config.has_option('monit', name):
+            return config.get('monit', name)
+        return default
+
+    log_dir = options.log_dir or joinpath(env_path, setting('log_dir', 'log/monit'))
+    db_path = joinpath(env_path, 'db', 'monit.db')
+    partitions = partition.from_env(env_path, log, options.partition)
+
+    Backfill(db_path, log, partitions, options.batch_size,
+             options.processes).run(log_dir)
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
+"""Standalone monit collector.
+
+Accepts the same POSTs as the /collector handler of the Trac plugin
+without going through Trac's request dispatch. All connections are
+served from a single event loop (asyncore with poll(), so the number
+of agents is not capped by select() or a worker pool), documents are
+handed to one writer thread which stores them in `monit.db` through
+`MonitIngest` and commits in batches. With `--spool` documents are
+appended to the durable spool instead (see spool.py), the agents are
+answered after one shared fsync() per pass of the event loop. Bodies
+may be MessagePack and gzip or deflate compressed (see wire.py), they
+are inflated while they arrive.
+
+Usage: monit-collectord [options] /path/to/tracenv
+"""
+
+import asynchat, asyncore, logging, os, socket, sys, threading
+from ConfigParser import ConfigParser
+from optparse import OptionParser
+from Queue import Queue, Empty
+from xml.dom import minidom
+
+import db, partition, wire
+from ingest import MonitIngest, save_invalid, save_xml
+from rules import RuleEngine, parse_rules
+
+joinpath = os.path.join
+
+responses = {
+    201: 'Created',
+    400: 'Bad Request',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    411: 'Length Required',
+    413: 'Request Entity Too Large',
+    415: 'Unsupported Media Type',
+}
+
+
+class Writer(threading.Thread):
+    """The only thread touching monit.db, stores queued documents and
+    commits once per batch."""
+
+    def __init__(self, path, log, batch_size=500, partitions=None, rules=None):
+        threading.Thread.__init__(self, name='monit-writer')
+        self.setDaemon(True)
+        self.path = path
+        self.log = log
+        self.batch_size = batch_size
+        self.queue = Queue()
+        self.ingest = MonitIngest(log, partitions, rules)
+
+    def put(self, data, remote_addr):
+        self.queue.put((data, remote_addr))
+
+    def run(self):
+        db.ensure_schema(self.path, self.log)
+        conn = db.connect(self.path, isolation_level=None)
+        while True:
+            batch = [self.queue.get()]
+            try:
+                while len(batch) < self.batch_size:
+                    batch.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            try:
+                self.ingest.begin(conn)
+                for data, remote_addr in batch:
+                    try:
+                        self.ingest.store(conn, data, remote_addr)
+                    except Exception, e:
+                        self.log.exception("Failed to store document from %s: %s"
+                                           % (remote_addr, e))
+                self.ingest.commit(conn)
+            except Exception, e:
+                # a locked or full database, drop the batch and go on
+                self.ingest.rollback(conn)
+                self.log.exception("Failed to store %d documents: %s" % (
+                                   len(batch), e))
+                continue
+            self.log.debug("Stored %d documents" % len(batch))
+
+
+class CollectorChannel(asynchat.async_chat):
+    """One agent connection, reads a single HTTP request."""
+
+    def __init__(self, server, sock, addr):
+        asynchat.async_chat.__init__(self, sock)
+        self.server = server
+        self.addr = addr
+        self.buffer = []
+        self.headers = None
+        self.decoder = None
+        self.error = None # status to answer once the body is read
+        self.set_terminator('\r\n\r\n')
+
+    def collect_incoming_data(self, data):
+        if self.decoder is None:
+            self.buffer.append(data)
+        elif self.error is None:
+            # asynchat still counts the body down, drop the rest on errors
+            try:
+                self.decoder.feed(data)
+            except wire.TooLarge:
+                self.error = 413
+            except wire.DecodeError:
+                self.error = 400
+
+    def found_terminator(self):
+        if self.headers is None:
+            data = ''.join(self.buffer)
+            self.buffer = []
+            self._parse_headers(data)
+        elif self.decoder is not None:
+            decoder, self.decoder = self.decoder, None
+            self.set_terminator(None)
+            if self.error:
+                return self.respond(self.error)
+            try:
+                data = decoder.finish()
+            except wire.TooLarge:
+                return self.respond(413)
+            except wire.DecodeError:
+                return self.respond(400)
+            self.server.handle_document(self, self.headers, data)
+
+    def _parse_headers(self, data):
+        lines = data.split('\r\n')
+        try:
+            self.method, self.path = lines[0].split()[:2]
+        except ValueError:
+            return self.respond(400)
+        self.headers = {}
+        for line in lines[1:]:
+            if ':' in line:
+                k, v = line.split(':', 1)
+                self.headers[k.strip().lower()] = v.strip()
+        if self.method != 'POST':
+            return self.respond(405)
+        if not self.path.startswith('/collector'):
+            return self.respond(404)
+        try:
+            length = int(self.headers['content-length'])
+        except (KeyError, ValueError):
+            return self.respond(411)
+        try:
+            self.decoder = wire.Decoder(self.headers.get('content-encoding'),
+                                        self.server.max_size)
+        except wire.Unsupported:
+            return self.respond(415)
+        if length > self.server.max_size:
+            return self.respond(413)
+        if length == 0:
+            return self.found_terminator()
+        self.set_terminator(length)
+
+    def respond(self, status):
+        self.decoder = None
+        self.set_terminator(None)
+        self.push('HTTP/1.0 %d %s\r\nContent-Type: text/plain\r\n'
+                  'Content-Length: 0\r\nConnection: close\r\n\r\n' % (
+                  status, responses.get(status, '')))
+        self.close_when_done()
+
+
+class CollectorServer(asyncore.dispatcher):
+
+    def __init__(self, address, writer, log_dir, log, max_size=wire.MAX_SIZE,
+                 spool=None):
+        asyncore.dispatcher.__init__(self)
+        self.writer = writer
+        self.spool = spool
+        self.pending = [] # channels waiting for the spool to be synced
+        self.log_dir = log_dir
+        self.log = log
+        self.max_size = max_size
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind(address)
+        self.listen(1024)
+
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            CollectorChannel(self, *pair)
+
+    def handle_document(self, channel, headers, body):
+        """same dispatch as MonitCollector.process_request"""
+        remote_addr = channel.addr[0]
+        ct = headers.get('content-type')
+        if ct in wire.content_types():
+            try:
+                data = wire.parse(body, ct)
+            except wire.DecodeError:
+                self.log.warning("Failed to parse data from %s" % remote_addr)
+                save_invalid(self.log_dir, ct, body, self.log)
+                return channel.respond(400)
+            if self.spool:
+                self.spool.append(remote_addr, body, sync=False,
+                                  content_type=ct)
+                self.pending.append(channel)
+                return
+            self.writer.put(data, remote_addr)
+            return channel.respond(201)
+        elif ct == 'text/xml':
+            try:
+                doc = minidom.parseString(body)
+                id = doc.getElementsByTagName('id')[0].childNodes[0].nodeValue
+            except Exception:
+                save_invalid(self.log_dir, ct, body, self.log)
+                return channel.respond(400)
+            save_xml(self.log_dir, id, doc.toxml(), self.log)
+            return channel.respond(201)
+        channel.respond(415)
+
+    def flush(self):
+        """acknowledge the documents spooled since the last call"""
+        if not self.pending:
+            return
+        self.spool.sync()
+        for channel in self.pending:
+            if channel.connected:
+                channel.respond(201)
+        self.pending = []
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options] /path/to/tracenv')
+    parser.add_option('-a', '--address', default='0.0.0.0',
+                      help='address to listen on [%default]')
+    parser.add_option('-p', '--port', type='int', default=8081,
+                      help='port to listen on [%default]')
+    parser.add_option('-l', '--log-dir', default=None,
+                      help='where raw XML and invalid documents are kept '
+                           '[<tracenv>/log/monit]')
+    parser.add_option('-b', '--batch-size', type='int', default=500,
+                      help='documents per transaction [%default]')
+    parser.add_option('--partition', default=None,
+                      choices=['none'] + partition.schemes.keys(),
+                      help='write history to per day or week files '
+                           '[[monit] partition from trac.ini]')
+    parser.add_option('--partition-keep', type='int', default=None,
+                      help='number of partitions to keep, 0 keeps all '
+                           '[[monit] partition_keep from trac.ini]')
+    parser.add_option('--spool', action='store_true', default=False,
+                      help='acknowledge documents once they are in the '
+                           'on-disk spool, store them from there')
+    parser.add_option('--segment-size', type='int', default=16,
+                      help='MB per spool segment [%default]')
+    parser.add_option('-v', '--verbose', action='store_true', default=False)
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('the path of the Trac environment is required')
+    env_path = args[0]
+
+    logging.basicConfig(level=options.verbose and logging.DEBUG or logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+    log = logging.getLogger('monit-collectord')
+
+    log_dir = options.log_dir or joinpath(env_path, 'log', 'monit')
+    if not os.path.isdir(log_dir):
+        os.makedirs(log_dir)
+
+    db_path = joinpath(env_path, 'db', 'monit.db')
+    partitions = partition.from_env(env_path, log, options.partition,
+                                    options.partition_keep)
+    rules = None
+    config = ConfigParser()
+    config.read(joinpath(env_path, 'conf', 'trac.ini'))
+    if config.has_section('monit-rules'):
+        try:
+            rules = RuleEngine(parse_rules(config.items('monit-rules')), log)
+        except ValueError, e:
+            parser.error(str(e))
+    spool = writer = None
+    if options.spool:
+        from spool import Applier, ApplierThread, Spool
+        spool = Spool(joinpath(env_path, 'db', 'monit-spool'), log,
+                      options.segment_size * 1024 * 1024)
+        ApplierThread(Applier(spool, db_path, log,
+                              MonitIngest(log, partitions, rules),
+                              options.batch_size), 1, log).start()
+    else:
+        writer = Writer(db_path, log, options.batch_size, partitions, rules)
+        writer.start()
+    server = CollectorServer((options.address, options.port), writer, log_dir,
+                             log, spool=spool)
+    log.info("Listening on %s:%d" % (options.address, options.port))
+    try:
+        while asyncore.socket_map:
+            asyncore.loop(timeout=30, use_poll=True, count=1)
+            server.flush()
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    sys.exit(main())
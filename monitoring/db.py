@@ -1,6 +1,8 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2008 Paul Klle (pkoelle@gmail.com)
 
+import os, threading
+
 try:
     import pysqlite2.dbapi2 as sqlite
     have_pysqlite = 2
@@ -67,14 +69,222 @@ class DbRowCursor(sqlite.Cursor):
         if self.description:
             self.row_factory = db_row.IMetaRow(self.description)
 
-def upgrade(cursor, from_version, to_version):
+def upgrade(cursor, from_version, to_version, tolerant=False):
+    """run the migrations, with `tolerant` tables and columns which
+    already exist are skipped"""
     for i in range(from_version, to_version):
         for stmt in updates[i]:
-            cursor.execute(stmt)
+            try:
+                cursor.execute(stmt)
+            except sqlite.OperationalError, e:
+                if not tolerant or ('already exists' not in str(e) and
+                                    'duplicate column' not in str(e)):
+                    raise
+
+def connect(path, timeout=10000, isolation_level=''):
+    """open the monit db at `path` with a DictConnection, with
+    `isolation_level` None the caller issues BEGIN itself"""
+    return sqlite.connect(path, timeout=timeout, factory=DictConnection,
+                          isolation_level=isolation_level)
+
+# path -> mtime of the file when its schema was last found current
+_checked = {}
+_checked_lock = threading.Lock()
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def ensure_schema(path, log):
+    """`init_schema` for the db at `path`, but only once per process and
+    again when the file was changed by someone else (its mtime moved)"""
+    mtime = _mtime(path)
+    if mtime is not None and _checked.get(path) == mtime:
+        return
+    _checked_lock.acquire()
+    try:
+        if mtime is None or _checked.get(path) != _mtime(path):
+            conn = connect(path)
+            try:
+                init_schema(conn, log)
+            finally:
+                conn.close()
+            _checked[path] = _mtime(path)
+    finally:
+        _checked_lock.release()
+
+def init_schema(conn, log):
+    """create the tables or run pending upgrades"""
+    cur = conn.cursor()
+    cur.execute("PRAGMA user_version")
+    if cur.fetchone()['user_version'] == db_version:
+        return
+    try:
+        # rows of clients added after an upgrade carry the column default
+        # 1, the highest version is the one the schema was upgraded to
+        cur.execute("SELECT MAX(db_version) AS db_version FROM monit")
+        current = cur.fetchone()['db_version']
+        if current is None:
+            # no monit row carries the version (partition files, a monit.db
+            # no client posted to yet), user_version does
+            cur.execute("PRAGMA user_version")
+            current = cur.fetchone()['user_version']
+        tolerant = False
+        if not current or current <= unversioned:
+            # written before user_version was set, somewhere between
+            # `unversioned` and 6. Files created by the original plugin
+            # have their clients at version 1 and the schema at 3.
+            current, tolerant = current or unversioned, True
+        if current != db_version:
+            log.debug("MonitDB version from db is '%s', current version is '%s'" % (current, db_version))
+            try:
+                upgrade(cur, current, db_version, tolerant)
+                cur.execute("UPDATE monit SET db_version=?", (db_version,))
+                cur.execute("PRAGMA user_version = %d" % db_version)
+            except sqlite.OperationalError, e:
+                log.warning("Database upgrade from verion %s to version %s failed (%s)" % (
+                                current, db_version, e))
+    except sqlite.OperationalError, e:
+        log.debug("Error fetching db_version %s" % e)
+        #the monit table does not exist, create tables from scratch
+        for stmt in tables:
+            cur.execute(stmt)
+        upgrade(cur, 1, db_version) #run all upgrades
+        cur.execute("PRAGMA user_version = %d" % db_version)
+    conn.commit()
+
+
+# string columns of the history tables kept once in `strings`. The rows
+# are stored in `<table>_data` with integer `<column>_id` keys, `<table>`
+# is a view joining the strings back in for readers (see ingest.py)
+interned = {
+    'system_service': ('name', 'groupname', 'status_message'),
+    'process_service': ('name', 'groupname', 'status_message'),
+    'directory_service': ('name', 'groupname', 'status_message'),
+    'file_service': ('name', 'groupname', 'status_message'),
+    'filesystem_service': ('name', 'groupname', 'status_message'),
+    'host_service': ('name', 'groupname', 'status_message'),
+    'event': ('message', 'groupname'),
+}
+
+_service_columns = [
+    "id INTEGER PRIMARY KEY",
+    "monit_id INTEGER NOT NULL",
+    "status INTEGER NOT NULL",
+    "monitormode INTEGER NOT NULL",
+    "monitor INTEGER NOT NULL",
+    "collected_sec INTEGER NOT NULL",
+    "name VARCHAR(255) NOT NULL",
+    "groupname VARCHAR(255)",
+    "status_message VARCHAR(255)",
+    "pendingaction INTEGER",
+    "type INTEGER",
+]
 
+# the interned tables as of version 9
+history_columns = {
+    'system_service': _service_columns + [
+        "load_avg01 REAL DEFAULT 0",
+        "load_avg05 REAL DEFAULT 0",
+        "load_avg15 REAL DEFAULT 0",
+        "cpu_wait REAL DEFAULT 0",
+        "cpu_user REAL DEFAULT 0",
+        "cpu_system REAL DEFAULT 0",
+        "memory_kilobyte REAL DEFAULT 0",
+        "memory_percent REAL DEFAULT 0"],
+    'process_service': _service_columns + [
+        "uptime INTEGER",
+        "pid INTEGER NOT NULL",
+        "ppid INTEGER",
+        "children INTEGER",
+        "cpu_percent REAL",
+        "cpu_percenttotal REAL",
+        "memory_kilobyte REAL",
+        "memory_kilobytetotal REAL",
+        "memory_percent REAL",
+        "memory_percenttotal REAL"],
+    'directory_service': _service_columns + [
+        "timestamp INTEGER",
+        "mode INTEGER",
+        "gid INTEGER",
+        "uid INTEGER"],
+    'file_service': _service_columns + [
+        "timestamp INTEGER",
+        "size INTEGER",
+        "mode INTEGER",
+        "gid INTEGER",
+        "uid INTEGER"],
+    'filesystem_service': _service_columns + [
+        "mode INTEGER",
+        "gid INTEGER",
+        "uid INTEGER",
+        "flags INTEGER",
+        "block_percent REAL NOT NULL",
+        "block_usage REAL NOT NULL",
+        "block_total REAL NOT NULL",
+        "inode_percent REAL",
+        "inode_usage REAL",
+        "inode_total REAL"],
+    'host_service': _service_columns,
+    'event': [
+        "id INTEGER PRIMARY KEY",
+        "service_id INTEGER NOT NULL",
+        "type INTEGER NOT NULL",
+        "collected_sec INTEGER NOT NULL",
+        "state INTEGER",
+        "action INTEGER",
+        "message VARCHAR(255) NOT NULL",
+        "groupname VARCHAR(255)",
+        "rule VARCHAR(255)"],
+}
+
+def intern_table(table, columns):
+    """statements moving the rows of `table` to `<table>_data` with the
+    `interned` columns replaced by keys into `strings`, `table` becomes
+    a view with the original columns"""
+    strings = interned[table]
+    ddl, names, keys = [], [], []
+    for column in columns:
+        name = column.split()[0]
+        if name in strings:
+            ddl.append('%s_id INTEGER%s' % (name, ' NOT NULL' in column
+                                             and ' NOT NULL' or ''))
+            keys.append('%s_id' % name)
+            names.append('(SELECT id FROM strings WHERE value=%s)' % name)
+        else:
+            ddl.append(column)
+            keys.append(name)
+            names.append(name)
+    return ["CREATE TABLE %s_data (%s)" % (table, ', '.join(ddl))] + \
+        ["INSERT OR IGNORE INTO strings (value) SELECT %s FROM %s "
+         "WHERE %s IS NOT NULL" % (name, table, name) for name in strings] + [
+        "INSERT INTO %s_data (%s) SELECT %s FROM %s" % (
+            table, ', '.join(keys), ', '.join(names), table),
+        "DROP TABLE %s" % table,
+        intern_view(table, columns),
+    ]
+
+def intern_view(table, columns):
+    """the view over `<table>_data` restoring the `interned` columns"""
+    view, joins = [], []
+    for column in columns:
+        name = column.split()[0]
+        if name in interned[table]:
+            view.append('s_%s.value AS %s' % (name, name))
+            joins.append(' LEFT JOIN strings s_%s ON s_%s.id = d.%s_id' % (
+                         name, name, name))
+        else:
+            view.append('d.%s AS %s' % (name, name))
+    return "CREATE VIEW %s AS SELECT %s FROM %s_data d%s" % (
+        table, ', '.join(view), table, ''.join(joins))
 
 # increment for schema changes   
-db_version = 3
+db_version = 13
+
+# the version of files without a monit row and user_version
+unversioned = 3
 
 # populate with DDL statements for migrations between 
 # versions e.g. from version 0 upwards 0: ["ALTER TABLE foo ...,]"
@@ -94,6 +304,119 @@ updates = {
     "ALTER TABLE host_service ADD COLUMN type INTEGER",
     "ALTER TABLE host_service ADD COLUMN status_message VARCHAR(255)",
  ],
+ 3: [
+    # rollups for the fleet overview, maintained at ingest (see overview.py)
+    """CREATE TABLE overview_service (
+        monit_id INTEGER NOT NULL,
+        type INTEGER NOT NULL,
+        name VARCHAR(255) NOT NULL,
+        groupname VARCHAR(255) NOT NULL DEFAULT '',
+        status INTEGER NOT NULL,
+        status_class VARCHAR(16) NOT NULL,
+        status_message VARCHAR(255),
+        collected_sec INTEGER NOT NULL,
+        cpu_percent REAL,
+        memory_percent REAL,
+        block_percent REAL,
+        PRIMARY KEY (monit_id, type, name))""",
+    "CREATE INDEX overview_service_cpu ON overview_service (type, cpu_percent)",
+    "CREATE INDEX overview_service_mem ON overview_service (type, memory_percent)",
+    "CREATE INDEX overview_service_block ON overview_service (type, block_percent)",
+    """CREATE TABLE overview_count (
+        monit_id INTEGER NOT NULL,
+        groupname VARCHAR(255) NOT NULL DEFAULT '',
+        status_class VARCHAR(16) NOT NULL,
+        count INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (monit_id, groupname, status_class))""",
+ ],
+ 4: [
+    # catalog of time partitions (see partition.py)
+    """CREATE TABLE monit_partition (
+        name VARCHAR(32) PRIMARY KEY,
+        start_sec INTEGER NOT NULL,
+        end_sec INTEGER NOT NULL)""",
+ ],
+ 5: [
+    # files loaded by monit-backfill (see backfill.py)
+    """CREATE TABLE backfill_file (
+        path VARCHAR(1024) PRIMARY KEY,
+        loaded_sec INTEGER NOT NULL,
+        status VARCHAR(16) NOT NULL)""",
+ ],
+ 6: [
+    # events raised by the rules in [monit-rules] (see rules.py)
+    "ALTER TABLE event ADD COLUMN rule VARCHAR(255)",
+    """CREATE TABLE rule_state (
+        rule VARCHAR(255) NOT NULL,
+        monit_id INTEGER NOT NULL,
+        type INTEGER NOT NULL,
+        name VARCHAR(255) NOT NULL,
+        active INTEGER NOT NULL,
+        changed_sec INTEGER NOT NULL,
+        PRIMARY KEY (rule, monit_id, type, name))""",
+ ],
+ 7: [
+    # position of the spool applier (see spool.py)
+    """CREATE TABLE spool_state (
+        name VARCHAR(32) PRIMARY KEY,
+        segment INTEGER NOT NULL,
+        offset INTEGER NOT NULL)""",
+ ],
+ 8: [
+    # hourly response time sketches of host checks (see latency.py)
+    """CREATE TABLE response_sketch (
+        monit_id INTEGER NOT NULL,
+        name VARCHAR(255) NOT NULL,
+        kind VARCHAR(8) NOT NULL,
+        target VARCHAR(255) NOT NULL,
+        bucket_sec INTEGER NOT NULL,
+        zero INTEGER NOT NULL,
+        count INTEGER NOT NULL,
+        sum REAL NOT NULL,
+        min REAL,
+        max REAL,
+        bins TEXT NOT NULL,
+        PRIMARY KEY (monit_id, name, kind, target, bucket_sec))""",
+    "CREATE INDEX response_sketch_bucket ON response_sketch (bucket_sec)",
+ ],
+ 9: ["CREATE TABLE strings (id INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE)"]
+    + intern_table('system_service', history_columns['system_service'])
+    + intern_table('process_service', history_columns['process_service'])
+    + intern_table('directory_service', history_columns['directory_service'])
+    + intern_table('file_service', history_columns['file_service'])
+    + intern_table('filesystem_service', history_columns['filesystem_service'])
+    + intern_table('host_service', history_columns['host_service'])
+    + intern_table('event', history_columns['event']),
+ 10: [
+    # repeated events are counted in the first one (see ingest.py)
+    "ALTER TABLE event_data ADD COLUMN last_sec INTEGER",
+    "ALTER TABLE event_data ADD COLUMN count INTEGER NOT NULL DEFAULT 1",
+    "UPDATE event_data SET last_sec = collected_sec",
+    "DROP VIEW event",
+    intern_view('event', history_columns['event'] + [
+        "last_sec INTEGER", "count INTEGER NOT NULL DEFAULT 1"]),
+    """CREATE TABLE event_latest (
+        type INTEGER NOT NULL,
+        name_id INTEGER NOT NULL,
+        event_id INTEGER NOT NULL,
+        PRIMARY KEY (type, name_id))""",
+ ],
+ 11: [
+    # services of different clients share names, an episode belongs to
+    # one client. Events before the upgrade are not counted anymore.
+    "DROP TABLE event_latest",
+    """CREATE TABLE event_latest (
+        monit_id INTEGER NOT NULL,
+        type INTEGER NOT NULL,
+        name_id INTEGER NOT NULL,
+        event_id INTEGER NOT NULL,
+        PRIMARY KEY (monit_id, type, name_id))""",
+ ],
+ 12: [
+    # time of the newest document of a client, older ones (backfill)
+    # must not overwrite its row (see ingest.py)
+    "ALTER TABLE monit ADD COLUMN collected_sec INTEGER",
+ ],
  }
  
 tables = [
@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
+"""Streaming export of monit history.
+
+Rows are read in chunks with keyset pagination (`id > last id ORDER BY
+id LIMIT n`): every chunk is a short statement of its own, so the export
+never holds a read lock long enough to block the collector, and memory
+use is bounded by the chunk size whatever the size of the table.
+Chunks are written as CSV or, if pyarrow is installed, as Arrow IPC
+stream or Parquet row groups.
+"""
+
+import csv, logging, os, sys, time
+from optparse import OptionParser
+from StringIO import StringIO
+
+import db, partition
+from db import sqlite
+from ingest import srv_types
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+    have_arrow = True
+except ImportError:
+    have_arrow = False
+
+joinpath = os.path.join
+
+tables = ['%s_service' % v for v in srv_types.values()] + ['event']
+
+content_types = {
+    'csv': 'text/csv',
+    'arrow': 'application/vnd.apache.arrow.stream',
+    'parquet': 'application/octet-stream',
+}
+
+def formats():
+    """the export formats available here"""
+    if have_arrow:
+        return ['csv', 'arrow', 'parquet']
+    return ['csv']
+
+def parse_time(value):
+    """seconds since the epoch or a YYYY-MM-DD date (UTC)"""
+    if not value:
+        return None
+    try:
+        return int(value)
+    except ValueError:
+        import calendar
+        return calendar.timegm(time.strptime(value, '%Y-%m-%d'))
+
+
+class Export(object):
+    """Rows of one history table matching the filters, in chunks"""
+
+    def __init__(self, conn, table, host=None, service=None, start=None,
+                 stop=None, chunk=5000, partitions=None):
+        if table not in tables:
+            raise ValueError("Unknown table '%s'" % table)
+        self.conn = conn
+        self.table = table
+        self.host = host
+        self.service = service
+        self.start = start
+        self.stop = stop
+        self.chunk = chunk
+        self.partitions = partitions
+        cur = conn.cursor()
+        cur.execute("PRAGMA table_info(%s)" % table)
+        self.columns = [(r['name'], r['type'].upper()) for r in cur.fetchall()]
+        if not self.columns:
+            raise ValueError("No table '%s' in the monit database" % table)
+
+    def chunks(self):
+        """Yield lists of row tuples, in the order of `columns`"""
+        monit_ids = None
+        if self.host:
+            cur = self.conn.cursor()
+            cur.execute("SELECT id FROM monit WHERE localhostname=?", (self.host,))
+            monit_ids = [r['id'] for r in cur.fetchall()]
+            if not monit_ids:
+                return
+        if self.partitions:
+            prefixes = self.partitions.iter_range(self.conn, self.start or 0,
+                                                  self.stop or sys.maxint)
+        else:
+            prefixes = ['']
+        for prefix in prefixes:
+            # partitions not written to since an upgrade lack new columns
+            cur = self.conn.cursor()
+            cur.execute("PRAGMA %stable_info(%s)" % (prefix, self.table))
+            present = set([r['name'] for r in cur.fetchall()])
+            select = [c[0] in present and c[0] or 'NULL' for c in self.columns]
+            where, args = self._where(prefix, monit_ids)
+            if where is None:
+                continue
+            sql = "SELECT %s FROM %s%s WHERE id > ?%s ORDER BY id LIMIT ?" % (
+                  ','.join(select), prefix, self.table, where)
+            last = -1
+            while True:
+                # a plain cursor, tuples are all we need
+                cur = sqlite.Cursor(self.conn)
+                cur.execute(sql, (last,) + args + (self.chunk,))
+                rows = cur.fetchall()
+                cur.close()
+                if not rows:
+                    break
+                yield rows
+                last = rows[-1][0]
+                if len(rows) < self.chunk:
+                    break
+
+    def _where(self, prefix, monit_ids):
+        """the conditions of the filters and their arguments, `where` is
+        None if no row of the schema can match"""
+        where, args = '', ()
+        if self.start is not None:
+            where += ' AND collected_sec >= ?'
+            args += (self.start,)
+        if self.stop is not None:
+            where += ' AND collected_sec <= ?'
+            args += (self.stop,)
+        if self.table != 'event':
+            if monit_ids:
+                where += ' AND monit_id IN (%s)' % ','.join(['?']*len(monit_ids))
+                args += tuple(monit_ids)
+            if self.service:
+                where += ' AND name=?'
+                args += (self.service,)
+        elif monit_ids or self.service:
+            # events only know their service, look the services up once
+            # instead of in every chunk
+            subs = []
+            for srv_type, srv_name in srv_types.items():
+                sql = "SELECT id FROM %s%s_service WHERE 1=1" % (prefix, srv_name)
+                sql_args = ()
+                if monit_ids:
+                    sql += ' AND monit_id IN (%s)' % ','.join(['?']*len(monit_ids))
+                    sql_args += tuple(monit_ids)
+                if self.service:
+                    sql += ' AND name=?'
+                    sql_args += (self.service,)
+                cur = self.conn.cursor()
+                cur.execute(sql, sql_args)
+                ids = [r['id'] for r in cur.fetchall()]
+                if ids:
+                    # integers from the database, inlined to stay below
+                    # the limit of SQL variables
+                    subs.append('(type=%d AND service_id IN (%s))' % (
+                                srv_type, ','.join([str(int(i)) for i in ids])))
+            if not subs:
+                return None, ()
+            where += ' AND (%s)' % ' OR '.join(subs)
+        return where, args
+
+    # writers, each yields the serialised chunks
+
+    def csv(self):
+        buf = StringIO()
+        writer = csv.writer(buf)
+        writer.writerow([c[0] for c in self.columns])
+        for rows in self.chunks():
+            writer.writerows([[isinstance(v, unicode) and v.encode('utf-8') or v
+                               for v in row] for row in rows])
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+        if buf.getvalue():
+            yield buf.getvalue()
+
+    def arrow(self):
+        sink = _Sink()
+        writer = pyarrow.RecordBatchStreamWriter(sink, self._schema())
+        for rows in self.chunks():
+            writer.write_batch(self._batch(rows))
+            yield sink.take()
+        writer.close()
+        yield sink.take()
+
+    def parquet(self):
+        sink = _Sink()
+        writer = pyarrow.parquet.ParquetWriter(sink, self._schema())
+        for rows in self.chunks():
+            writer.write_table(pyarrow.Table.from_batches([self._batch(rows)]))
+            yield sink.take()
+        writer.close()
+        yield sink.take()
+
+    def _schema(self):
+        fields = []
+        for name, sqltype in self.columns:
+            if 'INT' in sqltype:
+                t = pyarrow.int64()
+            elif 'REAL' in sqltype:
+                t = pyarrow.float64()
+            else:
+                t = pyarrow.string()
+            fields.append(pyarrow.field(name, t))
+        return pyarrow.schema(fields)
+
+    def _batch(self, rows):
+        schema = self._schema()
+        arrays = [pyarrow.array([r[i] for r in rows], type=schema[i].type)
+                  for i in range(len(self.columns))]
+        return pyarrow.RecordBatch.from_arrays(arrays, schema=schema)
+
+
+class _Sink(object):
+    """file-like object collecting what the pyarrow writers produce"""
+
+    closed = False
+
+    def __init__(self):
+        self._parts = []
+        self._pos = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self._parts.append(data)
+        self._pos += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._pos
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def take(self):
+        data = ''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options] /path/to/tracenv table\n\n'
+                          'tables: ' + ', '.join(tables))
+    parser.add_option('-o', '--output', default='-',
+                      help='output file [stdout]')
+    parser.add_option('-f', '--format', default='csv', choices=formats(),
+                      help='one of %s [%%default]' % ', '.join(formats()))
+    parser.add_option('--host', default=None, help='monit localhostname')
+    parser.add_option('--service', default=None, help='service name')
+    parser.add_option('--from', dest='start', default=None,
+                      help='YYYY-MM-DD or seconds since the epoch')
+    parser.add_option('--to', dest='stop', default=None,
+                      help='YYYY-MM-DD or seconds since the epoch')
+    parser.add_option('-c', '--chunk', type='int', default=5000,
+                      help='rows per chunk [%default]')
+    options, args = parser.parse_args(args)
+    if len(args) != 2:
+        parser.error('the Trac environment and a table are required')
+    env_path, table = args
+
+    logging.basicConfig(format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+    log = logging.getLogger('monit-export')
+
+    db_path = joinpath(env_path, 'db', 'monit.db')
+    partitions = partition.from_env(env_path, log)
+
+    conn = db.connect(db_path)
+    try:
+        export = Export(conn, table, options.host, options.service,
+                        parse_time(options.start), parse_time(options.stop),
+                        options.chunk, partitions)
+    except ValueError, e:
+        parser.error(str(e))
+    out = options.output == '-' and sys.stdout or open(options.output, 'wb')
+    try:
+        for data in getattr(export, options.format)():
+            out.write(data)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        conn.close()
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,444 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
+"""Mapping of monit status documents onto the tables in db.py.
+
+A flapping service makes monit repeat the same event on every poll. An
+event with the state and message of the previous event of its service
+is not stored again, the previous row counts it instead (`count`, last
+seen in `last_sec`, first seen is `collected_sec`). `event_latest`
+points to the last event of every service of a client in each schema.
+Events older than that one (backfilled) are stored on their own.
+
+It is shared by `MonitCollector` and the standalone collectors in
+collectord.py, spool.py and backfill.py.
+"""
+
+import os, time
+from types import ListType, DictType
+from xml.dom import Node
+
+import db, latency, overview
+
+joinpath = os.path.join
+
+srv_types = {
+    0:'filesystem',
+    1:'directory',
+    2:'file',
+    3:'process',
+    4:'host',
+    5:'system'}
+
+class StringCache(object):
+    """Ids of the values interned in the `strings` table of monit.db and
+    of each partition.
+
+    A value interned by a transaction is only known to its connection
+    until `commit()`, a rolled back id may be handed out again for a
+    different value. `discard()` forgets the values of a document rolled
+    back to its savepoint.
+    """
+
+    max_size = 100000 # values per schema before the cache starts over
+
+    def __init__(self):
+        self._ids = {} # schema prefix -> {value: id}
+        self._pending = {} # connection -> {(prefix, value): id}
+        self._document = {} # connection -> keys of _pending since the savepoint
+
+    def intern(self, cur, prefix, value):
+        """the id of `value` in the `strings` of schema `prefix`"""
+        if value is None:
+            return None
+        ids = self._ids.get(prefix)
+        if ids is None:
+            ids = self._ids[prefix] = {}
+        id = ids.get(value)
+        if id is not None:
+            return id
+        pending = self._pending.setdefault(cur.connection, {})
+        id = pending.get((prefix, value))
+        if id is not None:
+            return id
+        cur.execute("SELECT id FROM %sstrings WHERE value=?" % prefix, (value,))
+        row = cur.fetchone()
+        if row:
+            if len(ids) >= self.max_size:
+                ids.clear()
+            id = ids[value] = row['id']
+        else:
+            cur.execute("INSERT INTO %sstrings (value) VALUES (?)" % prefix,
+                        (value,))
+            id = pending[(prefix, value)] = cur.lastrowid
+            self._document.setdefault(cur.connection, []).append((prefix, value))
+        return id
+
+    def release(self, conn):
+        """the document was stored, its values stay pending"""
+        self._document.pop(conn, None)
+
+    def discard(self, conn):
+        pending = self._pending.get(conn, {})
+        for key in self._document.pop(conn, ()):
+            pending.pop(key, None)
+
+    def commit(self, conn):
+        self._document.pop(conn, None)
+        for (prefix, value), id in self._pending.pop(conn, {}).items():
+            self._ids.setdefault(prefix, {})[value] = id
+
+    def rollback(self, conn):
+        self._document.pop(conn, None)
+        self._pending.pop(conn, None)
+
+    def forget(self, name):
+        """drop the ids of a partition which was deleted"""
+        self._ids.pop(name + '.', None)
+
+
+class MonitIngest(object):
+    """Store parsed monit documents, the caller owns the transaction: it
+    opens the connection with `db.connect(path, isolation_level=None)`,
+    starts with `begin()` and ends with `commit()` or `rollback()`. Each
+    document is written below a savepoint, one that fails leaves nothing
+    behind and the others of the transaction can still be committed."""
+
+    def __init__(self, log, partitions=None, rules=None):
+        """@param partitions, a partition.Partitions instance if history
+           is written to time partitions
+           @param rules, a rules.RuleEngine checking every sample"""
+        self.log = log
+        self.partitions = partitions
+        self.rules = rules
+        self.strings = StringCache()
+        if partitions is not None:
+            partitions.on_expire.append(self.strings.forget)
+        self._columns = {} # table -> set of column names
+
+    def begin(self, conn):
+        conn.execute("BEGIN")
+
+    def commit(self, conn):
+        conn.commit()
+        self.strings.commit(conn)
+        if self.rules:
+            self.rules.commit(conn)
+        if self.partitions is not None:
+            self.partitions.release(conn)
+
+    def rollback(self, conn):
+        conn.rollback()
+        self.strings.rollback(conn)
+        if self.rules:
+            self.rules.rollback(conn)
+        if self.partitions is not None:
+            self.partitions.release(conn)
+
+    def store(self, conn, data, remote_addr=None):
+        """Store one decoded JSON document, returns the monit id. Raises
+        the error of a failed document after rolling it back."""
+        cur = conn.cursor()
+        stamps = self._timestamps(data)
+        if self.partitions is not None:
+            # ATTACH must not come between the writes of the document
+            self.partitions.prepare(conn, stamps)
+        cur.execute("SAVEPOINT document")
+        try:
+            monit_id = self._store(cur, data, stamps, remote_addr)
+        except Exception:
+            cur.execute("ROLLBACK TO document")
+            cur.execute("RELEASE document")
+            self.strings.discard(conn)
+            if self.rules:
+                self.rules.rollback(conn)
+            raise
+        cur.execute("RELEASE document")
+        self.strings.release(conn)
+        return monit_id
+
+    def _store(self, cur, data, stamps, remote_addr):
+        monit_id = self._store_client(cur, data, stamps and max(stamps))
+
+        #check for service reports
+        for s in data.get('servicelist', []):
+            s_type =  s.get('type', None)
+            if s_type != None and s_type in srv_types:
+                self._process_services(cur, monit_id, s_type, s)
+            else:
+                self.log.warning("Unknown service type %s from client %s (%s)" % (
+                                    str(s_type), remote_addr, str(s)))
+
+        #events need to come after services as they are linked to a service
+        evt = data.get('event', {})
+        if evt:
+            self._process_event(cur, monit_id, evt)
+        return monit_id
+
+    def _timestamps(self, data):
+        """collected_sec of the history rows `data` will write"""
+        stamps = set([s['collected_sec'] for s in data.get('servicelist', [])
+                      if s.get('monitor') and s.get('type') in srv_types])
+        if data.get('event'):
+            stamps.add(data['event']['collected_sec'])
+        return stamps
+
+    def _store_client(self, cur, data, collected_sec=None):
+        #sanitize the 'monit' section
+        raw = data.get('monit', {}).get('server', {})
+        client_info = dict([(k,v) for k,v in raw.items()
+                            if type(v) not in [ListType, DictType]])
+        client_info.update(dict([('platform_'+k,v) \
+                            for k,v in raw.get('platform', {}).items()]))
+        client_info.update(raw.get('httpd', {}))
+        client_info['monitid'] = client_info['id']; del client_info['id']
+        if collected_sec:
+            client_info['collected_sec'] = collected_sec
+
+        #get the id of the monit instance we're operating on
+        self.log.debug("query DB for monit client entry with id: %s" % client_info['monitid'])
+        cur.execute("SELECT id, collected_sec from monit WHERE monitid =?",
+                    (client_info['monitid'],))
+        res = cur.fetchone()
+
+        if not res:
+            self.log.debug("Inserting into monit table: id %s with values %s" % (
+                            client_info['monitid'], str(client_info)))
+            # new rows must not look like they need the upgrades in db.py
+            client_info['db_version'] = db.db_version
+            self._insert(cur, '', 'monit', client_info)
+            return cur.lastrowid
+        if collected_sec and collected_sec < res['collected_sec']:
+            # backfilled, the row describes a newer document
+            return res['id']
+        self.log.debug("Updating monit entry with id %s" % client_info['monitid'])
+        cur.dict_update('monit', self._known(cur, 'monit', client_info),
+                        {'monitid':client_info['monitid']})
+        return res['id']
+
+    def _known(self, cur, table, values):
+        """drop the keys of `values` which are not a column of `table`,
+        agents and older archives send fields we have no use for"""
+        cols = self._columns.get(table)
+        if cols is None:
+            cur.execute("PRAGMA table_info(%s)" % table)
+            cols = self._columns[table] = set([r['name'] for r in cur.fetchall()])
+        unknown = [k for k in values.keys() if k not in cols]
+        if unknown:
+            self.log.debug("Ignoring unknown fields %s for table %s" % (unknown, table))
+            values = dict([(k,v) for k,v in values.items() if k in cols])
+        return values
+
+    def _insert(self, cur, prefix, table, values):
+        values = self._known(cur, table, values)
+        if table in db.interned:
+            values = dict(values)
+            for column in db.interned[table]:
+                if column in values:
+                    values[column + '_id'] = self.strings.intern(cur, prefix,
+                                                    values.pop(column))
+            table += '_data'
+        cur.dict_insert(prefix+table, values)
+
+    def _prefix(self, cur, ts):
+        """table prefix for history rows collected at `ts`"""
+        if self.partitions is None:
+            return ''
+        return self.partitions.prefix(cur.connection, ts)
+
+    def _process_event(self, cur, monit_id, evt):
+        prefix = self._prefix(cur, evt['collected_sec'])
+        table = prefix+srv_types[evt['type']]+'_service_data'
+        self.log.debug("Updating event table with %s" % str(evt))
+        cur.execute("SELECT id from %s WHERE monit_id=? AND name_id=(SELECT id "
+                    "FROM %sstrings WHERE value=?)" % (table, prefix),
+                    (monit_id, evt['service']))
+        res = cur.fetchone()
+
+        if not res:
+            self.log.warning("No service with name %s found during event processing (%s)"  % (
+                                evt['service'], evt['message']))
+            return
+        evt = dict(evt)
+        evt['service_id'] = res.get('id')
+        evt['groupname'] = evt.pop('group', None)
+        evt['last_sec'] = evt['collected_sec']
+        evt.pop('collected_usec', None) #who cares
+        evt.pop('id', None)
+
+        # coalesce repeated events of the service
+        name_id = self.strings.intern(cur, prefix, evt.pop('service'))
+        message_id = self.strings.intern(cur, prefix, evt.get('message'))
+        cur.execute("SELECT e.id, e.state, e.message_id, e.last_sec FROM "
+                    "%sevent_latest l "
+                    "JOIN %sevent_data e ON e.id = l.event_id WHERE "
+                    "l.monit_id=? AND l.type=? AND l.name_id=?" % (prefix, prefix),
+                    (monit_id, evt['type'], name_id))
+        last = cur.fetchone()
+        if last and evt['collected_sec'] < last['last_sec']:
+            # backfilled, older than the current episode
+            self._insert(cur, prefix, 'event', evt)
+            return
+        if last and last['state'] == evt.get('state') and \
+                last['message_id'] == message_id:
+            cur.execute("UPDATE %sevent_data SET count = count + 1, last_sec = "
+                        "MAX(last_sec, ?) WHERE id=?" % prefix,
+                        (evt['collected_sec'], last['id']))
+            return
+        self._insert(cur, prefix, 'event', evt)
+        cur.execute("INSERT OR REPLACE INTO %sevent_latest (monit_id, type, "
+                    "name_id, event_id) VALUES (?,?,?,?)" % prefix,
+                    (monit_id, evt['type'], name_id, cur.lastrowid))
+
+    def _process_services(self, cur, monit_id, service_type, service_data):
+        """@param service_type, integer, lookup table is srv_types
+           @param service_data, dictionary"""
+
+        #don't handle unmonitored services for now
+        if not service_data.get('monitor', None):
+            return
+
+        srv_name = srv_types[service_type]
+        prefix = self._prefix(cur, service_data['collected_sec'])
+        table = "%s_service" % srv_name
+
+        values = dict([(k,v) for k,v in service_data.items()
+                            if type(v) not in [ListType, DictType]])
+        values.pop('collected_usec', None) #useless...
+        values['monit_id'] = monit_id
+        values['groupname'] = values.pop('group', None) # group is a sql kw
+
+        self.log.debug("Updating service table for service type '%s' with %s" % (srv_name, str(service_data)))
+        #ugly...
+        if srv_name == 'system':
+            values.update(dict([('load_'+k,v) for k,v in \
+                            service_data['system']['load'].items()]))
+            values.update(dict([('cpu_'+k, v) for k,v in \
+                            service_data['system']['cpu'].items()]))
+            values.update(dict([('memory_'+k, v) for k,v in \
+                            service_data['system']['memory'].items()]))
+            self._insert(cur, prefix, table, values)
+            service_id = cur.lastrowid
+
+        elif srv_name == 'host':
+            portlist = service_data.get('portlist', [])
+            icmplist = service_data.get('icmplist', [])
+
+            self._insert(cur, prefix, table, values)
+            service_id = host_id = cur.lastrowid
+            for e in portlist:
+                e = dict(e, host_id=host_id)
+                self._insert(cur, prefix, 'host_port', e)
+            for e in icmplist:
+                e = dict(e, host_id=host_id)
+                self._insert(cur, prefix, 'host_icmp', e)
+            latency.update_host(cur, monit_id, values['name'],
+                                values['collected_sec'], portlist, icmplist)
+
+        elif srv_name == 'process':
+            values.update(dict([('cpu_'+k, v) for k,v in \
+                            service_data['cpu'].items()]))
+            values.update(dict([('memory_'+k, v) for k,v in \
+                            service_data['memory'].items()]))
+            self._insert(cur, prefix, table, values)
+            service_id = cur.lastrowid
+
+        elif srv_name == 'filesystem':
+            values.update(dict([('block_'+k,v) for k,v in \
+                            service_data['block'].items()]))
+            if service_data.get('inode', None): # sometimes missing
+                values.update(dict([('inode_'+k,v) for k,v in \
+                            service_data['inode'].items()]))
+            self._insert(cur, prefix, table, values)
+            service_id = cur.lastrowid
+
+        else: # file and directory
+            self._insert(cur, prefix, table, values)
+            service_id = cur.lastrowid
+
+        overview.update_service(cur, monit_id, service_type, values)
+        if self.rules:
+            for evt in self.rules.evaluate(cur, monit_id, service_type,
+                                           service_id, values):
+                self._insert(cur, prefix, 'event', evt)
+
+
+def save_xml(log_dir, monitid, xml, log):
+    """Archive a raw XML document below log_dir/<monitid>/"""
+    # id is in $HOME/.monit.id and will be (re)generated if missing
+    # watch out if you're syncing $HOMEs
+    savepath = joinpath(log_dir, monitid)
+    if not os.path.isdir(savepath):
+        log.debug("MONIT collector: creating %s from id: %s and log: %s" % (savepath, monitid, log_dir))
+        os.mkdir(savepath)
+    fp = open(joinpath(savepath, str(int(time.time())) + '.xml'), 'w')
+    fp.write(xml); fp.close()
+
+def save_invalid(log_dir, contenttype, raw, log):
+    """Keep a document we could not parse in log_dir/invalid/"""
+    suffix = contenttype.split('/')[-1]
+    log.warning("The data will be saved in %s/invalid for review." % log_dir)
+    if not os.path.isdir(joinpath(log_dir, 'invalid')):
+        os.mkdir(joinpath(log_dir, 'invalid'))
+    fp = open(joinpath(log_dir, 'invalid', str(int(time.time()))+'.'+suffix ), 'wb')
+    fp.write(raw); fp.close()
+
+
+# elements which may repeat below their parent, they always become lists
+xml_lists = {
+    'monit': ['service'], # monit < 5.2
+    'services': ['service'],
+    'service': ['port', 'icmp'],
+}
+
+# names, ids and versions which must stay text even if they look like numbers
+xml_text = ['id', 'name', 'service', 'group', 'message', 'localhostname',
+            'hostname', 'request', 'version', 'release']
+
+def _scalar(text, name=None):
+    if name in xml_text:
+        return text
+    for conv in (int, float):
+        try:
+            return conv(text)
+        except ValueError:
+            pass
+    return text
+
+def _element(node):
+    """convert a DOM element to a dict, text only elements to scalars"""
+    children = [c for c in node.childNodes if c.nodeType == Node.ELEMENT_NODE]
+    if not children and not node.attributes.length:
+        return _scalar(''.join([c.data for c in node.childNodes
+                                if c.nodeType == Node.TEXT_NODE]).strip(),
+                       node.tagName)
+    d = dict([(str(k), _scalar(v, k)) for k, v in node.attributes.items()])
+    lists = xml_lists.get(node.tagName, ())
+    for c in children:
+        name = str(c.tagName)
+        value = _element(c)
+        if name in lists:
+            d.setdefault(name, []).append(value)
+        else:
+            d[name] = value
+    return d
+
+def parse_xml(raw):
+    """Map a monit XML status document to the structure of the JSON
+    documents `MonitIngest.store` expects."""
+    from xml.dom import minidom # only the backfill parses XML
+    tree = _element(minidom.parseString(raw).documentElement)
+    server = tree.get('server', {})
+    # monit >= 5.2 moved id, incarnation and version to <monit> attributes
+    for k in ('id', 'incarnation', 'version'):
+        if k in tree and k not in server:
+            server[k] = tree[k]
+    server['platform'] = tree.get('platform', {})
+    services = tree.get('service') or tree.get('services', {}).get('service', [])
+    for s in services:
+        s['portlist'] = s.pop('port', [])
+        s['icmplist'] = s.pop('icmp', [])
+    data = {'monit': {'server': server}, 'servicelist': services}
+    if isinstance(tree.get('event'), DictType):
+        data['event'] = tree['event']
+    return data
+
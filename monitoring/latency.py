@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
+"""Response time percentiles for host port and ICMP checks.
+
+The collector folds every `host_port` and `host_icmp` response time
+into a DDSketch per check and hour (`response_sketch`). A DDSketch
+counts values in logarithmic bins, every quantile it returns is within
+`ALPHA` (1%) of the true value and two sketches merge by adding their
+bins. Percentiles for any range are answered by merging the hourly
+sketches of the range instead of scanning the history tables.
+
+A check is identified by the monit instance, the host service name,
+the kind (`port` or `icmp`) and a target: `hostname:port/protocol` for
+ports, the ICMP type for ping checks.
+"""
+
+import math
+
+ALPHA = 0.01 # relative accuracy
+BUCKET = 3600 # seconds per sketch
+MIN_VALUE = 1e-6 # values below (and 0) are counted as zero
+
+
+class DDSketch(object):
+
+    def __init__(self, alpha=ALPHA):
+        self.gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self.gamma)
+        self.bins = {} # index -> count
+        self.zero = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = self.max = None
+
+    def add(self, value, n=1):
+        if value < MIN_VALUE:
+            self.zero += n
+        else:
+            i = int(math.ceil(math.log(value) / self._log_gamma))
+            self.bins[i] = self.bins.get(i, 0) + n
+        self.count += n
+        self.sum += value * n
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def merge(self, other):
+        for i, n in other.bins.items():
+            self.bins[i] = self.bins.get(i, 0) + n
+        self.zero += other.zero
+        self.count += other.count
+        self.sum += other.sum
+        for v in (other.min, other.max):
+            if v is not None:
+                if self.min is None or v < self.min:
+                    self.min = v
+                if self.max is None or v > self.max:
+                    self.max = v
+
+    def quantile(self, q):
+        """the value at quantile `q` (0..1), None if empty"""
+        if not self.count:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero
+        if rank < seen:
+            return 0.0
+        for i in sorted(self.bins):
+            seen += self.bins[i]
+            if rank < seen:
+                value = 2 * self.gamma ** i / (self.gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def dumps(self):
+        """the bins as text, count, sum, min and max are kept in columns"""
+        return ','.join(['%d:%d' % b for b in sorted(self.bins.items())])
+
+    def loads(self, text):
+        for item in text and text.split(',') or []:
+            i, n = item.split(':')
+            self.bins[int(i)] = int(n)
+
+
+def _sketch(row):
+    s = DDSketch()
+    s.loads(row['bins'])
+    s.zero, s.count, s.sum = row['zero'], row['count'], row['sum']
+    s.min, s.max = row['min'], row['max']
+    return s
+
+def targets(portlist, icmplist):
+    """(kind, target, response time) of the checks of one host sample"""
+    for p in portlist:
+        yield ('port', '%s:%s/%s' % (p.get('hostname', ''), p.get('portnumber', ''),
+               p.get('protocol') or p.get('type', '')), p.get('responsetime'))
+    for i in icmplist:
+        yield ('icmp', i.get('type', ''), i.get('responsetime'))
+
+def update_host(cur, monit_id, name, collected_sec, portlist, icmplist):
+    """Fold the response times of one host sample into the sketches.
+    Failed checks (no or a negative response time) are not counted."""
+    bucket = collected_sec - collected_sec % BUCKET
+    for kind, target, value in targets(portlist, icmplist):
+        if value is None or value < 0:
+            continue
+        key = (monit_id, name, kind, target, bucket)
+        cur.execute("SELECT zero, count, sum, min, max, bins FROM "
+                    "response_sketch WHERE monit_id=? AND name=? AND kind=? "
+                    "AND target=? AND bucket_sec=?", key)
+        row = cur.fetchone()
+        if row:
+            s = _sketch(row)
+        else:
+            s = DDSketch()
+        s.add(value)
+        cur.execute("INSERT OR REPLACE INTO response_sketch (monit_id, name, "
+                    "kind, target, bucket_sec, zero, count, sum, min, max, "
+                    "bins) VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                    key + (s.zero, s.count, s.sum, s.min, s.max, s.dumps()))
+
+def percentiles(cur, start, stop, quantiles=(0.5, 0.95, 0.99), monit_id=None,
+                name=None, kind=None, target=None):
+    """Merge the hourly sketches overlapping [start, stop] per check.
+
+    Returns a list of dicts with monit_id, name, kind, target, count,
+    mean, min, max and `quantiles`, a list of the values at `quantiles`.
+    """
+    sql = "SELECT * FROM response_sketch WHERE bucket_sec > ? AND bucket_sec <= ?"
+    args = [start - BUCKET, stop]
+    for column, value in [('monit_id', monit_id), ('name', name),
+                          ('kind', kind), ('target', target)]:
+        if value is not None:
+            sql += " AND %s=?" % column
+            args.append(value)
+    cur.execute(sql, args)
+    merged = {}
+    for row in cur.fetchall():
+        key = (row['monit_id'], row['name'], row['kind'], row['target'])
+        if key in merged:
+            merged[key].merge(_sketch(row))
+        else:
+            merged[key] = _sketch(row)
+    result = []
+    for key in sorted(merged):
+        s = merged[key]
+        result.append({'monit_id': key[0], 'name': key[1], 'kind': key[2],
+                       'target': key[3], 'count': s.count,
+                       'mean': s.sum / s.count if s.count else None,
+                       'min': s.min, 'max': s.max,
+                       'quantiles': [s.quantile(q) for q in quantiles]})
+    return result
@@ -1,32 +1,25 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
 
-import gc
-import os, time, re, csv
+import os, time
 from pkg_resources import resource_filename
-from types import ListType, DictType
-from xml.dom import minidom
 from datetime import datetime
 
 from genshi.builder import tag
-from genshi.core import Markup
-
-
 
 from trac.core import *
-from trac.util.text import CRLF, unicode_passwd
 from trac.util.translation import _
-from trac.util.datefmt import to_timestamp, to_datetime, format_datetime, localtz, utc
-from trac.config import BoolOption, IntOption, ListOption, Option
+from trac.util.datefmt import format_datetime, to_timestamp, utc
+from trac.config import BoolOption, IntOption, Option
 from trac.perm import IPermissionRequestor
 from trac.timeline import ITimelineEventProvider
-from trac.web import IRequestHandler, RequestDone, parse_query_string
-from trac.web.chrome import Chrome, INavigationContributor, ITemplateProvider,\
-        add_ctxtnav, add_link, add_script, add_stylesheet, add_warning, \
-        prevnext_nav
+from trac.web import IRequestHandler, RequestDone
+from trac.web.chrome import INavigationContributor, ITemplateProvider
 
-import db
-from db import sqlite, DictConnection, db_version
+import db, latency, overview, partition, routes, wire
+from ingest import MonitIngest, save_invalid, save_xml, srv_types
+from rules import RuleEngine, parse_rules
+from timeline import TimelineCache
 
 try:
     import simplejson
@@ -37,49 +30,61 @@ except ImportError:
 joinpath = os.path.join
 #gc.set_debug(gc.DEBUG_LEAK)
 
-srv_types = {
-    0:'filesystem',
-    1:'directory',
-    2:'file',
-    3:'process',
-    4:'host',
-    5:'system'}
-
 class MonitCollector(Component):
     implements(IRequestHandler)
 
     log_dir = Option('monit', 'log_dir', 'log/monit', '')
+
+    partition = Option('monit', 'partition', 'none',
+        """Write history to one database file per `day` or `week` below
+        `db/monit-partitions/`, `none` keeps everything in monit.db.""")
+
+    partition_keep = IntOption('monit', 'partition_keep', 0,
+        """Number of history partitions to keep, older partition files
+        are deleted when a new one is created. 0 keeps everything.""")
+
+    spool = BoolOption('monit', 'spool', False,
+        """Append posted documents to `db/monit-spool/` and answer once
+        they are on disk, a background thread stores them in monit.db.""")
+
+    spool_segment_size = IntOption('monit', 'spool_segment_size', 16,
+        """Size in MB after which a new spool segment is started.""")
+
+    spool_interval = IntOption('monit', 'spool_interval', 1,
+        """Seconds between runs of the spool applier.""")
     #connection_uri = Option('monit', 'database', 'sqlite:db/monit.db',
     #    """Database connection for monit""")
 
     def __init__(self, *args, **kwargs):
-        conn = self.get_db_cnx()
-        cur = conn.cursor()
+        self.partitions = None
+        if self.partition in partition.schemes:
+            self.partitions = partition.Partitions(
+                joinpath(self.env.path, 'db/monit.db'), self.partition,
+                self.log, self.partition_keep)
+        elif self.partition != 'none':
+            self.log.warning("Unknown partition scheme '%s', not partitioning" % self.partition)
         try:
-            cur.execute("SELECT db_version FROM monit")
-            res = cur.fetchone()
-            self.log.debug("MonitDB version from db is '%s', current version is '%s'" % (res['db_version'], db_version))
-            if res and res.get('db_version', None) != db_version:
-                current = res['db_version']
-                try:
-                    db.upgrade(cur, current, db_version)
-                    cur.execute("UPDATE monit SET db_version=?", (db_version,))
-                except sqlite.OperationalError, e:
-                    self.log.warning("Database upgrade from verion %s to version %s failed (%s)" % (
-                                    current, db_version, e))
-        except sqlite.OperationalError, e:
-            self.log.debug("Error fetching db_version %s" % e)
-            #the monit table does not exist, create tables from scratch
-            for stmt in db.tables:
-                cur.execute(stmt)
-            db.upgrade(cur, 1, db_version) #run all upgrades
-        conn.commit()
-        conn.close()
+            rules = RuleEngine(parse_rules(self.config.options('monit-rules')),
+                               self.log)
+        except ValueError, e:
+            self.log.error("Ignoring [monit-rules]: %s" % e)
+            rules = None
+        self.ingest = MonitIngest(self.log, self.partitions, rules)
+        self._spool = None
+        if self.spool:
+            from spool import Applier, ApplierThread, Spool
+            db_path = joinpath(self.env.path, 'db/monit.db')
+            self._spool = Spool(joinpath(self.env.path, 'db/monit-spool'),
+                                self.log, self.spool_segment_size * 1024 * 1024)
+            # one thread per process, flock() lets only one of them work
+            ApplierThread(Applier(self._spool, db_path, self.log, self.ingest),
+                          self.spool_interval, self.log).start()
         
     def get_db_cnx(self):
         """get a connection to the monit db"""
         path = joinpath(self.env.path, 'db/monit.db')
-        return sqlite.connect(path, timeout=10000, factory=DictConnection)
+        db.ensure_schema(path, self.log)
+        return db.connect(path, isolation_level=None)
 
     # IPermissionRequestor methods
     def get_permission_actions(self):
@@ -89,8 +94,7 @@ class MonitCollector(Component):
         
     # IRequestHandler methods
     def match_request(self, req):
-        self.env.log.debug("MONIT: match_request() called")
-        match = re.match('/collector(.*)', req.path_info)
+        match = routes.match('collector', req.path_info)
         if match:
             self.log.debug("MONIT collector request matched: %s" % match.group())
             return True
@@ -102,189 +106,79 @@ class MonitCollector(Component):
 
             ct = req.get_header('Content-Type')
             self.log.debug("content-type is: %s" % ct)
-            if ct == 'application/json':
-                self._handle_json(req)
+            if ct in wire.json_types or ct in wire.msgpack_types:
+                self._handle_document(req, ct)
             elif ct == 'text/xml':
                 self._handle_xml(req)
             else:
-                self_handle_text(req)
+                self._handle_text(req)
                 
         return 'monit.html', {}, 'text/html'
 
+    def _read_body(self, req):
+        """the request body, inflated if it was sent compressed"""
+        length = req.get_header('Content-Length')
+        try:
+            return wire.read_body(req.read, length and int(length),
+                                  req.get_header('Content-Encoding'))
+        except wire.Unsupported, e:
+            self.log.warning("Unsupported data from %s: %s" % (req.remote_addr, e))
+            req.send('', content_type='text/plain', status=415)
+        except wire.TooLarge, e:
+            self.log.warning("Document from %s is too large" % req.remote_addr)
+            req.send('', content_type='text/plain', status=413)
+        except wire.DecodeError, e:
+            self.log.warning("Failed to decode data from %s: %s" % (req.remote_addr, e))
+            req.send('', content_type='text/plain', status=400)
+
     def _handle_xml(self, req):
-        doc = minidom.parse(req) #req is file-like enough (has a .read())
+        from xml.dom import minidom
+        doc = minidom.parseString(self._read_body(req))
         id = doc.getElementsByTagName('id')[0].childNodes[0].nodeValue
-
-        # id is in $HOME/.monit.id and will be (re)generated if missing
-        # watch out if you're syncing $HOMEs
-        savepath = joinpath(self.log_dir, id)
-        if not os.path.isdir(savepath):
-            self.log.debug("MONIT collector: creating %s from id: %s and log: %s" % (savepath, id, self.log_dir))
-            os.mkdir(savepath)
-        fp = open(joinpath(savepath, str(int(time.time())) + '.xml'), 'w')
-        fp.write(doc.toxml()); fp.close()
+        save_xml(self.log_dir, id, doc.toxml(), self.log)
 
         #self.log.debug("POST HANDLER got data from %s for %s: %s" % (req.remote_addr, id, doc.toxml()))
         req.send('', content_type='text/plain', status=201)
 
-    def _handle_json(self, req):
-        # parse a JSON request
-
-        if not have_json:
-            self.log.warning("The simplejson module is missing. Cannot parse JSON")
-            req.send('', content_type='text/plain', status=200)
+    def _handle_document(self, req, ct):
+        # parse a JSON or MessagePack request
+        if ct not in wire.content_types():
+            self.log.warning("No module to parse %s installed" % ct)
+            req.send('', content_type='text/plain', status=415)
 
+        raw = self._read_body(req)
         try:
-            raw = req.read()
-            raw = raw.replace('\n', '') #strip linebreaks
-            data = simplejson.loads(raw)
-        except ValueError, e:
-            ct = req.get_header('Content-Type') or 'text/plain'
+            data = wire.parse(raw, ct)
+        except wire.DecodeError, e:
             self.log.warning("Failed to parse data from %s" % req.remote_addr)
             self._invalid_data(ct, raw)
             req.send('', content_type='text/plain', status=200)
         
-        # store data
-        conn = self.get_db_cnx()
-        cur = conn.cursor()
-        
-        #sanitize the 'monit' section
-        raw = data.get('monit', {}).get('server', {})
-        client_info = dict([(k,v) for k,v in raw.items()
-                            if type(v) not in [ListType, DictType]])
-        client_info.update(dict([('platform_'+k,v) \
-                            for k,v in raw.get('platform', {}).items()]))
-        client_info.update(raw.get('httpd', {}))
-        client_info['monitid'] = client_info['id']; del client_info['id']
-        
-        #get the id of the monit instance we're operating on and save it for the service processing
-        self.log.debug("query DB for monit client entry with id: %s" % client_info['monitid'])
-        cur.execute("SELECT id from monit WHERE monitid =?", (client_info['monitid'],))
-        res = cur.fetchone()
-        
-        if not res:
-            self.log.debug("Inserting into monit table: id %s with values %s" % (
-                            client_info['monitid'], str(client_info)))
-                            
-            cur.dict_insert('monit', client_info)
-            self.monit_id = cur.lastrowid
-        else:
-            self.log.debug("Updating monit entry with id %s" % client_info['monitid'])
-            cur.dict_update('monit', client_info, {'monitid':client_info['monitid']})
-            self.monit_id = res['id']
-            
-        conn.commit()
-        #write data for inspection
-        #fp = open('/home/pkoelle/trac012dev/tracenv/log/'+str(time.time())+'.json', 'w')
-        #fp.write(simplejson.dumps(data, indent=2))
-        #fp.close()
-        
+        if self._spool:
+            self._spool.append(req.remote_addr, raw, content_type=ct)
+            req.send('', content_type='text/plain', status=201)
 
-        #check for service reports 
-        for s in data.get('servicelist', []):
-            s_type =  s.get('type', None)
-            if s_type != None and s_type in range(6):
-                self._process_services(conn, s_type, s)
-            else:
-                self.log.warning("Unknown service type %s from client %s (%s)" % (
-                                    str(s_type), req.remote_addr, str(s)))
-        
-        #events need to come after services as they are linked to a service
-        evt = data.get('event', {})
-        if evt:
-            table = srv_types[evt['type']]+'_service'
-            self.log.debug("Updating event table with %s" % str(evt))
-            cur.execute("SELECT id from %s WHERE name=?" % table, (evt['service'],))
-            res = cur.fetchone()
-               
-            if not res:
-                self.log.warning("No service with name %s found during event processing (%s)"  % (
-                                    evt['service'], evt['message']))
-            else:
-                evt['service_id'] = res.get('id'); del evt['service']
-                evt['groupname'] = evt['group']; del evt['group']
-                del evt['collected_usec'] #who cares
-                del evt['id']
-                cur.dict_insert('event', evt)
-            
-            conn.commit()
-        conn.close()
+        # store data, the whole document is a single transaction
+        conn = self.get_db_cnx()
+        try:
+            try:
+                self.ingest.begin(conn)
+                self.ingest.store(conn, data, req.remote_addr)
+                self.ingest.commit(conn)
+            except Exception:
+                self.ingest.rollback(conn)
+                raise
+        finally:
+            conn.close()
             
         req.send('', content_type='text/plain', status=201)
 
-    def _process_services(self, conn, service_type, service_data):
-        """@param service_type, integer, lookup table is srv_types
-           @param service_data, dictionary"""
-           
-        #don't handle unmonitored services for now
-        if not service_data.get('monitor', None):
-            return
-            
-        srv_name = srv_types[service_type]
-        table = "%s_service" % srv_name
-        cur = conn.cursor()
-        
-        values = dict([(k,v) for k,v in service_data.items()
-                            if type(v) not in [ListType, DictType]])
-        del values['collected_usec'] #useless...
-        values['monit_id'] = self.monit_id
-        values['groupname'] = values['group']; del values['group'] # group is a sql kw
-        
-        self.log.debug("Updating service table for service type '%s' with %s" % (srv_name, str(service_data)))
-        #ugly...
-        if srv_name == 'system':
-            values.update(dict([('load_'+k,v) for k,v in \
-                            service_data['system']['load'].items()]))
-            values.update(dict([('cpu_'+k, v) for k,v in \
-                            service_data['system']['cpu'].items()]))
-            values.update(dict([('memory_'+k, v) for k,v in \
-                            service_data['system']['memory'].items()]))
-            cur.dict_insert(table, values)
-            
-        elif srv_name == 'host':
-            portlist = service_data.get('portlist', [])
-            icmplist = service_data.get('icmplist', [])
-
-            cur.dict_insert(table, values)
-            host_id = cur.lastrowid
-            for e in portlist:
-                e['host_id'] = host_id
-                cur.dict_insert('host_port', e)
-            for e in icmplist:
-                e['host_id'] = host_id
-                cur.dict_insert('host_icmp', e)
-                
-        elif srv_name == 'process':
-            values.update(dict([('cpu_'+k, v) for k,v in \
-                            service_data['cpu'].items()]))
-            values.update(dict([('memory_'+k, v) for k,v in \
-                            service_data['memory'].items()]))
-            cur.dict_insert(table, values)
-            
-        elif srv_name == 'filesystem':
-            values.update(dict([('block_'+k,v) for k,v in \
-                            service_data['block'].items()]))
-            if service_data.get('inode', None): # sometimes missing 
-                values.update(dict([('inode_'+k,v) for k,v in \
-                            service_data['inode'].items()]))
-            cur.dict_insert(table, values)
-            
-        else: # file and directory
-            cur.dict_insert(table, values)
- 
-        conn.commit()
-        
     def _handle_text(self, req):
         """we don't parse text/plain for now"""
-        req.send('', type='text/plain', status=301)
+        req.send('', content_type='text/plain', status=301)
 
     def _invalid_data(self, contenttype, raw):
-        suffix = contenttype.split('/')[-1]
-        self.log.warning("The data will be saved in %s/invalid for review." % self.log_dir )
-        if not os.path.isdir(joinpath(self.log_dir, 'invalid')):
-            os.mkdir(joinpath(self.log_dir, 'invalid'))
-        fp = open(joinpath(self.log_dir, 'invalid', str(int(time.time()))+'.'+suffix ), 'w')
-        fp.write(raw); fp.close()
+        save_invalid(self.log_dir, contenttype, raw, self.log)
 
 
         
@@ -295,10 +189,27 @@ class MonitViewer(Component):
     rc_file = Option('monit', 'rc_file', '/etc/monitrc',
         """monit configuration.""")
 
+    overview_top = IntOption('monit', 'overview_top', 10,
+        """Number of processes listed in the top CPU and memory tables
+        of the overview.""")
+
+    overview_fs_threshold = IntOption('monit', 'overview_fs_threshold', 90,
+        """Filesystems with a block usage at or above this percentage
+        are listed in the overview.""")
+
+    timeline_cache_size = IntOption('monit', 'timeline_cache_size', 20000,
+        """Number of timeline events kept in memory, repeated timeline
+        views only read the events added since. 0 disables the cache.""")
+
+    def __init__(self, *args, **kwargs):
+        self._timeline = TimelineCache(self._timeline_event,
+                                       self.timeline_cache_size)
+
     def get_db_cnx(self):
         """get a connection to the monit db"""
         path = joinpath(self.env.path, 'db/monit.db')
-        return sqlite.connect(path, timeout=10000, factory=DictConnection)
+        db.ensure_schema(path, self.log)
+        return db.connect(path)
 
 
     # ITimelineEventProvider methods
@@ -309,56 +220,42 @@ class MonitViewer(Component):
            
     def get_timeline_events(self, req, start, stop, filters):
         self.log.debug("Monit: get_timeline_events() called")
-        conn = self.get_db_cnx()
-        
         myfilter = [f for f in filters if f.startswith('monit_')]
         event_filter = [k for k,v in srv_types.items() if v in [f.split('_')[1] for f in myfilter]]
         self.log.debug("Input: %s, filtered: %s, Types: %s" % (filters, myfilter, event_filter))
         
         if event_filter:
-            #monit_realm = Resource('monit')
-            cur = conn.cursor()
-            sql = "SELECT COUNT(*) AS events FROM event WHERE \
-                    collected_sec >=? AND collected_sec <=? AND type IN (%s)" % ','.join(['?' for e in event_filter])
-            cur.execute(sql, (to_timestamp(start), to_timestamp(stop))+tuple(event_filter))
-            
-            self.log.debug("There are currently %s events for the range from %s to %s" % (
-                        cur.fetchall(), start, stop))
-            
-            sql = "SELECT * FROM event WHERE collected_sec >=? \
-                    AND collected_sec <=? AND type IN (%s)" % ','.join(['?' for e in event_filter])
-            cur.execute(sql, (to_timestamp(start), to_timestamp(stop))+tuple(event_filter))
-            events = cur.fetchall()
-            
-            for evt in events:
-                self.log.debug("Found monit event  %s" % evt)
-                srv_table = "%s_service" % srv_types[evt['type']]
-                
-                #self.log.debug("Selecting service entry with %s" )
-                cur.execute("SELECT * FROM %s WHERE id=? LIMIT 1" % srv_table, (evt['service_id'],))
-                srv = cur.fetchone()
-                #self.log.debug("Found service entry %s" % srv)
-                
-                if srv:
-                    cur.execute("SELECT * FROM monit WHERE id=?", (srv['monit_id'],))
-                    monit = cur.fetchone()
-                    #self.log.debug("Found monit instance %s" % monit)
-                    
-                    if monit:
-                        msg = ('monit', datetime.fromtimestamp(evt['collected_sec'], utc), 
-                            'monit@%s' % monit['localhostname'], (evt, srv, monit))
-                    else:        
-                        self.log.warning("No monit entry with id '%s' found while rendering event '%s'." % (
-                             srv['monit_id'], evt['id']))
-                        msg = ('monit', datetime.fromtimestamp(evt['collected_sec'], utc), 
-                            'monit@unknown', (evt, srv, None))
-                else:            
-                    self.log.warning("No service entry with id '%s' found while rendering event '%s'." % (
-                             evt['service_id'], evt['id']))            
-                    msg = ('monit', datetime.fromtimestamp(evt['collected_sec'], utc), 
-                            'monit@unknown', (evt, None, None))
+            conn = self.get_db_cnx()
+            try:
+                start_ts, stop_ts = to_timestamp(start), to_timestamp(stop)
+                partitions = MonitCollector(self.env).partitions
+                if partitions:
+                    prefixes = partitions.iter_range(conn, start_ts, stop_ts)
+                else:
+                    prefixes = ['']
+                events = self._timeline.events(conn, event_filter, start_ts,
+                                               stop_ts, prefixes)
+            finally:
+                conn.close()
+            self.log.debug("There are %d events for the range from %s to %s, "
+                           "%d cached" % (len(events), start, stop,
+                           self._timeline.size()))
+            for msg in events:
                 yield msg
-        conn.close()
+
+    def _timeline_event(self, evt, srv, monit):
+        """the timeline tuple of an event, kept by `TimelineCache`"""
+        collected = datetime.fromtimestamp(evt['collected_sec'], utc)
+        if srv and monit:
+            return ('monit', collected, 'monit@%s' % monit['localhostname'],
+                    (evt, srv, monit))
+        if srv:
+            self.log.warning("No monit entry with id '%s' found while rendering event '%s'." % (
+                             srv['monit_id'], evt['id']))
+        else:
+            self.log.warning("No service entry with id '%s' found while rendering event '%s'." % (
+                             evt['service_id'], evt['id']))
+        return ('monit', collected, 'monit@unknown', (evt, srv, None))
                          
     def render_timeline_event(self, context, field, event):
         #self.log.debug("Monit: render_timeline_event() called")
@@ -368,19 +265,23 @@ class MonitViewer(Component):
         elif field == 'title':
             return tag(tag.em('New ', srv_types.get(evt['type'], ''), ' event'))
         elif field == 'description':
+            repeated = ''
+            if evt.get('count', 1) > 1:
+                repeated = ' (%d times, last on %s)' % (evt['count'],
+                           format_datetime(evt['last_sec'], tzinfo=context.req.tz))
             if srv and monit:
                 markup = tag.div('Event on ', tag.b(monit['localhostname']),
                                  ' for service ', tag.b(srv['name']), '(type %s) ' % srv_types.get(evt['type'], ''),
-                                  tag.em(evt['message']))
+                                  tag.em(evt['message']), repeated)
                 self.log.debug("Monit markup for Timeline -> %s" % str(markup))
             elif srv:
                 markup =  tag.div('Event on ', tag.b('unknown'), ' for service ',
                           tag.b(srv['name']), '(type %s) ' % srv_types.get(evt['type'], ''),
-                          tag.em(evt['message']))
+                          tag.em(evt['message']), repeated)
             else:
                 markup = tag.div('Event on ', tag.b('unknown'), ' for service ', 
                          tag.b('unknown'), '(type unknown)',
-                         tag.em(evt['message']))
+                         tag.em(evt['message']), repeated)
                          
                 self.log.debug("Monit markup for Timeline -> %s" % str(markup))
                 
@@ -414,12 +315,10 @@ class MonitViewer(Component):
 
     # IRequestHandler methods
     def match_request(self, req):
-        self.env.log.debug("MONIT: match_request() called")
-        if 'MONIT_VIEW' in req.perm:
-            match = re.match('/monit(.*)', req.path_info)
-            if match:
-                self.log.debug("MONIT: request matched:%s" % match.group())
-                return True
+        match = routes.match('monit', req.path_info)
+        if match and 'MONIT_VIEW' in req.perm:
+            self.log.debug("MONIT: request matched:%s" % match.group())
+            return True
         return False
 
     def process_request(self, req):
@@ -428,6 +327,12 @@ class MonitViewer(Component):
             parts = [p for p in req.path_info.split('/') if p]
             if len(parts) >= 2 and parts[1] == 'xhr':
                 self._process_xhr(req, parts[1:])
+            if len(parts) == 3 and parts[1] == 'export':
+                self._process_export(req, parts[2])
+            if len(parts) == 2 and parts[1] == 'latency':
+                self._process_latency(req)
+            if len(parts) == 3 and parts[1] == 'report':
+                self._process_report(req, parts[2])
                 
             conn = self.get_db_cnx()
             cur = conn.cursor()
@@ -436,7 +341,10 @@ class MonitViewer(Component):
             self.log.debug("MonitViewer: Found monits %s" % monits)
             for m in monits:
                 m['uptime'] = "%d days %d:%d:%d" % self.fract_sec(m['uptime'])
-            data = {'monits': monits}
+            data = {'monits': monits,
+                    'overview': overview.get_overview(cur, self.overview_top,
+                                                self.overview_fs_threshold)}
+            conn.close()
             return 'monit.html', data, 'text/html'
 
     def fract_sec(self, s):
@@ -448,6 +356,109 @@ class MonitViewer(Component):
 
     def _process_xhr(self, req, parts):
             req.send(str(parts), content_type='text/plain')
+
+    def _process_latency(self, req):
+        """/monit/latency?host=&name=&kind=&target=&from=&to=&q=, response
+        time percentiles per host check as JSON. The range defaults to
+        the last day, `q` to 0.5,0.95,0.99."""
+        if not have_json:
+            raise TracError(_("The simplejson module is missing"))
+        from export import parse_time
+        try:
+            stop = parse_time(req.args.get('to')) or int(time.time())
+            start = parse_time(req.args.get('from')) or stop - 86400
+            quantiles = [float(q) for q in
+                         (req.args.get('q') or '0.5,0.95,0.99').split(',')]
+        except ValueError, e:
+            raise TracError(_("Invalid argument: %s") % e)
+        conn = self.get_db_cnx()
+        try:
+            cur = conn.cursor()
+            monit_ids = [None]
+            if req.args.get('host'):
+                cur.execute("SELECT id FROM monit WHERE localhostname=?",
+                            (req.args['host'],))
+                monit_ids = [r['id'] for r in cur.fetchall()]
+            checks = []
+            for monit_id in monit_ids:
+                checks.extend(latency.percentiles(cur, start, stop, quantiles,
+                              monit_id, req.args.get('name'),
+                              req.args.get('kind'), req.args.get('target')))
+        finally:
+            conn.close()
+        req.send(simplejson.dumps({'from': start, 'to': stop,
+                                   'q': quantiles, 'checks': checks}),
+                 content_type='application/json')
+
+    def _process_report(self, req, report):
+        """/monit/report/<daily|trend>?table=&column=&host=&service=&from=
+        &to=&q=&limit=, fleet statistics of one column as JSON. The range
+        defaults to the last 30 days, `q` to 0.5,0.95."""
+        if not have_json:
+            raise TracError(_("The simplejson module is missing"))
+        import analytics
+        from export import parse_time
+        if report not in analytics.reports:
+            raise TracError(_("Unknown report '%s', available are %s") % (
+                            report, ', '.join(analytics.reports)))
+        table = req.args.get('table') or 'system_service'
+        column = req.args.get('column') or 'cpu_user'
+        try:
+            stop = parse_time(req.args.get('to')) or int(time.time())
+            start = parse_time(req.args.get('from')) or stop - 30 * 86400
+            quantiles = [float(q) for q in
+                         (req.args.get('q') or '0.5,0.95').split(',')]
+            limit = None
+            if req.args.get('limit'):
+                limit = float(req.args['limit'])
+            conn = self.get_db_cnx()
+            try:
+                samples = analytics.load(conn, table, column, start, stop,
+                              req.args.get('host'), req.args.get('service'),
+                              MonitCollector(self.env).partitions)
+            finally:
+                conn.close()
+        except ValueError, e:
+            raise TracError(_("Invalid argument: %s") % e)
+        if report == 'daily':
+            rows = analytics.daily(samples, quantiles)
+        else:
+            rows = analytics.trend(samples, limit)
+        req.send(simplejson.dumps({'report': report, 'table': table,
+                                   'column': column, 'from': start,
+                                   'to': stop, 'rows': rows}),
+                 content_type='application/json')
+
+    def _process_export(self, req, filename):
+        """/monit/export/<table>.<format>?host=&service=&from=&to=, the
+        rows are written chunk by chunk as they are read"""
+        import export
+        table, ext = os.path.splitext(filename)
+        fmt = ext[1:]
+        if table not in export.tables or fmt not in export.formats():
+            raise TracError(_("Can't export '%s', available are %s as %s") % (
+                            filename, ', '.join(export.tables),
+                            ', '.join(export.formats())))
+        try:
+            start = export.parse_time(req.args.get('from'))
+            stop = export.parse_time(req.args.get('to'))
+        except ValueError, e:
+            raise TracError(_("Invalid time: %s") % e)
+        conn = self.get_db_cnx()
+        try:
+            exp = export.Export(conn, table, req.args.get('host'),
+                                req.args.get('service'), start, stop,
+                                partitions=MonitCollector(self.env).partitions)
+            req.send_response(200)
+            req.send_header('Content-Type', export.content_types[fmt])
+            req.send_header('Content-Disposition',
+                            'attachment; filename=%s' % filename)
+            req.end_headers()
+            for data in getattr(exp, fmt)():
+                req.write(data)
+        finally:
+            conn.close()
+        raise RequestDone
     
 
     
@@ -1,28 +1,31 @@
 # -*- coding: utf-8 -*-
 # Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
 
-import os, time, re
-import csv, shutil
+import os, time
+import gzip, hashlib
 
-from datetime import datetime
 from pkg_resources import resource_filename
 from StringIO import StringIO
-from subprocess import Popen, PIPE
 
 from trac.core import *
-from trac.timeline.api import ITimelineEventProvider
-from trac.perm import IPermissionRequestor
-from trac.config import BoolOption, Option, IntOption, ListOption
-from trac.mimeview.api import Mimeview, IContentConverter, Context
-from trac.web import parse_query_string, IRequestHandler, RequestDone
-from trac.web.chrome import add_link, add_script, add_stylesheet, \
-        add_warning, add_ctxtnav, prevnext_nav, Chrome, \
-        INavigationContributor, ITemplateProvider
+from trac.perm import IPermissionRequestor, PermissionError, PermissionSystem
+from trac.config import BoolOption, Option, IntOption
+from trac.web import HTTPNotFound, IRequestHandler, RequestDone
+from trac.web.chrome import INavigationContributor, ITemplateProvider
 from trac.util.translation import _
-from trac.util.text import CRLF
-from genshi.core import Markup
 from genshi.builder import tag
 
+import routes
+from search import SearchIndex, documents
+from prerender import GraphCache, Prerenderer, Watcher, period_mapping, \
+                      render_graphs
+
+try:
+    import simplejson
+    have_json = True
+except ImportError:
+    have_json = False
+
 joinpath = os.path.join
 
 class MuninStatsViewer(Component):
@@ -31,13 +34,42 @@ class MuninStatsViewer(Component):
 
     rrd_path = Option('munin', 'rrd_path', '/var/lib/munin',
             """default path for rrd files.""")
+
+    prerender = BoolOption('munin', 'prerender', False,
+            """Watch `datafile` and render the most requested graphs after
+            each munin-update. Not needed if munin-cron runs
+            munin-prerender.""")
+
+    prerender_interval = IntOption('munin', 'prerender_interval', 60,
+            """Seconds between checks of the `datafile` mtime.""")
+
+    prerender_top = IntOption('munin', 'prerender_top', 50,
+            """Number of graphs rendered after each munin-update.""")
+
+    prerender_workers = IntOption('munin', 'prerender_workers', 2,
+            """Number of parallel munin-graph processes when pre-rendering.""")
+
+    permission_cache_ttl = IntOption('munin', 'permission_cache_ttl', 60,
+            """Seconds until the permissions of a user are checked again to
+            find the munin domains visible to them.""")
+
+    def __init__(self, *args, **kwargs):
+        self._catalogs = {} # (domain, host, domains) -> (mtime, etag, body, gzipped)
+        self._search_index = SearchIndex()
+        self._indexed = None # the stats the search index was built from
+        self._permission_index = PermissionIndex({})
+        self._users = {} # authname -> (time, permission set)
+        self.graph_cache = GraphCache(self.env.path, self.rrd_path, self.log)
+        if self.prerender:
+            Watcher(Prerenderer(self.graph_cache, self.log, self.prerender_top,
+                                self.prerender_workers),
+                    self.prerender_interval, self.log).start()
     
     # IPermissionRequestor methods
     def get_permission_actions(self):
         """return defined permissions if any"""
-        objects = self._get_permission_objects()
-        actions = ['MUNIN_ADMIN', 'MUNIN_VIEW', 'MUNIN_SAVE']
-        return actions + objects
+        actions = ['MUNIN_VIEW', 'MUNIN_SAVE'] + self._get_permission_objects()
+        return actions + [('MUNIN_ADMIN', actions)]
 
     # ITemplateProvider methods
     def get_htdocs_dirs(self):
@@ -60,11 +92,9 @@ class MuninStatsViewer(Component):
 
     # IRequestHandler methods
     def match_request(self, req):
-        self.env.log.debug("MUNIN: match_request() called")
-        match = re.match('/munin(.*)', req.path_info)
+        match = routes.match('munin', req.path_info)
         if match:
             self.log.debug("MUNIN: request matched:%s" % match.group()) 
-            parts = match.group().split('/')
             return True
 
 
@@ -75,33 +105,48 @@ class MuninStatsViewer(Component):
         parts = [p for p in req.path_info.split('/') if p]
         self.log.debug("MUNIN: parts %s" % parts)
 
-        if len(parts) > 2 and parts[1] == 'objects':
+        if len(parts) == 2 and parts[1] == 'catalog':
+            self._send_catalog(req)
+        elif len(parts) == 2 and parts[1] == 'search':
+            self._send_search(req)
+        elif len(parts) > 2 and parts[1] == 'objects':
             self._send_objects(req, parts[2:])
         elif len(parts) > 2 and parts[1] == 'values':
             self._send_values(req, parts[2:])
         
         raw = self.get_available_stats()
+        allowed = self._allowed_domains(req)
         data = {
-                'domains': [d for d in raw.keys() if d != 'version'],
+                'domains': [d for d in raw.keys() if d in allowed],
                 'hosts': [], 'cat': [],
                  }
         return 'munin.html', data, 'text/html'
 
     #Implementation
     def _get_permission_objects(self):
-        #return a list of hosts or hostgroups from munin
-        result = []
+        #return the VIEW_MUNIN_<DOMAIN> actions of the hostgroups in datafile
+        try:
+            return self._get_permission_index().actions
+        except EnvironmentError, e:
+            self.log.debug("MUNIN: no hostgroup permissions: %s" % e)
+            return []
 
-        #stupid hack, everything not in blacklist is probably a hostgroup
-        blacklist = ['plugin-state', 'datafile','limits', 
-                'munin-graph.stats', 'munin-update.stats',
-                '.viminfo', '.bash_history','munin-update-stats.tmp']
-        
-        items = os.listdir(self.rrd_path)
-        for item in items:
-            if item not in blacklist:
-                result.append('VIEW_MUNIN_'+item.upper())
-        return result
+    def _get_permission_index(self):
+        """the permission index, rebuilt when `datafile` changed"""
+        stats = self.get_available_stats()
+        if self._permission_index.stats is not stats:
+            self._permission_index = PermissionIndex(stats)
+        return self._permission_index
+
+    def _allowed_domains(self, req):
+        """the set of domains the user of `req` may see"""
+        now = time.time()
+        user = self._users.get(req.authname)
+        if user is None or now - user[0] > self.permission_cache_ttl:
+            perms = PermissionSystem(self.env).get_user_permissions(req.authname)
+            user = (now, frozenset([k for k, v in perms.items() if v]))
+            self._users[req.authname] = user
+        return self._get_permission_index().allowed(user[1])
 
     def _send_objects(self, req, params):
         if len(params) == 1:
@@ -113,17 +158,19 @@ class MuninStatsViewer(Component):
         
     def _send_hostnames(self, req, domain):
         raw = self.get_available_stats()
-        d = raw.get(domain, None)
+        d = domain in self._allowed_domains(req) and raw.get(domain, None)
         if d:
             res = d.keys()
         else: res = []
         #res.insert(0, '<host>')
-        self._send_response(req, str(res), 'application/json')
+        self._send_json(req, res)
 
     def _send_categories(self, req, domain, host):
         raw = self.get_available_stats()
         res = []
         try:
+            if domain not in self._allowed_domains(req):
+                raise KeyError(domain)
             entries = raw[domain][host]
             for e in entries:
                 if 'cat' in e:
@@ -133,66 +180,153 @@ class MuninStatsViewer(Component):
         except KeyError:
             pass
         #res.insert(0, '<category>')
-        self._send_response(req, str(res), 'application/json')
+        self._send_json(req, res)
         
     def _send_cat_details(self, req, dom, node, cat):
         raw = self.get_available_stats()
-        entries = raw[dom][node]
+        if dom in self._allowed_domains(req):
+            entries = raw.get(dom, {}).get(node, [])
+        else:
+            entries = []
         res = []
         for e in entries:
             if 'cat' in e and e['cat'] == cat:
                 res.append({e['label']:e['value']})
-        self._send_response(req, str(res), 'application/json')
+        self._send_json(req, res)
     
     def _send_values(self, req, params):
         """get values, for now we're just generate and load images
         through munin"""
-        period_mapping = {
-                'daily':'--noweek --nomonth --noyear',
-                'weekly':'--noday --nomonth --noyear',
-                'monthly':'--noday --noweek --noyear',
-                'yearly':'--noday --noweek --nomonth'
-            }
-        raw = self.get_available_stats()
         domain, host, cat = params
-        hosts = ' '.join(['--host '+h for h in host.split(',')])
-        srvs = ' '.join(['--service '+c for c in cat.split(',')])
+        # munin-graph only knows hosts, check each host is in the domain
+        nodes = self.get_available_stats().get(domain, {})
+        hosts = host.split(',')
+        if domain not in self._allowed_domains(req) or \
+                [h for h in hosts if h not in nodes]:
+            raise PermissionError(view_action(domain))
+        # requests are recorded and rendered again later, only keep
+        # categories munin knows for these hosts
+        cats = set([e['cat'] for h in hosts for e in nodes[h] if 'cat' in e])
+        if [c for c in cat.split(',') if c not in cats]:
+            raise HTTPNotFound(_('Unknown munin category %(cat)s', cat=cat))
         period = req.args.get('period', 'daily')
         if period not in period_mapping.keys():
             period = 'daily'
-        cmd = 'su -p -c "/usr/share/munin/munin-graph  --list-images '+period_mapping[period]+' '+hosts+' '+srvs+'" munin'
-        p = Popen(cmd, shell=True, close_fds=True, stdout=PIPE, stderr=PIPE)
-        self.log.debug('munin command executed was: '+cmd)
-
-        picdir = joinpath(self.env.path, 'htdocs', 'munin')
-        if not os.path.isdir(picdir):
-            os.mkdir(picdir)
-        pics = [pic.strip() for pic in p.stdout.readlines()]
-        self.log.debug("OUTPUT from popen call to munin-graph: %s (stderr: %s" % (pics, p.stderr.read()))
-        new_pics = []
-        for pic in pics:
-            #newer munin breaks naming, join host and metric 
-            parts = pic.split('/')
-            new_name = '-'.join(parts[-2:])
-            new_pics.append(new_name)
-            shutil.copy(pic, joinpath(picdir, new_name))
-        pics = [self.env.href()+'/chrome/site/munin/'+os.path.basename(p) for p in new_pics]
-        self._send_response(req, str(pics), 'application/json')
+        cache = self.graph_cache
+        cache.record(domain, host, cat, period)
+
+        pics = cache.lookup(domain, host, cat, period)
+        if pics is None:
+            started = int(time.time())
+            pics = render_graphs(host, cat, period, cache.picdir, self.log)
+            cache.store(domain, host, cat, period, pics, started)
+        pics = [self.env.href()+'/chrome/site/munin/'+os.path.basename(p) for p in pics]
+        self._send_json(req, pics)
         
-    def _send_response(self, req, data, content_type):
-        self.log.debug("sending RAW response, request.path_info was: %s" % req.path_info)
-        self.log.debug("sending RAW response, content-type: %s, data: %s" % (content_type, data))
+    def _send_json(self, req, data, etag=None):
+        """Send `data` as JSON, gzip compressed if the client accepts it.
+        With an `etag` a matching If-None-Match is answered with 304."""
+        body = simplejson.dumps(data)
+        self._send_body(req, body, etag, 'application/json')
+
+    def _send_body(self, req, body, etag, content_type, gz_body=None):
+        accept = req.get_header('Accept-Encoding') or ''
+        gzipped = 'gzip' in accept
+        if etag and gzipped:
+            etag += '-gz'
+        if etag:
+            etag = '"%s"' % etag
+            if req.get_header('If-None-Match') == etag:
+                req.send_response(304)
+                req.send_header('ETag', etag)
+                req.end_headers()
+                raise RequestDone
+        if gzipped:
+            body = gz_body or compress(body)
         req.send_response(200)
         req.send_header('Content-Type', content_type)
+        req.send_header('Content-Length', len(body))
+        req.send_header('Vary', 'Accept-Encoding')
+        if gzipped:
+            req.send_header('Content-Encoding', 'gzip')
+        if etag:
+            req.send_header('ETag', etag)
+            req.send_header('Cache-Control', 'private, must-revalidate')
         req.end_headers()
-        req.write(data+CRLF)
+        req.write(body)
         raise RequestDone
 
+    def _send_catalog(self, req):
+        """The domain/host/category tree in one response, optionally
+        limited to `?domain=` and `?host=`."""
+        allowed = self._allowed_domains(req)
+        key = (req.args.get('domain'), req.args.get('host'), allowed)
+        mtime = self._datafile_mtime()
+        cached = self._catalogs.get(key)
+        if not cached or cached[0] != mtime:
+            if len(self._catalogs) > 256:
+                self._catalogs.clear()
+            catalog = self._catalog(*key)
+            body = simplejson.dumps(catalog)
+            etag = hashlib.md5((u'%s:%s:%s:%s:%s' % (catalog['version'], mtime,
+                                key[0], key[1], ','.join(sorted(allowed)))
+                                ).encode('utf-8')).hexdigest()
+            cached = (mtime, etag, body, compress(body))
+            self._catalogs[key] = cached
+        mtime, etag, body, gz_body = cached
+        self._send_body(req, body, etag, 'application/json', gz_body)
+
+    def _send_search(self, req):
+        """typeahead over domain, host, category and label names,
+        `?q=<text>&limit=<n>`"""
+        try:
+            limit = min(int(req.args.get('limit', 20)), 200)
+        except ValueError:
+            limit = 20
+        index = self._get_search_index()
+        res = []
+        for doc in index.search(req.args.get('q', ''), limit,
+                                self._allowed_domains(req)):
+            match = {'kind': doc[0]}
+            match.update(zip(('domain', 'host', 'cat', 'label'), doc[1:]))
+            res.append(match)
+        self._send_json(req, res)
+
+    def _get_search_index(self):
+        """the search index, updated with the changes in `datafile`"""
+        stats = self.get_available_stats()
+        if self._indexed is not stats:
+            added, removed = self._search_index.update(documents(stats))
+            self._indexed = stats
+            self.log.debug("MUNIN: search index updated, %d added, %d removed" % (
+                           added, removed))
+        return self._search_index
+
+    def _catalog(self, domain=None, host=None, allowed=()):
+        raw = self.get_available_stats()
+        tree = {}
+        for dom, nodes in raw.items():
+            if dom not in allowed or (domain and dom != domain):
+                continue
+            tree[dom] = {}
+            for node, entries in nodes.items():
+                if host and node != host:
+                    continue
+                tree[dom][node] = sorted(set([e['cat'] for e in entries
+                                              if 'cat' in e]))
+        return {'version': raw['version'], 'domains': tree}
+
+    def _datafile_mtime(self):
+        try:
+            return os.stat(joinpath(self.rrd_path, 'datafile')).st_mtime
+        except OSError:
+            return 0
+
     def get_available_stats(self):
+        """parse `datafile`, the result is cached until its mtime changes"""
+        mtime = self._datafile_mtime()
         try:
-            last = self._lastrun
-            now = time.time()
-            if now - last < 15: # ten seconds
+            if self._cached_mtime == mtime:
                 return self._cached
         except AttributeError:
             pass
@@ -219,13 +353,51 @@ class MuninStatsViewer(Component):
                 continue
             if not node in data[dom].keys():
                 data[dom].update({node:[]})
-            else:
-                data[dom][node].append({'cat':cat, 'label':label, 'value':value})
+            data[dom][node].append({'cat':cat, 'label':label, 'value':value})
 
-        self._lastrun = time.time()
+        self._cached_mtime = mtime
         self._cached = data
         return data
- 
 
-        
 
+def view_action(domain):
+    """the permission needed to see a munin domain"""
+    return 'VIEW_MUNIN_' + domain.upper()
+
+
+class PermissionIndex(object):
+    """The `VIEW_MUNIN_<DOMAIN>` action of each munin domain (hostgroup).
+
+    Built once per version of `datafile`. The domains visible with a set
+    of permissions are an intersection with the set of actions, the
+    result is kept per permission set, so users sharing permissions
+    share it.
+    """
+
+    def __init__(self, stats):
+        self.stats = stats
+        self._domains = {} # action -> domains
+        for dom in stats:
+            if dom != 'version':
+                self._domains.setdefault(view_action(dom), []).append(dom)
+        self.actions = sorted(self._domains)
+        self._actions = frozenset(self.actions)
+        self._allowed = {} # permission set -> visible domains
+
+    def allowed(self, permissions):
+        """the domains visible with `permissions` (a frozenset)"""
+        domains = self._allowed.get(permissions)
+        if domains is None:
+            domains = []
+            for action in self._actions & permissions:
+                domains += self._domains[action]
+            domains = self._allowed[permissions] = frozenset(domains)
+        return domains
+
+
+def compress(body):
+    buf = StringIO()
+    gz = gzip.GzipFile(fileobj=buf, mode='wb', compresslevel=6)
+    gz.write(body)
+    gz.close()
+    return buf.getvalue()
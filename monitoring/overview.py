@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
+"""Rollups for the fleet overview on /monit.
+
+The tables `overview_service` (latest sample per service) and
+`overview_count` (number of services per host, group and status class)
+are updated by the collector for every sample it stores, so rendering
+the overview never touches the history tables.
+"""
+
+# columns of the service tables we keep in the latest-sample rollup
+rollup_columns = {
+    3: {'cpu_percent': 'cpu_percent', 'memory_percent': 'memory_percent'},
+    0: {'block_percent': 'block_percent'},
+}
+
+def status_class(status):
+    """monit reports a bitmask of failed checks, 0 means everything is fine"""
+    if status:
+        return 'error'
+    return 'ok'
+
+def _bump(cur, monit_id, groupname, s_class, delta):
+    cur.execute("UPDATE overview_count SET count=count+? WHERE monit_id=? "
+                "AND groupname=? AND status_class=?",
+                (delta, monit_id, groupname, s_class))
+    if not cur.rowcount and delta > 0:
+        cur.execute("INSERT INTO overview_count (monit_id, groupname, "
+                    "status_class, count) VALUES (?,?,?,?)",
+                    (monit_id, groupname, s_class, delta))
+
+def update_service(cur, monit_id, service_type, values):
+    """Fold one service sample into the rollups, samples older than the
+    one in `overview_service` (backfilled documents) are left out.
+
+    @param values, the flattened row just written to the service table
+    """
+    name = values['name']
+    groupname = values.get('groupname') or ''
+    status = values.get('status', 0) or 0
+    s_class = status_class(status)
+
+    cur.execute("SELECT groupname, status_class, collected_sec FROM "
+                "overview_service WHERE monit_id=? AND type=? AND name=?",
+                (monit_id, service_type, name))
+    old = cur.fetchone()
+    if old and old['collected_sec'] > values['collected_sec']:
+        return
+    if not old:
+        _bump(cur, monit_id, groupname, s_class, 1)
+    elif (old['groupname'], old['status_class']) != (groupname, s_class):
+        _bump(cur, monit_id, old['groupname'], old['status_class'], -1)
+        _bump(cur, monit_id, groupname, s_class, 1)
+
+    row = {'monit_id': monit_id, 'type': service_type, 'name': name,
+           'groupname': groupname, 'status': status,
+           'status_class': s_class,
+           'status_message': values.get('status_message'),
+           'collected_sec': values['collected_sec']}
+    for src, dst in rollup_columns.get(service_type, {}).items():
+        row[dst] = values.get(src)
+    cur.execute("INSERT OR REPLACE INTO overview_service (%s) VALUES (%s)" % (
+                ",".join(row.keys()), ",".join(['?']*len(row))),
+                tuple(row.values()))
+
+def get_overview(cur, top=10, fs_threshold=90):
+    """Return the data for the overview page.
+
+    All queries hit the rollup tables through their indexes, the cost
+    depends on `top` and the number of hits, not on the history size.
+    """
+    cur.execute("SELECT m.localhostname AS host, c.groupname, "
+                "c.status_class, c.count FROM overview_count c "
+                "JOIN monit m ON m.id = c.monit_id WHERE c.count > 0 "
+                "ORDER BY m.localhostname, c.groupname")
+    counts = {}
+    for r in cur.fetchall():
+        key = (r['host'], r['groupname'])
+        counts.setdefault(key, {'host': r['host'], 'group': r['groupname'],
+                                'ok': 0, 'error': 0})
+        counts[key][r['status_class']] = r['count']
+    counts = [counts[k] for k in sorted(counts.keys())]
+
+    def top_by(column, service_type, limit, threshold=None):
+        sql = "SELECT m.localhostname AS host, o.* FROM overview_service o " \
+              "JOIN monit m ON m.id = o.monit_id WHERE o.type=? " \
+              "AND o.%s IS NOT NULL" % column
+        args = [service_type]
+        if threshold is not None:
+            sql += " AND o.%s >= ?" % column
+            args.append(threshold)
+        sql += " ORDER BY o.%s DESC" % column
+        if limit:
+            sql += " LIMIT ?"
+            args.append(limit)
+        cur.execute(sql, tuple(args))
+        return cur.fetchall()
+
+    return {'counts': counts,
+            'top_cpu': top_by('cpu_percent', 3, top),
+            'top_memory': top_by('memory_percent', 3, top),
+            'full_filesystems': top_by('block_percent', 0, top, fs_threshold),
+            'fs_threshold': fs_threshold}
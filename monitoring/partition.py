@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
+"""Time partitioned history for monit.db.
+
+With partitioning enabled the history tables (`*_service`, `host_port`,
+`host_icmp` and `event`) are written to one SQLite file per day or week
+below `db/monit-partitions/`. The `monit` table, the rollups and the
+catalog of partitions (`monit_partition`) stay in `monit.db`. Partition
+files are attached to a connection on demand and detached again with
+`release()`, expiring old data is a matter of deleting files.
+
+The sqlite module commits the open transaction before ATTACH, DETACH
+and PRAGMA statements unless the connection was opened with
+`isolation_level=None`. Writers use such connections and attach the
+partitions a document needs with `prepare()` before its first write,
+the attached names are tracked here instead of asking the connection.
+"""
+
+import os, time
+from ConfigParser import ConfigParser
+
+import db
+
+joinpath = os.path.join
+
+DAY = 86400
+
+# name: (length, offset of the first period from the epoch)
+schemes = {
+    'day': (DAY, 0),
+    'week': (7*DAY, 4*DAY), # 1970-01-01 was a thursday, weeks start on monday
+}
+
+def from_env(env_path, log, scheme=None, keep=None):
+    """The `Partitions` of the Trac environment at `env_path` as set by
+    `[monit] partition` and `partition_keep` in its trac.ini, None if the
+    history is not partitioned. `scheme` and `keep` override them, for
+    the standalone tools which can't use the Trac config."""
+    config = ConfigParser()
+    config.read(joinpath(env_path, 'conf', 'trac.ini'))
+    def setting(name, default):
+        if config.has_option('monit', name):
+            return config.get('monit', name)
+        return default
+    scheme = scheme or setting('partition', 'none')
+    if keep is None:
+        keep = int(setting('partition_keep', 0))
+    if scheme not in schemes:
+        if scheme != 'none':
+            log.warning("Unknown partition scheme '%s', not partitioning" % scheme)
+        return None
+    return Partitions(joinpath(env_path, 'db', 'monit.db'), scheme, log, keep)
+
+
+class Partitions(object):
+
+    def __init__(self, db_path, scheme, log, keep=0):
+        """@param db_path, path of monit.db
+           @param scheme, one of `schemes`
+           @param keep, number of partitions to keep, 0 keeps everything"""
+        self.span, self.offset = schemes[scheme]
+        self.dir = joinpath(os.path.dirname(db_path), 'monit-partitions')
+        self.log = log
+        self.keep = keep
+        self.on_expire = [] # called with the name of each dropped partition
+        self._known = set() # partition files with a current schema
+        self._attached = {} # connection -> set of attached names
+        self._created = set() # connections which added a partition
+
+    def bounds(self, ts):
+        """return (start, end) of the partition containing `ts`"""
+        start = ts - (ts - self.offset) % self.span
+        return start, start + self.span
+
+    def name(self, start):
+        return time.strftime('p%Y%m%d', time.gmtime(start))
+
+    def path(self, name):
+        return joinpath(self.dir, name + '.db')
+
+    def prepare(self, conn, timestamps):
+        """Attach the partitions for rows collected at `timestamps`,
+        creating them as needed. Call before the first write of a
+        document, `prefix()` only looks the names up."""
+        for ts in timestamps:
+            start, end = self.bounds(int(ts))
+            name = self.name(start)
+            if name not in self._attached.get(conn, ()):
+                self._create(conn, name, start, end)
+                self._attach(conn, name)
+
+    def prefix(self, conn, ts):
+        """Return the table prefix for history rows collected at `ts`,
+        the partition was attached by `prepare()`."""
+        return self.name(self.bounds(int(ts))[0]) + '.'
+
+    def overlapping(self, conn, start, stop):
+        """names of the partitions overlapping [start, stop]"""
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM monit_partition WHERE end_sec > ? "
+                    "AND start_sec <= ? ORDER BY start_sec", (start, stop))
+        return [r['name'] for r in cur.fetchall()]
+
+    def iter_range(self, conn, start, stop):
+        """Yield the table prefix of every schema holding history for
+        [start, stop]: '' for rows written before partitioning was
+        enabled, then each overlapping partition. Only one partition is
+        attached at a time."""
+        yield ''
+        for name in self.overlapping(conn, start, stop):
+            self._attach(conn, name)
+            try:
+                yield name + '.'
+            finally:
+                self._detach(conn, name)
+
+    def release(self, conn):
+        """detach all partitions, call after commit or rollback. Drops
+        old partitions if one was added."""
+        for name in list(self._attached.pop(conn, ())):
+            conn.execute("DETACH DATABASE %s" % name)
+        if conn in self._created:
+            self._created.discard(conn)
+            self.expire(conn)
+
+    def expire(self, conn):
+        """Drop the oldest partitions beyond `keep`, returns their names.
+        Call without a transaction open on `conn`."""
+        if not self.keep:
+            return []
+        cur = conn.cursor()
+        cur.execute("SELECT name FROM monit_partition ORDER BY start_sec DESC")
+        names = [r['name'] for r in cur.fetchall()][self.keep:]
+        attached = self._attached.get(conn, ())
+        for name in names:
+            if name in attached:
+                self._detach(conn, name)
+            cur.execute("DELETE FROM monit_partition WHERE name=?", (name,))
+            conn.commit()
+            self._known.discard(name)
+            path = self.path(name)
+            if os.path.exists(path):
+                os.unlink(path)
+            for callback in self.on_expire:
+                callback(name)
+            self.log.info("Dropped monit partition %s" % name)
+        return names
+
+    # Internal methods
+
+    def _create(self, conn, name, start, end):
+        if name not in self._known:
+            if not os.path.isdir(self.dir):
+                os.makedirs(self.dir)
+            # every partition carries the full schema, only the history
+            # tables are used. Existing files are upgraded on first use.
+            db.ensure_schema(self.path(name), self.log)
+            self._known.add(name)
+        # part of the transaction, registered again if it is rolled back
+        cur = conn.cursor()
+        cur.execute("INSERT OR IGNORE INTO monit_partition "
+                    "(name, start_sec, end_sec) VALUES (?,?,?)",
+                    (name, start, end))
+        if cur.rowcount == 1:
+            self.log.info("Created monit partition %s" % name)
+            self._created.add(conn)
+
+    def _attach(self, conn, name):
+        attached = self._attached.setdefault(conn, set())
+        if name not in attached:
+            conn.execute("ATTACH DATABASE ? AS %s" % name, (self.path(name),))
+            attached.add(name)
+
+    def _detach(self, conn, name):
+        conn.execute("DETACH DATABASE %s" % name)
+        attached = self._attached.get(conn)
+        if attached is not None:
+            attached.discard(name)
+            if not attached:
+                del self._attached[conn]
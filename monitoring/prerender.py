@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
+"""Render munin graphs before anyone asks for them.
+
+`MuninStatsViewer` records every graph request in `db/munin.db`. After
+munin-update has written new data (the mtime of `datafile` changed) the
+most requested host/category/period combinations are rendered on a pool
+of niced worker threads, `_send_values` then serves the stored images
+until the next update.
+
+Run `munin-prerender /path/to/tracenv` from munin-cron after
+munin-update, or enable `[munin] prerender` to let Trac watch datafile.
+"""
+
+import logging, os, shutil, sys, threading, time
+from ConfigParser import ConfigParser
+from optparse import OptionParser
+from pipes import quote
+from Queue import Queue
+from subprocess import Popen, PIPE
+
+from db import sqlite
+
+joinpath = os.path.join
+
+period_mapping = {
+        'daily':'--noweek --nomonth --noyear',
+        'weekly':'--noday --nomonth --noyear',
+        'monthly':'--noday --noweek --noyear',
+        'yearly':'--noday --noweek --nomonth'
+    }
+
+tables = [
+"""
+CREATE TABLE IF NOT EXISTS graph_request (
+    domain VARCHAR(255) NOT NULL,
+    host VARCHAR(255) NOT NULL,
+    cat VARCHAR(255) NOT NULL,
+    period VARCHAR(16) NOT NULL,
+    hits REAL NOT NULL,
+    last_sec INTEGER NOT NULL,
+    PRIMARY KEY (domain, host, cat, period));
+""",
+"""
+CREATE TABLE IF NOT EXISTS graph_render (
+    domain VARCHAR(255) NOT NULL,
+    host VARCHAR(255) NOT NULL,
+    cat VARCHAR(255) NOT NULL,
+    period VARCHAR(16) NOT NULL,
+    rendered_sec INTEGER NOT NULL,
+    images TEXT NOT NULL,
+    PRIMARY KEY (domain, host, cat, period));
+""",
+"""
+CREATE TABLE IF NOT EXISTS prerender_state (
+    name VARCHAR(64) PRIMARY KEY,
+    value INTEGER NOT NULL);
+""",
+]
+
+def render_graphs(host, cat, period, picdir, log, nice=False):
+    """Run munin-graph for the comma separated hosts and categories and
+    copy the images to `picdir`, returns the new file names."""
+    args = ['/usr/share/munin/munin-graph', '--list-images'] + \
+           period_mapping[period].split()
+    for h in host.split(','):
+        args += ['--host', h]
+    for c in cat.split(','):
+        args += ['--service', c]
+    # su hands the command to the shell of munin, quote every argument
+    cmd = ['su', '-p', '-c', ' '.join([quote(a) for a in args]), 'munin']
+    if nice:
+        cmd = ['nice', '-n', '19'] + cmd
+    p = Popen(cmd, close_fds=True, stdout=PIPE, stderr=PIPE)
+    log.debug('munin command executed was: %s' % cmd)
+
+    if not os.path.isdir(picdir):
+        os.mkdir(picdir)
+    pics = [pic.strip() for pic in p.stdout.readlines()]
+    log.debug("OUTPUT from popen call to munin-graph: %s (stderr: %s" % (pics, p.stderr.read()))
+    p.wait()
+    new_pics = []
+    for pic in pics:
+        #newer munin breaks naming, join host and metric
+        parts = pic.split('/')
+        new_name = '-'.join(parts[-2:])
+        new_pics.append(new_name)
+        shutil.copy(pic, joinpath(picdir, new_name))
+    return new_pics
+
+
+class GraphCache(object):
+    """Request statistics and rendered images in db/munin.db"""
+
+    def __init__(self, env_path, rrd_path, log, half_life=7*86400):
+        """@param half_life, seconds after which a request counts half"""
+        self.path = joinpath(env_path, 'db', 'munin.db')
+        self.picdir = joinpath(env_path, 'htdocs', 'munin')
+        self.datafile = joinpath(rrd_path, 'datafile')
+        self.log = log
+        self.half_life = half_life
+
+    _created = set() # paths with the tables, per process
+
+    def _cnx(self):
+        cnx = sqlite.connect(self.path, timeout=10000)
+        if self.path not in self._created:
+            for stmt in tables:
+                cnx.execute(stmt)
+            cnx.commit()
+            self._created.add(self.path)
+        return cnx
+
+    def data_mtime(self):
+        try:
+            return int(os.stat(self.datafile).st_mtime)
+        except OSError:
+            return 0
+
+    def record(self, domain, host, cat, period):
+        """count a request for a graph, older requests decay"""
+        now = int(time.time())
+        cnx = self._cnx()
+        try:
+            row = cnx.execute("SELECT hits, last_sec FROM graph_request WHERE "
+                              "domain=? AND host=? AND cat=? AND period=?",
+                              (domain, host, cat, period)).fetchone()
+            hits = 1.0
+            if row:
+                hits += row[0] * 0.5 ** (float(now - row[1]) / self.half_life)
+            cnx.execute("INSERT OR REPLACE INTO graph_request (domain, host, "
+                        "cat, period, hits, last_sec) VALUES (?,?,?,?,?,?)",
+                        (domain, host, cat, period, hits, now))
+            cnx.commit()
+        finally:
+            cnx.close()
+
+    def lookup(self, domain, host, cat, period):
+        """Return the image names if they were rendered after the last
+        munin-update and still exist, None otherwise."""
+        cnx = self._cnx()
+        try:
+            row = cnx.execute("SELECT rendered_sec, images FROM graph_render "
+                              "WHERE domain=? AND host=? AND cat=? AND period=?",
+                              (domain, host, cat, period)).fetchone()
+        finally:
+            cnx.close()
+        if not row or row[0] < self.data_mtime():
+            return None
+        images = [i for i in row[1].split('\n') if i]
+        for i in images:
+            if not os.path.exists(joinpath(self.picdir, i)):
+                return None
+        return images
+
+    def store(self, domain, host, cat, period, images, rendered_sec):
+        cnx = self._cnx()
+        try:
+            cnx.execute("INSERT OR REPLACE INTO graph_render (domain, host, "
+                        "cat, period, rendered_sec, images) VALUES (?,?,?,?,?,?)",
+                        (domain, host, cat, period, rendered_sec,
+                         '\n'.join(images)))
+            cnx.commit()
+        finally:
+            cnx.close()
+
+    def popular(self, limit):
+        """the `limit` most requested (domain, host, cat, period)"""
+        now = time.time()
+        cnx = self._cnx()
+        try:
+            rows = cnx.execute("SELECT domain, host, cat, period, hits, "
+                               "last_sec FROM graph_request").fetchall()
+        finally:
+            cnx.close()
+        ranked = [(hits * 0.5 ** ((now - last) / self.half_life), key)
+                  for key, hits, last in [(r[:4], r[4], r[5]) for r in rows]]
+        ranked.sort(reverse=True)
+        return [key for score, key in ranked[:limit]]
+
+    def claim_update(self):
+        """Return the datafile mtime if no one rendered graphs for it yet
+        and mark it as taken, None otherwise. Several Trac processes and
+        munin-cron may race for it, only one wins."""
+        mtime = self.data_mtime()
+        if not mtime:
+            return None
+        cnx = self._cnx()
+        try:
+            cnx.execute("INSERT OR IGNORE INTO prerender_state (name, value) "
+                        "VALUES ('data_mtime', 0)")
+            cur = cnx.execute("UPDATE prerender_state SET value=? WHERE "
+                              "name='data_mtime' AND value<?", (mtime, mtime))
+            cnx.commit()
+            if cur.rowcount == 1:
+                return mtime
+            return None
+        finally:
+            cnx.close()
+
+
+class Prerenderer(object):
+    """Render the popular graphs once per munin-update"""
+
+    def __init__(self, cache, log, top=50, workers=2):
+        self.cache = cache
+        self.log = log
+        self.top = top
+        self.workers = workers
+
+    def run_once(self):
+        """Render if datafile changed, returns the number of graphs"""
+        mtime = self.cache.claim_update()
+        if mtime is None:
+            return 0
+        keys = self.cache.popular(self.top)
+        self.log.info("Pre-rendering %d munin graphs" % len(keys))
+        queue = Queue()
+        for key in keys:
+            queue.put(key)
+        threads = [threading.Thread(target=self._work, args=(queue,))
+                   for i in range(min(self.workers, len(keys)))]
+        for t in threads:
+            queue.put(None) # one stop marker per worker
+            t.setDaemon(True)
+            t.start()
+        for t in threads:
+            t.join()
+        return len(keys)
+
+    def _work(self, queue):
+        while True:
+            key = queue.get()
+            if key is None:
+                return
+            domain, host, cat, period = key
+            try:
+                started = int(time.time())
+                images = render_graphs(host, cat, period, self.cache.picdir,
+                                       self.log, nice=True)
+                self.cache.store(domain, host, cat, period, images, started)
+            except Exception, e:
+                self.log.warning("Pre-rendering %s/%s/%s (%s) failed: %s" % (
+                                 domain, host, cat, period, e))
+
+
+class Watcher(threading.Thread):
+    """Poll the datafile mtime and pre-render after each change"""
+
+    def __init__(self, prerenderer, interval, log):
+        threading.Thread.__init__(self, name='munin-prerender')
+        self.setDaemon(True)
+        self.prerenderer = prerenderer
+        self.interval = interval
+        self.log = log
+
+    def run(self):
+        while True:
+            try:
+                self.prerenderer.run_once()
+            except Exception, e:
+                self.log.warning("munin pre-render failed: %s" % e)
+            time.sleep(self.interval)
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options] /path/to/tracenv')
+    parser.add_option('-r', '--rrd-path', default=None,
+                      help='munin data directory [[munin] rrd_path from '
+                           'trac.ini or /var/lib/munin]')
+    parser.add_option('-n', '--top', type='int', default=50,
+                      help='number of graphs to render [%default]')
+    parser.add_option('-w', '--workers', type='int', default=2,
+                      help='parallel munin-graph processes [%default]')
+    parser.add_option('-v', '--verbose', action='store_true', default=False)
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('the path of the Trac environment is required')
+    env_path = args[0]
+
+    logging.basicConfig(level=options.verbose and logging.DEBUG or logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+    log = logging.getLogger('munin-prerender')
+
+    rrd_path = options.rrd_path
+    if not rrd_path:
+        config = ConfigParser()
+        config.read(joinpath(env_path, 'conf', 'trac.ini'))
+        if config.has_option('munin', 'rrd_path'):
+            rrd_path = config.get('munin', 'rrd_path')
+        else:
+            rrd_path = '/var/lib/munin'
+
+    cache = GraphCache(env_path, rrd_path, log)
+    count = Prerenderer(cache, log, options.top, options.workers).run_once()
+    log.info("Rendered %d graphs" % count)
+
+if __name__ == '__main__':
+    sys.exit(main())
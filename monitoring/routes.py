@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
+"""Routing table for the monitoring request handlers.
+
+Trac calls `match_request()` of every handler for every request, so
+paths which are not ours must be rejected as cheaply as possible: a
+`str.startswith()` on the route prefix runs before any regex.
+"""
+
+import re
+
+# name: (prefix, compiled pattern)
+routes = {
+    'collector': ('/collector', re.compile(r'/collector(?:/.*)?$')),
+    'monit': ('/monit', re.compile(r'/monit(?:/.*)?$')),
+    'munin': ('/munin', re.compile(r'/munin(?:/.*)?$')),
+    'monitoring': ('/monitoring',
+        re.compile(r'/monitoring(?:/([^/]+))?(?:/([^/]+))?(?:/(.*))?$')),
+}
+
+def match(name, path_info):
+    """Return the match object for route `name` or None"""
+    prefix, pattern = routes[name]
+    if not path_info.startswith(prefix):
+        return None
+    return pattern.match(path_info)
@@ -0,0 +1,180 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
+"""Threshold rules evaluated as samples arrive.
+
+Rules are configured in the `[monit-rules]` section of trac.ini:
+
+    [monit-rules]
+    fs_full = filesystem block_percent > 90
+    fs_full.clear = 85
+    fs_full.message = $name is $block_percent% full
+    load_jump = system rate(load_avg01) > 0.05
+
+A rule names a service type, a column of its `*_service` table (as
+flattened by `MonitIngest`), a comparison and a threshold. `rate(col)`
+compares the change of `col` per second since the previous sample of
+the same service instead. A rule is raised when the comparison becomes
+true and cleared when it is false against `.clear` (the threshold if
+unset), values between the two keep the current state. `.message` may
+refer to the columns of the sample as `$column`.
+
+Every change becomes a row of the `event` table with the rule name in
+`event.rule` (state 1 raised, 0 cleared), the state of each service is
+kept in `rule_state` and read in the transaction storing the sample, so
+rollbacks and other collector processes are seen. Rules are compiled
+once per service type, each sample costs a primary key lookup and a
+comparison per rule. `rate()` uses the previous sample this process
+stored, samples of a rolled back transaction are forgotten.
+"""
+
+import operator, re
+from string import Template
+
+from ingest import srv_types
+
+operators = {
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+    '==': operator.eq,
+    '!=': operator.ne,
+}
+
+_expr_re = re.compile(r'^\s*(\w+)\s+(?:rate\((\w+)\)|(\w+))\s*'
+                      r'(>=|<=|==|!=|>|<)\s*(-?[\d.]+)\s*$')
+
+srv_numbers = dict([(v, k) for k, v in srv_types.items()])
+
+
+class Rule(object):
+
+    def __init__(self, name, service_type, column, op, threshold, clear=None,
+                 rate=False, message=None):
+        self.name = name
+        self.service_type = service_type
+        self.column = column
+        self.op = op
+        self.compare = operators[op]
+        self.threshold = threshold
+        if clear is None:
+            clear = threshold
+        self.clear = clear
+        self.rate = rate
+        self.message = message and Template(message)
+
+    def describe(self, value):
+        column = self.rate and 'rate(%s)' % self.column or self.column
+        return "%s %s %g %s %g" % (self.name, column, value, self.op,
+                                   self.threshold)
+
+
+def parse_rules(options):
+    """Compile (option, value) pairs of `[monit-rules]`, returns a dict
+    service type -> list of rules. Raises ValueError for bad rules."""
+    extra = {}
+    exprs = []
+    for option, value in options:
+        if '.' in option:
+            name, attr = option.split('.', 1)
+            extra.setdefault(name, {})[attr] = value
+        else:
+            exprs.append((option, value))
+    compiled = {}
+    for name, expr in exprs:
+        match = _expr_re.match(expr)
+        if not match:
+            raise ValueError("Invalid rule %s: '%s'" % (name, expr))
+        type_name, rate_col, col, op, threshold = match.groups()
+        if type_name not in srv_numbers:
+            raise ValueError("Invalid rule %s: unknown service type '%s'" % (
+                             name, type_name))
+        attrs = extra.get(name, {})
+        clear = attrs.get('clear')
+        if clear is not None:
+            clear = float(clear)
+        rule = Rule(name, srv_numbers[type_name], rate_col or col, op,
+                    float(threshold), clear, bool(rate_col), attrs.get('message'))
+        compiled.setdefault(rule.service_type, []).append(rule)
+    return compiled
+
+
+class RuleEngine(object):
+
+    def __init__(self, rules, log):
+        """@param rules, as returned by `parse_rules`"""
+        self.rules = rules
+        self.log = log
+        self._last = {} # (column, monit_id, type, name) -> (sec, value)
+        self._pending = {} # connection -> samples for _last not committed
+
+    def __nonzero__(self):
+        return bool(self.rules)
+
+    def evaluate(self, cur, monit_id, service_type, service_id, values):
+        """Check the rules for one stored sample, `values` are the columns
+        of its `*_service` row. Must run in the transaction storing it.
+        Returns the `event` rows to store for the changes."""
+        events = []
+        rules = self.rules.get(service_type)
+        if not rules:
+            return events
+        pending = self._pending.setdefault(cur.connection, {})
+        name = values['name']
+        sec = values['collected_sec']
+        previous = {}
+        for rule in rules:
+            value = values.get(rule.column)
+            if value is None:
+                continue
+            if rule.rate:
+                series = (rule.column, monit_id, service_type, name)
+                if series not in previous:
+                    previous[series] = pending.get(series,
+                                                   self._last.get(series))
+                    pending[series] = (sec, value)
+                last = previous[series]
+                if last is None or sec <= last[0]:
+                    continue
+                value = float(value - last[1]) / (sec - last[0])
+            key = (rule.name, monit_id, service_type, name)
+            if self._active(cur, key):
+                if not rule.compare(value, rule.clear):
+                    events.append(self._change(cur, rule, key, service_id,
+                                               values, value, 0))
+            elif rule.compare(value, rule.threshold):
+                events.append(self._change(cur, rule, key, service_id, values,
+                                           value, 1))
+        return events
+
+    def commit(self, conn):
+        self._last.update(self._pending.pop(conn, {}))
+
+    def rollback(self, conn):
+        self._pending.pop(conn, None)
+
+    # Internal methods
+
+    def _active(self, cur, key):
+        cur.execute("SELECT active FROM rule_state WHERE rule=? AND "
+                    "monit_id=? AND type=? AND name=?", key)
+        row = cur.fetchone()
+        return row and row['active']
+
+    def _change(self, cur, rule, key, service_id, values, value, state):
+        sec = values['collected_sec']
+        message = rule.describe(value)
+        if state and rule.message:
+            message = rule.message.safe_substitute(dict([(k, isinstance(v, float)
+                                        and '%g' % v or v) for k, v in values.items()]))
+        elif not state:
+            message = "cleared: " + message
+        self.log.debug("Rule %s %s for %s" % (rule.name,
+                       state and 'raised' or 'cleared', values['name']))
+        cur.execute("INSERT OR REPLACE INTO rule_state (rule, monit_id, type, "
+                    "name, active, changed_sec) VALUES (?,?,?,?,?,?)",
+                    key + (state, sec))
+        return {'service_id': service_id, 'type': rule.service_type,
+                'collected_sec': sec, 'last_sec': sec, 'state': state,
+                'message': message,
+                'groupname': values.get('groupname'), 'rule': rule.name}
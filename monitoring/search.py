@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
+"""In-memory search over munin domain, host, category and label names.
+
+Documents are tuples `(kind, domain[, host[, cat[, label]]])`, the
+searchable term is the last element. The index works on distinct terms
+(most labels repeat on every host): a sorted list answers prefix
+queries with bisect, a trigram map narrows substring queries down to a
+few candidate terms which are then checked with `in`. Substrings are
+only looked at if the prefix matches do not fill the result, and at
+most `limit * 5` terms are ranked per query.
+"""
+
+import heapq, threading
+from bisect import bisect_left, insort
+
+# rank of the document kinds, lower ranks first
+kinds = {'domain': 0, 'host': 1, 'cat': 2, 'label': 3}
+
+separators = '.-_ '
+
+def trigrams(term):
+    return set([term[i:i+3] for i in range(len(term) - 2)])
+
+def documents(stats):
+    """Documents for the data returned by `get_available_stats()`"""
+    docs = set()
+    for dom, nodes in stats.items():
+        if dom == 'version':
+            continue
+        docs.add(('domain', dom))
+        for node, entries in nodes.items():
+            docs.add(('host', dom, node))
+            for e in entries:
+                docs.add(('cat', dom, node, e['cat']))
+                docs.add(('label', dom, node, e['cat'], e['label']))
+    return docs
+
+
+class SearchIndex(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._docs = set()
+        self._terms = {} # term -> {kind: sorted list of documents}
+        self._sorted = [] # all terms
+        self._grams = {} # trigram -> set of terms
+
+    def __len__(self):
+        return len(self._docs)
+
+    def update(self, docs):
+        """Make the index contain exactly `docs`, only the difference to
+        the current content is applied. Returns (added, removed)."""
+        docs = set(docs)
+        self._lock.acquire()
+        try:
+            added = docs - self._docs
+            removed = self._docs - docs
+            if not self._docs:
+                # initial build, sort once instead of insort per term
+                for doc in added:
+                    self._add(doc, sort=False)
+                self._sorted.sort()
+                for groups in self._terms.values():
+                    for group in groups.values():
+                        group.sort()
+            else:
+                for doc in removed:
+                    self._remove(doc)
+                for doc in added:
+                    self._add(doc)
+            self._docs = docs
+        finally:
+            self._lock.release()
+        return len(added), len(removed)
+
+    def search(self, query, limit=20, domains=None):
+        """Return up to `limit` documents matching `query`, exact matches
+        first, then prefixes, word prefixes and other substrings. Ties
+        are broken by kind and the length of the term. With `domains`
+        (a set) only documents of these domains are returned."""
+        q = query.strip().lower()
+        if not q:
+            return []
+        cap = limit * 5
+        self._lock.acquire()
+        try:
+            # rank (term, kind) groups, expand only as many as needed
+            groups = []
+            found = 0
+            for term in self._prefixed(q, cap):
+                match = term != q and 1 or 0
+                for kind, docs in self._terms[term].items():
+                    docs = self._visible(docs, domains)
+                    if docs:
+                        groups.append((match, kinds[kind], len(term), term, docs))
+                        found += len(docs)
+            if len(q) >= 3 and found < limit:
+                for term in self._containing(q, cap):
+                    if term.startswith(q):
+                        continue # already a prefix match
+                    match = 3
+                    for s in separators:
+                        if s + q in term:
+                            match = 2
+                            break
+                    for kind, docs in self._terms[term].items():
+                        docs = self._visible(docs, domains)
+                        if docs:
+                            groups.append((match, kinds[kind], len(term), term,
+                                           docs))
+            result = []
+            for group in heapq.nsmallest(limit, groups):
+                result.extend(group[-1][:limit - len(result)])
+                if len(result) >= limit:
+                    break
+        finally:
+            self._lock.release()
+        return result
+
+    # Internal methods
+
+    def _visible(self, docs, domains):
+        if domains is None:
+            return docs
+        return [d for d in docs if d[1] in domains]
+
+    def _prefixed(self, q, limit):
+        terms = []
+        i = bisect_left(self._sorted, q)
+        while i < len(self._sorted) and len(terms) < limit:
+            term = self._sorted[i]
+            if not term.startswith(q):
+                break
+            terms.append(term)
+            i += 1
+        return terms
+
+    def _containing(self, q, limit):
+        sets = []
+        for gram in trigrams(q):
+            terms = self._grams.get(gram)
+            if not terms:
+                return []
+            sets.append(terms)
+        # the rarest trigram has the fewest candidates, `in` checks the rest
+        terms = []
+        for t in min(sets, key=len):
+            if q in t:
+                terms.append(t)
+                if len(terms) >= limit:
+                    break
+        return terms
+
+    def _add(self, doc, sort=True):
+        term = doc[-1].lower()
+        groups = self._terms.get(term)
+        if groups is None:
+            groups = self._terms[term] = {}
+            if sort:
+                insort(self._sorted, term)
+            else:
+                self._sorted.append(term)
+            for gram in trigrams(term):
+                self._grams.setdefault(gram, set()).add(term)
+        docs = groups.setdefault(doc[0], [])
+        if sort:
+            insort(docs, doc)
+        else:
+            docs.append(doc)
+
+    def _remove(self, doc):
+        term = doc[-1].lower()
+        groups = self._terms.get(term)
+        docs = groups and groups.get(doc[0])
+        if not docs:
+            return
+        i = bisect_left(docs, doc)
+        if i == len(docs) or docs[i] != doc:
+            return
+        del docs[i]
+        if not docs:
+            del groups[doc[0]]
+        if not groups:
+            del self._terms[term]
+            i = bisect_left(self._sorted, term)
+            if i < len(self._sorted) and self._sorted[i] == term:
+                del self._sorted[i]
+            for gram in trigrams(term):
+                terms = self._grams.get(gram)
+                if terms is not None:
+                    terms.discard(term)
+                    if not terms:
+                        del self._grams[gram]
@@ -0,0 +1,397 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
+"""Durable spool between the collectors and monit.db.
+
+With `[monit] spool` enabled (or `monit-collectord --spool`) a posted
+document is validated, appended to the spool and acknowledged once it
+is on disk; storing it in monit.db is left to the `Applier`. Agents no
+longer wait for (or lose documents to) a locked database.
+
+The spool is a directory of segment files `<sequence>.log` below
+`db/monit-spool/`. Records are appended to the newest segment, a new
+one is started when it grows beyond the segment size. Each record is
+
+    'MSP1' | payload length (4 bytes) | crc32 of payload (4 bytes) | payload
+
+with the payload `remote address \\t content type \\n document` (records
+without a content type are JSON). Writers in several processes are
+serialised with flock() on `spool.lock`, fsync() is shared by all
+appends waiting for it (group commit).
+
+The applier stores records in batches and writes its position
+(segment, offset) into `spool_state` in the same transaction, after a
+crash it continues from the last commit. A record torn by a crashed
+writer fails its checksum and is skipped up to the next 'MSP1' marker.
+A database error rolls the batch back to be applied again later, a
+record failing `max_attempts` times in a row is set aside in
+`failed/`. Applied segments are deleted. Only one applier works on a spool at a
+time (flock() on `applier.lock`).
+
+Usage: monit-spool [options] /path/to/tracenv
+"""
+
+import fcntl, logging, os, struct, sys, threading, time, zlib
+from ConfigParser import ConfigParser
+from optparse import OptionParser
+
+import db, partition, wire
+from db import sqlite
+from ingest import MonitIngest
+from rules import RuleEngine, parse_rules
+
+joinpath = os.path.join
+
+MAGIC = 'MSP1'
+header = struct.Struct('>4sII')
+
+
+class Spool(object):
+
+    def __init__(self, path, log, segment_size=16*1024*1024):
+        """@param path, the spool directory, created if missing
+           @param segment_size, bytes after which a new segment is started"""
+        self.path = path
+        self.log = log
+        self.segment_size = segment_size
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._lockfile = None
+        self._seq = None
+        self._fd = None
+        self._dirty = [] # fds written to since the last sync
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._written = 0 # number of appends in this process
+        self._synced = 0 # appends covered by a finished fsync()
+        self._syncing = False
+
+    def segment_path(self, seq):
+        return joinpath(self.path, '%012d.log' % seq)
+
+    def segments(self):
+        """sequence numbers of all segments, oldest first"""
+        seqs = []
+        for name in os.listdir(self.path):
+            if name.endswith('.log') and name[:-4].isdigit():
+                seqs.append(int(name[:-4]))
+        seqs.sort()
+        return seqs
+
+    def append(self, remote_addr, raw, sync=True, content_type='application/json'):
+        """Append one document. With `sync` return only after it was
+        fsync()ed, otherwise call `sync()` before acknowledging it."""
+        payload = '%s\t%s\n%s' % (remote_addr or '', content_type, raw)
+        record = header.pack(MAGIC, len(payload),
+                             zlib.crc32(payload) & 0xffffffff) + payload
+        self._lock.acquire()
+        try:
+            if self._lockfile is None:
+                self._lockfile = open(joinpath(self.path, 'spool.lock'), 'a')
+            fcntl.flock(self._lockfile, fcntl.LOCK_EX)
+            try:
+                fd = self._segment(len(record))
+                while record:
+                    record = record[os.write(fd, record):]
+            finally:
+                fcntl.flock(self._lockfile, fcntl.LOCK_UN)
+            if fd not in self._dirty:
+                self._dirty.append(fd)
+            self._written += 1
+            ticket = self._written
+        finally:
+            self._lock.release()
+        if sync:
+            self.sync(ticket)
+
+    def sync(self, ticket=None):
+        """fsync() everything appended so far (or up to append number
+        `ticket`). Concurrent callers share one fsync()."""
+        self._cond.acquire()
+        try:
+            if ticket is None:
+                ticket = self._written
+            while self._synced < ticket:
+                if self._syncing:
+                    self._cond.wait()
+                    continue
+                # lead: sync all that was written up to now
+                self._syncing = True
+                target, fds, self._dirty = self._written, self._dirty, []
+                self._cond.release()
+                try:
+                    for fd in fds:
+                        os.fsync(fd)
+                finally:
+                    self._cond.acquire()
+                    self._syncing = False
+                for fd in fds:
+                    if fd != self._fd and fd not in self._dirty:
+                        os.close(fd) # a rolled over segment
+                self._synced = max(self._synced, target)
+                self._cond.notifyAll()
+        finally:
+            self._cond.release()
+
+    def read(self, seq, offset):
+        """Yield (end offset, remote address, content type, document) for
+        the records of segment `seq` from `offset` on, damaged parts are
+        yielded as (end offset, None, None, None)."""
+        fp = open(self.segment_path(seq), 'rb')
+        try:
+            # appends finish while holding the lock, all records before
+            # the size seen under it are complete
+            lockfile = open(joinpath(self.path, 'spool.lock'), 'a')
+            try:
+                fcntl.flock(lockfile, fcntl.LOCK_EX)
+                size = os.fstat(fp.fileno()).st_size
+            finally:
+                lockfile.close()
+            fp.seek(offset)
+            buf = fp.read(max(size - offset, 0))
+        finally:
+            fp.close()
+        pos = 0
+        while pos < len(buf):
+            end = pos + header.size
+            if end <= len(buf):
+                magic, length, crc = header.unpack(buf[pos:end])
+                if magic == MAGIC and end + length <= len(buf):
+                    payload = buf[end:end + length]
+                    if zlib.crc32(payload) & 0xffffffff == crc:
+                        info, raw = payload.split('\n', 1)
+                        remote_addr, ct = (info.split('\t', 1) +
+                                           [wire.json_types[0]])[:2]
+                        yield offset + end + length, remote_addr, ct, raw
+                        pos = end + length
+                        continue
+            # torn by a crashed writer, continue at the next marker
+            resume = buf.find(MAGIC, pos + 1)
+            if resume < 0:
+                resume = len(buf)
+            self.log.warning("Skipping %d bytes of damaged spool segment "
+                             "%d at %d" % (resume - pos, seq, offset + pos))
+            yield offset + resume, None, None, None
+            pos = resume
+
+    def set_aside(self, seq, offset, remote_addr, content_type, raw):
+        """keep a record which can't be applied in failed/"""
+        path = joinpath(self.path, 'failed')
+        if not os.path.isdir(path):
+            os.mkdir(path)
+        name = '%012d-%d.%s' % (seq, offset, content_type.split('/')[-1])
+        fp = open(joinpath(path, name), 'wb')
+        try:
+            fp.write(raw)
+        finally:
+            fp.close()
+        self.log.warning("Set aside spooled document from %s as failed/%s" % (
+                         remote_addr, name))
+
+    # Internal methods
+
+    def _segment(self, size):
+        """fd of the segment to append `size` bytes to, holding flock"""
+        if self._fd is None or os.path.exists(self.segment_path(self._seq + 1)) \
+                or not os.fstat(self._fd).st_nlink:
+            # first append, another process rolled over or the segment
+            # was applied and removed
+            seqs = self.segments()
+            self._open(seqs and seqs[-1] or 1)
+        used = os.fstat(self._fd).st_size
+        if used and used + size > self.segment_size:
+            self._open(self._seq + 1)
+        return self._fd
+
+    def _open(self, seq):
+        path = self.segment_path(seq)
+        created = not os.path.exists(path)
+        fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0640)
+        if created:
+            dirfd = os.open(self.path, os.O_RDONLY)
+            try:
+                os.fsync(dirfd)
+            finally:
+                os.close(dirfd)
+        if self._fd is not None and self._fd not in self._dirty:
+            self._dirty.append(self._fd) # closed by the next sync()
+        self._fd, self._seq = fd, seq
+
+
+class Applier(object):
+    """Store spooled documents in monit.db"""
+
+    def __init__(self, spool, db_path, log, ingest, batch_size=1000,
+                 max_attempts=5):
+        """@param max_attempts, database errors of one record before it
+           is set aside"""
+        self.spool = spool
+        self.db_path = db_path
+        self.log = log
+        self.ingest = ingest
+        self.batch_size = batch_size
+        self.max_attempts = max_attempts
+        self._lockfile = None
+        self._failing = None # ((segment, offset), attempts) of a record
+
+    def apply(self):
+        """Store everything spooled so far, returns the number of
+        documents or None if another applier is running."""
+        if self._lockfile is None:
+            self._lockfile = open(joinpath(self.spool.path, 'applier.lock'), 'a')
+        try:
+            fcntl.flock(self._lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return None
+        try:
+            db.ensure_schema(self.db_path, self.log)
+            conn = db.connect(self.db_path, isolation_level=None)
+            try:
+                return self._apply(conn)
+            finally:
+                conn.close()
+        finally:
+            fcntl.flock(self._lockfile, fcntl.LOCK_UN)
+
+    def _apply(self, conn):
+        cur = conn.cursor()
+        cur.execute("SELECT segment, offset FROM spool_state WHERE name='spool'")
+        row = cur.fetchone()
+        seg, offset = row and (row['segment'], row['offset']) or (0, 0)
+        seqs = self.spool.segments()
+        if seqs and seqs[-1] < seg:
+            self.log.warning("Spool segments were renumbered, applying all")
+            seg, offset = 0, 0
+        count = pending = stored = 0 # stored: documents since the last commit
+        self.ingest.begin(conn)
+        try:
+            for seq in seqs:
+                if seq < seg:
+                    continue
+                last = seq == seqs[-1]
+                for end, remote_addr, ct, raw in self.spool.read(seq,
+                                            seq == seg and offset or 0):
+                    if raw is None: # damaged, skipped
+                        seg, offset = seq, end
+                        pending += 1
+                        continue
+                    start = (seq, seq == seg and offset or 0)
+                    try:
+                        data = wire.parse(raw, ct)
+                        self.ingest.store(conn, data, remote_addr)
+                    except sqlite.OperationalError, e:
+                        if not self._give_up(start):
+                            raise # locked, retry the batch later
+                        self.spool.set_aside(seq, start[1], remote_addr, ct,
+                                             raw)
+                        seg, offset = seq, end
+                        pending += 1
+                        continue
+                    except Exception, e:
+                        self.log.exception("Failed to store spooled document "
+                                           "from %s: %s" % (remote_addr, e))
+                    seg, offset = seq, end
+                    stored += 1
+                    pending += 1
+                    if pending >= self.batch_size:
+                        self._commit(conn, seg, offset)
+                        self.ingest.begin(conn)
+                        count, pending, stored = count + stored, 0, 0
+                if not last:
+                    seg, offset = seq + 1, 0
+                    pending += 1
+            if pending:
+                self._commit(conn, seg, offset)
+                count += stored
+            else:
+                self.ingest.rollback(conn)
+        except sqlite.OperationalError, e:
+            self.ingest.rollback(conn)
+            self.log.warning("Storing spooled documents failed, will retry: %s" % e)
+        # compaction, segments before the committed position are applied
+        cur.execute("SELECT segment FROM spool_state WHERE name='spool'")
+        row = cur.fetchone()
+        for seq in seqs[:-1]: # writers append to the newest
+            if row and seq < row['segment']:
+                os.unlink(self.spool.segment_path(seq))
+                self.log.debug("Removed applied spool segment %d" % seq)
+        return count
+
+    def _give_up(self, position):
+        """count a database error of the record at `position`, True once
+        it failed `max_attempts` times in a row"""
+        attempts = 1
+        if self._failing and self._failing[0] == position:
+            attempts = self._failing[1] + 1
+        self._failing = (position, attempts)
+        return attempts >= self.max_attempts
+
+    def _commit(self, conn, seg, offset):
+        conn.execute("INSERT OR REPLACE INTO spool_state (name, segment, "
+                     "offset) VALUES ('spool', ?, ?)", (seg, offset))
+        self.ingest.commit(conn)
+
+
+class ApplierThread(threading.Thread):
+    """Run the applier every `interval` seconds"""
+
+    def __init__(self, applier, interval, log):
+        threading.Thread.__init__(self, name='monit-spool')
+        self.setDaemon(True)
+        self.applier = applier
+        self.interval = interval
+        self.log = log
+
+    def run(self):
+        while True:
+            try:
+                count = self.applier.apply()
+                if count:
+                    self.log.debug("Applied %d spooled documents" % count)
+            except Exception, e:
+                self.log.exception("Applying the monit spool failed: %s" % e)
+            time.sleep(self.interval)
+
+
+def main(args=None):
+    parser = OptionParser(usage='%prog [options] /path/to/tracenv')
+    parser.add_option('-b', '--batch-size', type='int', default=1000,
+                      help='documents per transaction [%default]')
+    parser.add_option('-i', '--interval', type='float', default=0,
+                      help='keep running, apply every INTERVAL seconds '
+                           '[apply once]')
+    parser.add_option('-v', '--verbose', action='store_true', default=False)
+    options, args = parser.parse_args(args)
+    if len(args) != 1:
+        parser.error('the path of the Trac environment is required')
+    env_path = args[0]
+
+    logging.basicConfig(level=options.verbose and logging.DEBUG or logging.INFO,
+                        format='%(asctime)s %(name)s %(levelname)s: %(message)s')
+    log = logging.getLogger('monit-spool')
+
+    config = ConfigParser()
+    config.read(joinpath(env_path, 'conf', 'trac.ini'))
+    db_path = joinpath(env_path, 'db', 'monit.db')
+    partitions = partition.from_env(env_path, log)
+    rules = None
+    if config.has_section('monit-rules'):
+        try:
+            rules = RuleEngine(parse_rules(config.items('monit-rules')), log)
+        except ValueError, e:
+            parser.error(str(e))
+
+    spool = Spool(joinpath(env_path, 'db', 'monit-spool'), log)
+    applier = Applier(spool, db_path, log, MonitIngest(log, partitions, rules),
+                      options.batch_size)
+    while True:
+        count = applier.apply()
+        if count is None:
+            log.info("Another applier is running")
+        elif count or not options.interval:
+            log.info("Applied %d documents" % count)
+        if not options.interval:
+            break
+        time.sleep(options.interval)
+
+if __name__ == '__main__':
+    sys.exit(main())
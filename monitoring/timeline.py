@@ -0,0 +1,208 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
+"""Timeline events of monit.db, cached per filter set.
+
+Trac asks for the events of the whole timeline window (30 days by
+default) on every view. Events are only appended, except that a
+repeated event updates `count` and `last_sec` of the last event of its
+service, the one `event_latest` points to (see ingest.py). A cached
+window is brought up to date per schema with
+
+  - the events with an id above the last one read,
+  - the events `event_latest` points to and the ones it pointed to on
+    the last update, rendered again if their count changed,
+  - the older events if the window starts earlier than before, events
+    collected before the start are dropped as the window slides.
+
+Each schema is read in one transaction, an event which is not the
+latest of its service in that snapshot won't change anymore. The cache
+holds at most `max_events` events, the filter sets used least recently
+are dropped first.
+"""
+
+import threading
+
+from db import sqlite
+from ingest import srv_types
+
+
+class TimelineCache(object):
+
+    def __init__(self, make, max_events=20000):
+        """@param make, called with the event, service and monit rows
+                  (service and monit may be None), returns the item
+                  kept for the event
+           @param max_events, events kept for all filter sets"""
+        self.make = make
+        self.max_events = max_events
+        self._lock = threading.Lock()
+        self._entries = {} # event types -> _Entry
+        self._used = 0
+
+    def events(self, conn, types, start, stop, prefixes):
+        """The items of the events of `types` collected in [start, stop].
+        `prefixes` are the schemas holding them, see
+        `Partitions.iter_range()`."""
+        types = tuple(sorted(types))
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(types, None) or _Entry()
+            items = []
+            visited = set()
+            for prefix in prefixes:
+                visited.add(prefix)
+                schema = self._update(conn, prefix, types, start,
+                                      entry.schemas.get(prefix))
+                entry.schemas[prefix] = schema
+                items.extend([e[3] for e in schema.events.values()
+                              if e[0] <= stop])
+            for prefix, schema in entry.schemas.items():
+                if prefix not in visited:
+                    # before the window or a partition which was dropped
+                    schema.trim(stop + 1)
+                    if not schema.events:
+                        del entry.schemas[prefix]
+            self._used += 1
+            entry.used = self._used
+            self._entries[types] = entry
+            self._evict()
+            return items
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._entries = {}
+        finally:
+            self._lock.release()
+
+    def size(self):
+        """number of events cached"""
+        return sum([e.size() for e in self._entries.values()])
+
+    # Internal methods
+
+    def _evict(self):
+        size = self.size()
+        entries = self._entries.items()
+        entries.sort(key=lambda item: item[1].used)
+        for types, entry in entries:
+            if size <= self.max_events:
+                break
+            size -= entry.size()
+            del self._entries[types]
+
+    def _update(self, conn, prefix, types, start, schema):
+        """bring the events of schema `prefix` up to date"""
+        cur = conn.cursor()
+        where = " AND type IN (%s)" % ','.join(['?'] * len(types))
+        cur.execute("BEGIN") # one snapshot for all reads below
+        try:
+            cur.execute("SELECT MAX(id) AS id FROM %sevent" % prefix)
+            last_id = cur.fetchone()['id'] or 0
+            if schema is None or last_id < schema.last_id: # new or recreated
+                schema = _Schema(start)
+                self._add(cur, prefix, schema, "collected_sec >= ? AND id <= ?"
+                          + where, (start, last_id) + types)
+            else:
+                if start < schema.start:
+                    self._add(cur, prefix, schema, "collected_sec >= ? AND "
+                              "collected_sec < ? AND id <= ?" + where,
+                              (start, schema.start, schema.last_id) + types)
+                else:
+                    schema.trim(start)
+                if last_id > schema.last_id:
+                    self._add(cur, prefix, schema, "id > ? AND id <= ? AND "
+                              "collected_sec >= ?" + where,
+                              (schema.last_id, last_id, start) + types)
+            schema.start, schema.last_id = start, last_id
+            self._refresh(cur, prefix, schema, types)
+        finally:
+            conn.commit()
+        return schema
+
+    def _refresh(self, cur, prefix, schema, types):
+        """render the events again which were counted since the last
+        update"""
+        try:
+            cur.execute("SELECT e.* FROM %sevent_latest l JOIN %sevent e ON "
+                        "e.id = l.event_id WHERE e.id <= ? AND e.collected_sec "
+                        ">= ? AND e.type IN (%s)" % (prefix, prefix,
+                        ','.join(['?'] * len(types))),
+                        (schema.last_id, schema.start) + types)
+        except sqlite.OperationalError: # not upgraded, nothing is counted
+            return
+        rows = cur.fetchall()
+        latest = set([r['id'] for r in rows])
+        done = [i for i in schema.latest if i not in latest and
+                i in schema.events]
+        for i in range(0, len(done), 500):
+            part = done[i:i+500]
+            cur.execute("SELECT * FROM %sevent WHERE id IN (%s)" % (
+                        prefix, ','.join(['?'] * len(part))), part)
+            rows.extend(cur.fetchall())
+        lookups = {}
+        for evt in rows:
+            cached = schema.events.get(evt['id'])
+            if cached and cached[1:3] != (evt.get('count'), evt.get('last_sec')):
+                schema.events[evt['id']] = self._event(cur, prefix, evt, lookups)
+        schema.latest = latest
+
+    def _add(self, cur, prefix, schema, where, args):
+        cur.execute("SELECT * FROM %sevent WHERE %s" % (prefix, where), args)
+        lookups = {}
+        for evt in cur.fetchall():
+            schema.events[evt['id']] = self._event(cur, prefix, evt, lookups)
+
+    def _event(self, cur, prefix, evt, lookups):
+        """(collected_sec, count, last_sec, item) of one event row,
+        `lookups` keeps the service and monit rows for the next ones"""
+        table = '%s%s_service' % (prefix, srv_types[evt['type']])
+        key = (table, evt['service_id'])
+        if key not in lookups:
+            cur.execute("SELECT * FROM %s WHERE id=? LIMIT 1" % table,
+                        (evt['service_id'],))
+            lookups[key] = cur.fetchone()
+        srv = lookups[key]
+        monit = None
+        if srv:
+            key = ('monit', srv['monit_id'])
+            if key not in lookups:
+                cur.execute("SELECT * FROM monit WHERE id=?", (srv['monit_id'],))
+                lookups[key] = cur.fetchone()
+            monit = lookups[key]
+        return (evt['collected_sec'], evt.get('count'), evt.get('last_sec'),
+                self.make(evt, srv, monit))
+
+
+class _Entry(object):
+    """the cached events of one filter set"""
+
+    def __init__(self):
+        self.schemas = {} # schema prefix -> _Schema
+        self.used = 0
+
+    def size(self):
+        return sum([len(s.events) for s in self.schemas.values()])
+
+
+class _Schema(object):
+    """the cached events of one filter set in one schema: all with an id
+    up to `last_id` collected since `start`"""
+
+    def __init__(self, start):
+        self.start = start
+        self.last_id = 0
+        self.events = {} # id -> (collected_sec, count, last_sec, item)
+        self.latest = set() # ids of the events which may still be counted
+
+    def trim(self, start):
+        """drop the events collected before `start`"""
+        if start <= self.start:
+            return
+        for id, event in self.events.items():
+            if event[0] < start:
+                del self.events[id]
+        self.latest &= set(self.events)
+        self.start = start
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2008 Paul Kölle (pkoelle@gmail.com)
+"""Encodings of the documents posted to /collector.
+
+Besides `application/json` the collectors accept the same document as
+MessagePack (`application/x-msgpack`, if the msgpack module is
+installed), either one optionally compressed with `Content-Encoding:
+gzip` or `deflate`. Compressed bodies are inflated chunk by chunk as
+they are read and never beyond `MAX_SIZE`.
+"""
+
+import zlib
+
+try:
+    import simplejson
+    have_json = True
+except ImportError:
+    have_json = False
+
+try:
+    import msgpack
+    have_msgpack = True
+except ImportError:
+    have_msgpack = False
+
+MAX_SIZE = 16*1024*1024 # bytes of a decoded document
+
+json_types = ['application/json']
+msgpack_types = ['application/x-msgpack', 'application/msgpack']
+
+
+class DecodeError(ValueError):
+    """the body is not a valid document"""
+
+class TooLarge(ValueError):
+    """the decoded body exceeds the size limit"""
+
+class Unsupported(ValueError):
+    """unknown content or transfer encoding"""
+
+
+def content_types():
+    """the document types which can be parsed here"""
+    types = []
+    if have_json:
+        types += json_types
+    if have_msgpack:
+        types += msgpack_types
+    return types
+
+
+class Decoder(object):
+    """Collect a request body fed in chunks, inflating it on the fly"""
+
+    def __init__(self, encoding=None, max_size=MAX_SIZE):
+        encoding = (encoding or 'identity').strip().lower()
+        if encoding not in ('identity', 'gzip', 'x-gzip', 'deflate'):
+            raise Unsupported("Content-Encoding '%s'" % encoding)
+        self.encoding = encoding
+        self.max_size = max_size
+        self._inflate = None
+        self._parts = []
+        self._size = 0
+
+    def feed(self, data):
+        if not data:
+            return
+        if self.encoding != 'identity':
+            if self._inflate is None:
+                self._inflate = zlib.decompressobj(self._wbits(data))
+            try:
+                data = self._inflate.decompress(data, self.max_size - self._size + 1)
+            except zlib.error, e:
+                raise DecodeError(str(e))
+            if self._inflate.unconsumed_tail:
+                raise TooLarge("more than %d bytes" % self.max_size)
+        self._add(data)
+
+    def finish(self):
+        """the whole decoded body"""
+        if self._inflate is not None:
+            try:
+                self._add(self._inflate.flush())
+            except zlib.error, e:
+                raise DecodeError(str(e))
+        return ''.join(self._parts)
+
+    def _add(self, data):
+        self._size += len(data)
+        if self._size > self.max_size:
+            raise TooLarge("more than %d bytes" % self.max_size)
+        self._parts.append(data)
+
+    def _wbits(self, first):
+        if self.encoding != 'deflate':
+            return 16 + zlib.MAX_WBITS # gzip header
+        # "deflate" should be zlib wrapped, some clients send it raw
+        if len(first) >= 2 and ord(first[0]) & 0x0f == 8 and \
+                (ord(first[0]) << 8 | ord(first[1])) % 31 == 0:
+            return zlib.MAX_WBITS
+        return -zlib.MAX_WBITS
+
+
+def read_body(read, length, encoding=None, max_size=MAX_SIZE, chunk=65536):
+    """Read `length` bytes (all if None) of a request body with
+    `read(size)` and return it decoded. Raises DecodeError, TooLarge or
+    Unsupported."""
+    decoder = Decoder(encoding, max_size)
+    if length is None: # no Content-Length, read what there is
+        decoder.feed(read())
+        return decoder.finish()
+    if length > max_size: # compressed it is never larger
+        raise TooLarge("more than %d bytes" % max_size)
+    while length > 0:
+        data = read(min(chunk, length))
+        if not data:
+            break
+        length -= len(data)
+        decoder.feed(data)
+    return decoder.finish()
+
+def parse(body, content_type):
+    """the document in `body`, raises DecodeError or Unsupported"""
+    if content_type in json_types and have_json:
+        try:
+            return simplejson.loads(body.replace('\n', '')) #strip linebreaks
+        except ValueError, e:
+            raise DecodeError(str(e))
+    elif content_type in msgpack_types and have_msgpack:
+        try:
+            data = msgpack.unpackb(body, raw=False)
+        except Exception, e:
+            raise DecodeError(str(e))
+        if not isinstance(data, dict):
+            raise DecodeError("not a document")
+        return data
+    raise Unsupported("Content-Type '%s'" % content_type)
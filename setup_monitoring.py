@@ -19,6 +19,14 @@ setup(name=PACKAGE,
             'monitoring.db = monitoring.db',
             'monitoring.munin = monitoring.munin',
             'monitoring.monit = monitoring.monit'
+            ],
+        'console_scripts': [
+            'monit-collectord = monitoring.collectord:main',
+            'munin-prerender = monitoring.prerender:main',
+            'monit-backfill = monitoring.backfill:main',
+            'monit-export = monitoring.export:main',
+            'monit-spool = monitoring.spool:main',
+            'monit-report = monitoring.analytics:main',
             ]},
       package_data={'monitoring': ['templates/*.html', 'htdocs/*']},
       install_requires= ['simplejson']
@@ -0,0 +1,157 @@
+-- monit.db written by the original plugin (schema version 3, the client
+-- row at db_version 1), one document with an event
+BEGIN TRANSACTION;
+CREATE TABLE directory_service (
+    id INTEGER PRIMARY KEY,
+    monit_id INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    monitormode INTEGER NOT NULL,
+    monitor INTEGER NOT NULL,
+    collected_sec INTEGER NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    groupname VARCHAR(255),
+    pendingaction INTEGER,
+    timestamp INTEGER,
+    mode INTEGER,
+    gid INTEGER,
+    uid INTEGER, type INTEGER, status_message VARCHAR(255));
+CREATE TABLE event (
+    id INTEGER PRIMARY KEY,
+    service_id INTEGER NOT NULL,
+    type INTEGER NOT NULL,
+    collected_sec INTEGER NOT NULL,
+    state INTEGER,
+    action INTEGER,
+    message VARCHAR(255) NOT NULL,
+    groupname VARCHAR(255)
+);
+INSERT INTO "event" VALUES(1,2,3,1230000000,1,0,'down',NULL);
+CREATE TABLE file_service (
+    id INTEGER PRIMARY KEY,
+    monit_id INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    monitormode INTEGER NOT NULL,
+    monitor INTEGER NOT NULL,
+    collected_sec INTEGER NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    groupname VARCHAR(255),
+    pendingaction INTEGER,
+    timestamp INTEGER,
+    size INTEGER,
+    mode INTEGER,
+    gid INTEGER,
+    uid INTEGER, type INTEGER, status_message VARCHAR(255));
+CREATE TABLE filesystem_service (
+    id INTEGER PRIMARY KEY,
+    monit_id INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    monitormode INTEGER NOT NULL,
+    monitor INTEGER NOT NULL,
+    collected_sec INTEGER NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    groupname VARCHAR(255),
+    pendingaction INTEGER,
+    mode INTEGER,
+    gid INTEGER,
+    uid INTEGER,
+    flags INTEGER,
+    block_percent REAL NOT NULL,
+    block_usage REAL NOT NULL,
+    block_total REAL NOT NULL,
+    inode_percent REAL,
+    inode_usage REAL,
+    inode_total REAL
+, type INTEGER, status_message VARCHAR(255));
+INSERT INTO "filesystem_service" VALUES(1,1,0,0,1,1230000000,'rootfs',NULL,0,755,0,0,0,42.0,420.0,1000.0,1.0,10.0,1000.0,0,NULL);
+CREATE TABLE host_icmp (
+    id INTEGER PRIMARY KEY,
+    host_id INTEGER NOT NULL,
+    type VARCHAR(255),
+    responsetime REAL
+);
+CREATE TABLE host_port (
+    id INTEGER PRIMARY KEY,
+    host_id INTEGER NOT NULL,
+    type VARCHAR(255),
+    responsetime REAL,
+    portnumber INTEGER,
+    request VARCHAR(255),
+    hostname VARCHAR(255),
+    protocol VARCHAR(255)
+);
+CREATE TABLE host_service (
+    id INTEGER PRIMARY KEY,
+    monit_id INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    monitormode INTEGER NOT NULL,
+    monitor INTEGER NOT NULL,
+    collected_sec INTEGER NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    groupname VARCHAR(255),
+    pendingaction INTEGER
+, type INTEGER, status_message VARCHAR(255));
+CREATE TABLE monit (
+    id INTEGER PRIMARY KEY,
+    db_version INTEGER DEFAULT 1,
+    address VARCHAR(255),
+    port INTEGER,
+    ssl INTEGER,
+    uptime INTEGER,
+    incarnation INTEGER,
+    version VARCHAR(255),
+    localhostname VARCHAR(255) NOT NULL,
+    monitid VARCHAR(255) NOT NULL,
+    platform_name VARCHAR(255),
+    platform_machine VARCHAR(255),
+    platform_version VARCHAR(255),
+    platform_memory VARCHAR(255),
+    platform_release VARCHAR(255),
+    platform_cpu INTEGER,
+    startdelay INTEGER,
+    controlfile VARCHAR(255),
+    poll INTEGER );
+INSERT INTO "monit" VALUES(1,1,NULL,NULL,NULL,86400,1230000000,'5.0','bench','ffffffffffffffffffffffffffffffff','Linux','x86_64','#1','2055120','2.6.26',4,0,'/etc/monitrc',60);
+CREATE TABLE process_service (
+    id INTEGER PRIMARY KEY,
+    monit_id INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    monitormode INTEGER NOT NULL,
+    monitor INTEGER NOT NULL,
+    collected_sec INTEGER NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    groupname VARCHAR(255),
+    pendingaction INTEGER,
+    uptime INTEGER,
+    pid INTEGER NOT NULL,
+    ppid INTEGER,
+    children INTEGER,
+    cpu_percent REAL,
+    cpu_percenttotal REAL,
+    memory_kilobyte REAL,
+    memory_kilobytetotal REAL,
+    memory_percent REAL,
+    memory_percenttotal REAL, type INTEGER, status_message VARCHAR(255));
+INSERT INTO "process_service" VALUES(1,1,0,0,1,1230000000,'process-0',NULL,0,86400,1000,1,0,0.1,0.3,8124.0,16248.0,0.4,0.9,3,NULL);
+INSERT INTO "process_service" VALUES(2,1,0,0,1,1230000000,'process-1',NULL,0,86401,1001,1,1,0.1,0.3,8125.0,16248.0,0.4,0.9,3,NULL);
+INSERT INTO "process_service" VALUES(3,1,0,0,1,1230000000,'process-2',NULL,0,86402,1002,1,2,0.1,0.3,8126.0,16248.0,0.4,0.9,3,NULL);
+CREATE TABLE system_service (
+    id INTEGER PRIMARY KEY,
+    monit_id INTEGER NOT NULL,
+    status INTEGER NOT NULL,
+    monitormode INTEGER NOT NULL,
+    monitor INTEGER NOT NULL,
+    collected_sec INTEGER NOT NULL,
+    name VARCHAR(255) NOT NULL,
+    groupname VARCHAR(255),
+    status_message VARCHAR(255),
+    pendingaction INTEGER,
+    load_avg01 REAL DEFAULT 0,
+    load_avg05 REAL DEFAULT 0,
+    load_avg15 REAL DEFAULT 0,
+    cpu_wait REAL DEFAULT 0,
+    cpu_user REAL DEFAULT 0,
+    cpu_system REAL DEFAULT 0,
+    memory_kilobyte REAL DEFAULT 0,
+    memory_percent REAL DEFAULT 0, type INTEGER);
+INSERT INTO "system_service" VALUES(1,1,0,0,1,1230000000,'localhost',NULL,NULL,0,0.12,0.2,0.3,0.1,1.5,0.7,843212.0,41.2,5);
+COMMIT;
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""Fleet reports over clients which share a localhostname.
+
+A host whose .monit.id was generated again posts with a new monit id
+under its old name, both clients are one series in the reports.
+
+Usage: python -m unittest discover tests
+"""
+
+import logging, os, shutil, sys, tempfile, unittest
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(root, 'monitoring'))
+
+import analytics, db
+from ingest import MonitIngest
+from test_upgrade import make_document
+
+log = logging.getLogger('test_analytics')
+
+
+class SharedHostnameTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        path = os.path.join(self.dir, 'monit.db')
+        db.ensure_schema(path, log)
+        self.conn = db.connect(path, isolation_level=None)
+        ingest = MonitIngest(log)
+        ingest.begin(self.conn)
+        for i, (monitid, cpu) in enumerate([('a' * 32, 10.0), ('b' * 32, 30.0)]):
+            doc = make_document(1230000060 + i * 3600)
+            doc['monit']['server']['id'] = monitid
+            doc['servicelist'][0]['cpu']['percent'] = cpu
+            ingest.store(self.conn, doc)
+        ingest.commit(self.conn)
+        self.have_numpy = analytics.have_numpy
+
+    def tearDown(self):
+        analytics.have_numpy = self.have_numpy
+        self.conn.close()
+        shutil.rmtree(self.dir)
+
+    def _check(self):
+        samples = analytics.load(self.conn, 'process_service', 'cpu_percent')
+        self.assertEqual([('bench', 'process-1')], samples.keys)
+        rows = analytics.daily(samples, (0.5,))
+        self.assertEqual(1, len(rows))
+        self.assertEqual((2, 20.0, 10.0, 30.0), (rows[0]['count'],
+                         rows[0]['mean'], rows[0]['min'], rows[0]['max']))
+        rows = analytics.trend(samples)
+        self.assertEqual(1, len(rows))
+        self.assertEqual((2, 30.0), (rows[0]['count'], rows[0]['last']))
+        self.assertAlmostEqual(480.0, rows[0]['slope'])
+
+    def test_python(self):
+        analytics.have_numpy = False
+        self._check()
+
+    def test_numpy(self):
+        if not self.have_numpy:
+            return
+        self._check()
+
+
+if __name__ == '__main__':
+    unittest.main()
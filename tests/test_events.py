@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+"""Coalescing of repeated events when older documents are backfilled.
+
+An event older than the last one of its service is stored on its own, the
+episode the live events coalesce into goes on.
+
+Usage: python -m unittest discover tests
+"""
+
+import logging, os, shutil, sys, tempfile, unittest
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(root, 'monitoring'))
+
+import db, partition
+from ingest import MonitIngest
+from test_upgrade import make_document
+
+log = logging.getLogger('test_events')
+
+T = 1230040000 # 2008-12-23 13:46:40 UTC
+
+
+class BackfillEventTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'monit.db')
+        db.ensure_schema(self.path, log)
+        self.partitions = partition.Partitions(self.path, 'day', log)
+        self.ingest = MonitIngest(log, self.partitions)
+        self.conn = db.connect(self.path, isolation_level=None)
+
+    def tearDown(self):
+        self.conn.close()
+        shutil.rmtree(self.dir)
+
+    def _store(self, collected_sec, state, message):
+        doc = make_document(collected_sec)
+        doc['event'].update({'state': state, 'message': message})
+        self.ingest.begin(self.conn)
+        self.ingest.store(self.conn, doc)
+        self.ingest.commit(self.conn)
+
+    def _events(self):
+        name = self.partitions.name(self.partitions.bounds(T)[0])
+        conn = db.connect(self.partitions.path(name))
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT e.collected_sec, e.last_sec, e.count, "
+                        "e.state, s.value AS message FROM event_data e "
+                        "JOIN strings s ON s.id = e.message_id ORDER BY e.id")
+            return [(r['collected_sec'], r['last_sec'], r['count'],
+                     r['state'], r['message']) for r in cur.fetchall()]
+        finally:
+            conn.close()
+
+    def test_backfill_keeps_episode(self):
+        self._store(T, 1, 'down')
+        self._store(T + 60, 1, 'down')
+        self._store(T - 3600, 0, 'up')
+        self._store(T + 120, 1, 'down')
+        self.assertEqual([(T, T + 120, 3, 1, 'down'),
+                          (T - 3600, T - 3600, 1, 0, 'up')], self._events())
+
+    def test_backfill_not_coalesced(self):
+        self._store(T, 1, 'down')
+        self._store(T - 3600, 1, 'down')
+        self._store(T + 60, 1, 'down')
+        self.assertEqual([(T, T + 60, 2, 1, 'down'),
+                          (T - 3600, T - 3600, 1, 1, 'down')], self._events())
+
+
+if __name__ == '__main__':
+    unittest.main()
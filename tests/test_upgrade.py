@@ -0,0 +1,90 @@
+# -*- coding: utf-8 -*-
+"""Upgrade of a monit.db written by the original plugin.
+
+baseline-monit.sql is the dump of a monit.db the original plugin
+created and stored one document with an event in.
+
+Usage: python -m unittest discover tests
+"""
+
+import logging, os, shutil, sys, tempfile, unittest
+
+root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(root, 'monitoring'))
+
+import db
+from ingest import MonitIngest
+
+log = logging.getLogger('test_upgrade')
+
+def make_document(collected_sec):
+    return {'monit': {'server': {'id': 'f' * 32, 'incarnation': 1230000000,
+                                 'version': '5.0', 'uptime': 86400, 'poll': 60,
+                                 'startdelay': 0, 'localhostname': 'bench',
+                                 'controlfile': '/etc/monitrc'}},
+            'servicelist': [{'type': 3, 'name': 'process-1', 'status': 0,
+                             'monitor': 1, 'monitormode': 0,
+                             'pendingaction': 0, 'collected_sec': collected_sec,
+                             'collected_usec': 0, 'pid': 1001, 'ppid': 1,
+                             'uptime': 86400, 'children': 0,
+                             'memory': {'percent': 0.4, 'percenttotal': 0.9,
+                                        'kilobyte': 8124,
+                                        'kilobytetotal': 16248},
+                             'cpu': {'percent': 0.1, 'percenttotal': 0.3}}],
+            'event': {'type': 3, 'service': 'process-1', 'state': 0,
+                      'action': 0, 'message': 'up', 'id': 1,
+                      'collected_sec': collected_sec, 'collected_usec': 0}}
+
+
+class BaselineUpgradeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'monit.db')
+        conn = db.connect(self.path)
+        conn.executescript(open(os.path.join(os.path.dirname(__file__),
+                                             'baseline-monit.sql')).read())
+        conn.close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_upgrade(self):
+        db.ensure_schema(self.path, log)
+        conn = db.connect(self.path)
+        try:
+            cur = conn.cursor()
+            cur.execute("PRAGMA user_version")
+            self.assertEqual(db.db_version, cur.fetchone()['user_version'])
+            cur.execute("SELECT name FROM process_service ORDER BY name")
+            self.assertEqual(['process-0', 'process-1', 'process-2'],
+                             [r['name'] for r in cur.fetchall()])
+            cur.execute("SELECT message, count, last_sec FROM event")
+            self.assertEqual([{'message': 'down', 'count': 1,
+                               'last_sec': 1230000000}], cur.fetchall())
+        finally:
+            conn.close()
+
+    def test_store_after_upgrade(self):
+        db.ensure_schema(self.path, log)
+        ingest = MonitIngest(log)
+        conn = db.connect(self.path, isolation_level=None)
+        try:
+            ingest.begin(conn)
+            ingest.store(conn, make_document(1230000060))
+            ingest.commit(conn)
+            cur = conn.cursor()
+            cur.execute("SELECT COUNT(*) AS n FROM monit")
+            self.assertEqual(1, cur.fetchone()['n'])
+            cur.execute("SELECT COUNT(*) AS n FROM process_service")
+            self.assertEqual(4, cur.fetchone()['n'])
+            cur.execute("SELECT message FROM event ORDER BY id")
+            self.assertEqual(['down', 'up'], [r['message'] for r in cur.fetchall()])
+            cur.execute("SELECT COUNT(*) AS n FROM overview_service")
+            self.assertTrue(cur.fetchone()['n'] > 0)
+        finally:
+            conn.close()
+
+
+if __name__ == '__main__':
+    unittest.main()